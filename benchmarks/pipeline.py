@@ -0,0 +1,420 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+"""End-to-end benchmark of the polling, claim, stream and report pipeline
+
+Runs background_task_loop() from lib/main.py against two local stand-ins, so the pipeline
+can be measured offline and without models:
+- a fake Nextcloud serving the task processing OCS API (next_task, report_result,
+  stream-result, progress) from a queue of synthetic tasks
+- one fake OpenAI-compatible llama-server per model, with a configurable time to first
+  token, token rate and number of slots
+
+The model servers are "spawned" by a server pool whose spawn function points the model
+clients at the fake servers, so server startup (--cold-start) is part of the measurement.
+Tasks arrive all at once or at --rate tasks per second; --no-trigger leaves finding them
+to polling alone.
+
+Usage: python benchmarks/pipeline.py [--tasks 200] [--models 1] [--slots 4] [--mix TYPE=WEIGHT,...] [--json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+
+LIB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib")
+sys.path.insert(0, LIB_PATH)
+
+import uvicorn  # noqa: E402
+from fastapi import FastAPI, Request, Response  # noqa: E402
+from fastapi.responses import JSONResponse, StreamingResponse  # noqa: E402
+
+DEFAULT_MIX = "core:text2text:headline=3,core:text2text=2,core:text2text:summary=1"
+WORDS = "the quick brown fox jumps over a lazy dog while the scheduler keeps every slot busy".split()
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile; 0 for no values."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered) + 0.5) - 1))]
+
+
+def ocs(data) -> JSONResponse:
+    return JSONResponse({"ocs": {"meta": {"status": "ok", "statuscode": 200, "message": "OK"}, "data": data}})
+
+
+@dataclass
+class TaskRecord:
+    task_type: str
+    scheduled: float = 0.0
+    claimed: float = 0.0
+    finished: float = 0.0
+    error: str | None = None
+
+
+class FakeNextcloud:
+    """Task processing OCS endpoints over an in-memory queue."""
+
+    def __init__(self, tasks: list[dict], on_new_task) -> None:
+        self.pending = deque(tasks)
+        self.queue: deque[dict] = deque()
+        self.records: dict[int, TaskRecord] = {task["id"]: TaskRecord(task["type"]) for task in tasks}
+        self.on_new_task = on_new_task
+        self.finished = 0
+        self.next_calls = 0
+        self.empty_calls = 0
+        self.stream_updates = 0
+        self.progress_updates = 0
+        self.app = FastAPI()
+        self.app.add_api_route("/ocs/v2.php/taskprocessing/tasks_provider/next", self.next_task, methods=["GET"])
+        self.app.add_api_route("/ocs/v2.php/taskprocessing/tasks_provider/{task_id}/result", self.result, methods=["POST"])
+        self.app.add_api_route(
+            "/ocs/v2.php/taskprocessing/tasks_provider/{task_id}/stream-result", self.stream_result, methods=["POST"],
+        )
+        self.app.add_api_route(
+            "/ocs/v2.php/taskprocessing/tasks_provider/{task_id}/progress", self.progress, methods=["POST"],
+        )
+        self.app.add_api_route("/ocs/v1.php/cloud/capabilities", self.capabilities, methods=["GET"])
+        self.app.add_api_route("/{path:path}", self.anything, methods=["GET", "POST", "PUT", "DELETE"])
+
+    async def schedule(self, rate: float, rng: random.Random) -> None:
+        """Moves the tasks into the queue, all at once or as a Poisson process of `rate` tasks/s."""
+        while self.pending:
+            if rate > 0:
+                await asyncio.sleep(rng.expovariate(rate))
+            task = self.pending.popleft()
+            task["scheduledAt"] = int(time.time())
+            self.records[task["id"]].scheduled = time.perf_counter()
+            self.queue.append(task)
+            if rate > 0 or not self.pending:
+                self.on_new_task()
+
+    async def next_task(self, request: Request) -> Response:
+        self.next_calls += 1
+        body = await request.json()
+        provider_by_type: dict[str, str] = {}
+        for provider_id in body["providerIds"]:
+            provider_by_type.setdefault(provider_id.split(":", 2)[2], provider_id)
+        for task in self.queue:
+            provider_id = provider_by_type.get(task["type"])
+            if provider_id is not None:
+                self.queue.remove(task)
+                self.records[task["id"]].claimed = time.perf_counter()
+                return ocs({"task": task, "provider": {"name": provider_id}})
+        self.empty_calls += 1
+        return Response(status_code=204)
+
+    async def result(self, task_id: int, request: Request) -> Response:
+        body = await request.json()
+        record = self.records[task_id]
+        record.finished = time.perf_counter()
+        record.error = body.get("errorMessage")
+        self.finished += 1
+        return ocs({"task": {"id": task_id}})
+
+    async def stream_result(self, task_id: int) -> Response:
+        self.stream_updates += 1
+        return ocs([])
+
+    async def progress(self, task_id: int) -> Response:
+        self.progress_updates += 1
+        return ocs({"task": {"id": task_id, "status": "STATUS_RUNNING"}})
+
+    async def capabilities(self) -> Response:
+        return ocs({
+            "version": {"major": 33, "minor": 0, "micro": 0, "string": "33.0.0", "edition": "", "extendedSupport": False},
+            "capabilities": {"app_api": {"loglevel": 4}},
+        })
+
+    async def anything(self, path: str) -> Response:
+        return ocs([])
+
+
+class FakeLlamaServer:
+    """OpenAI-compatible chat completions with llama-server's slot limit, health and /tokenize."""
+
+    def __init__(self, slots: int, ttft: float, token_rate: float, output_tokens: int, cold_start: float, seed: int):
+        self.slots = asyncio.Semaphore(slots)
+        self.slot_count = slots
+        self.ttft = ttft
+        self.token_rate = token_rate
+        self.output_tokens = output_tokens
+        self.cold_start = cold_start
+        self.rng = random.Random(seed)
+        self.ready_at: float | None = None
+        self.port = free_port()
+        # Integral of the busy slots over time, for the utilization
+        self.busy = 0
+        self.busy_seconds = 0.0
+        self._busy_since = time.perf_counter()
+        self.requests = 0
+        self.app = FastAPI()
+        self.app.add_api_route("/health", self.health, methods=["GET"])
+        self.app.add_api_route("/tokenize", self.tokenize, methods=["POST"])
+        self.app.add_api_route("/v1/chat/completions", self.chat_completions, methods=["POST"])
+
+    def spawned(self) -> None:
+        self.ready_at = time.monotonic() + self.cold_start
+
+    def _set_busy(self, delta: int) -> None:
+        now = time.perf_counter()
+        self.busy_seconds += self.busy * (now - self._busy_since)
+        self._busy_since = now
+        self.busy += delta
+
+    async def health(self) -> Response:
+        if self.ready_at is None or time.monotonic() < self.ready_at:
+            return JSONResponse({"error": {"code": 503, "message": "Loading model"}}, status_code=503)
+        return JSONResponse({"status": "ok"})
+
+    async def tokenize(self, request: Request) -> Response:
+        content = (await request.json()).get("content", "")
+        return JSONResponse({"tokens": list(range(len(content) // 4 + 1))})
+
+    async def chat_completions(self, request: Request) -> Response:
+        body = await request.json()
+        self.requests += 1
+        tokens = max(1, min(body.get("max_tokens") or self.output_tokens, round(self.output_tokens * self.rng.uniform(0.5, 1.5))))
+        if body.get("stream"):
+            return StreamingResponse(self._stream(body, tokens), media_type="text/event-stream")
+        async with self.slots:
+            self._set_busy(1)
+            try:
+                await asyncio.sleep(self.ttft + tokens / self.token_rate)
+            finally:
+                self._set_busy(-1)
+        return JSONResponse({
+            "id": "chatcmpl-bench", "object": "chat.completion", "created": int(time.time()), "model": body.get("model"),
+            "choices": [{
+                "index": 0, "finish_reason": "stop",
+                "message": {"role": "assistant", "content": " ".join(WORDS[i % len(WORDS)] for i in range(tokens))},
+            }],
+            "usage": {"prompt_tokens": 100, "completion_tokens": tokens, "total_tokens": 100 + tokens},
+        })
+
+    async def _stream(self, body: dict, tokens: int):
+        def chunk(delta: dict, finish_reason: str | None = None) -> bytes:
+            data = {
+                "id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": int(time.time()),
+                "model": body.get("model"), "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            return f"data: {json.dumps(data)}\n\n".encode()
+
+        async with self.slots:
+            self._set_busy(1)
+            try:
+                await asyncio.sleep(self.ttft)
+                yield chunk({"role": "assistant", "content": ""})
+                for i in range(tokens):
+                    yield chunk({"content": WORDS[i % len(WORDS)] + " "})
+                    await asyncio.sleep(1 / self.token_rate)
+                yield chunk({}, "stop")
+                yield b"data: [DONE]\n\n"
+            finally:
+                self._set_busy(-1)
+
+    def utilization(self, wall_time: float) -> float:
+        self._set_busy(0)
+        return self.busy_seconds / (self.slot_count * wall_time) if wall_time > 0 else 0.0
+
+
+def make_tasks(args: argparse.Namespace, rng: random.Random) -> list[dict]:
+    mix = []
+    for entry in args.mix.split(","):
+        task_type, _, weight = entry.partition("=")
+        mix.append((task_type.strip(), float(weight or 1)))
+    types, weights = zip(*mix)
+    filler = " ".join(WORDS)
+    tasks = []
+    for task_id in range(1, args.tasks + 1):
+        text = f"Task {task_id}. " + (filler + ". ") * max(1, args.input_chars // (len(filler) + 2))
+        tasks.append({
+            "id": task_id,
+            "type": rng.choices(types, weights)[0],
+            "input": {"input": text},
+            "preferStreaming": rng.random() < args.streaming,
+        })
+    return tasks
+
+
+def start_servers(
+        apps: list[tuple[FastAPI, int]],
+) -> tuple[asyncio.AbstractEventLoop, threading.Thread, list[uvicorn.Server]]:
+    """Serves the stand-ins from their own thread and event loop, apart from the app's loop."""
+    loop = asyncio.new_event_loop()
+    servers = [uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning")) for app, port in apps]
+
+    def run() -> None:
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(asyncio.gather(*(server.serve() for server in servers)))
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    while not all(server.started for server in servers):
+        time.sleep(0.01)
+    return loop, thread, servers
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tasks", type=int, default=200)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="task types and their weights")
+    parser.add_argument("--models", type=int, default=1)
+    parser.add_argument("--slots", type=int, default=4, help="n_parallel of every model")
+    parser.add_argument("--ttft", type=float, default=0.2, help="seconds to the first token")
+    parser.add_argument("--token-rate", type=float, default=50, help="tokens per second and slot")
+    parser.add_argument("--output-tokens", type=int, default=40, help="mean tokens per response")
+    parser.add_argument("--cold-start", type=float, default=1.0, help="seconds until a spawned server is ready")
+    parser.add_argument("--input-chars", type=int, default=2000)
+    parser.add_argument("--streaming", type=float, default=0.5, help="share of tasks that prefer streaming")
+    parser.add_argument("--rate", type=float, default=0, help="task arrivals per second, 0 to queue all at once")
+    parser.add_argument("--no-trigger", action="store_true", help="don't notify the app of new tasks")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    storage = tempfile.mkdtemp(prefix="llm2-bench-")
+    nextcloud_port = free_port()
+    # The app reads these when it is imported and when it creates its Nextcloud client
+    os.environ.update({
+        "APP_ID": "llm2", "APP_VERSION": "0.0.0", "APP_SECRET": "benchmark",
+        "NEXTCLOUD_URL": f"http://127.0.0.1:{nextcloud_port}", "APP_PERSISTENT_STORAGE": storage,
+        "RESULT_CACHE_DISABLED_TASK_TYPES": "all",
+    })
+    sys.exit(asyncio.run(run(args, storage, nextcloud_port)))
+
+
+async def run(args: argparse.Namespace, storage: str, nextcloud_port: int) -> int:
+    import logging
+
+    from langchain_openai import ChatOpenAI
+
+    import main as app
+    import task_processors
+    from metrics import GENERATION_METRICS
+    from server_pool import ModelServer, ServerLogPipe, ServerPool
+
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("main").setLevel(logging.WARNING)
+
+    rng = random.Random(args.seed)
+    fake_servers: dict[str, FakeLlamaServer] = {}
+    for i in range(args.models):
+        model = f"bench-model-{i}"
+        fake_servers[model] = FakeLlamaServer(
+            args.slots, args.ttft, args.token_rate, args.output_tokens, args.cold_start, args.seed + i,
+        )
+        open(os.path.join(storage, model + ".gguf"), "wb").close()
+        with open(os.path.join(storage, model + ".json"), "w") as f:
+            json.dump({"loader_config": {"n_ctx": 8192, "max_tokens": 512, "n_parallel": args.slots}}, f)
+
+    app_loop = asyncio.get_running_loop()
+    nextcloud = FakeNextcloud(
+        make_tasks(args, rng),
+        on_new_task=(lambda: None) if args.no_trigger else (
+            lambda: asyncio.run_coroutine_threadsafe(app.trigger_handler("llm2"), app_loop)
+        ),
+    )
+    server_loop, server_thread, servers = start_servers(
+        [(nextcloud.app, nextcloud_port)] + [(fake.app, fake.port) for fake in fake_servers.values()]
+    )
+
+    def spawn(model_name: str) -> ModelServer:
+        fake = fake_servers[model_name]
+        fake.spawned()
+        # Stands in for the llama-server process, so the pool can watch and stop it
+        proc = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(86400)"])
+        llm = ChatOpenAI(
+            base_url=f"http://127.0.0.1:{fake.port}/v1", api_key="not-needed", model=model_name,
+            max_tokens=512, callbacks=[GENERATION_METRICS],
+        )
+        return ModelServer(
+            model_name=model_name, proc=proc, base_url=f"http://127.0.0.1:{fake.port}", llm=llm,
+            log_pipe=ServerLogPipe(model_name),
+        )
+
+    pool = ServerPool(spawn, lambda model_name: 0)
+    app.SERVER_POOL = task_processors.SERVER_POOL = pool
+
+    app.app_enabled.set()
+    loop_task = asyncio.create_task(app.background_task_loop())
+    time_start = time.perf_counter()
+    asyncio.run_coroutine_threadsafe(nextcloud.schedule(args.rate, rng), server_loop)
+    timed_out = False
+    while nextcloud.finished < args.tasks:
+        if time.perf_counter() - time_start > args.timeout:
+            timed_out = True
+            break
+        await asyncio.sleep(0.02)
+    wall_time = time.perf_counter() - time_start
+
+    app.SHUTDOWN_EVENT.set()
+    app.trigger.set()
+    await loop_task
+    pool.stop_all()
+    for server in servers:
+        server.should_exit = True
+    server_thread.join(timeout=10)
+
+    records = [record for record in nextcloud.records.values() if record.finished]
+    claim_latencies = [record.claimed - record.scheduled for record in nextcloud.records.values() if record.claimed]
+    by_type: dict[str, list[float]] = {}
+    for record in records:
+        by_type.setdefault(record.task_type, []).append(record.finished - record.scheduled)
+    results = {
+        "tasks": len(records),
+        "errors": sum(1 for record in records if record.error),
+        "timed_out": timed_out,
+        "wall_seconds": wall_time,
+        "tasks_per_second": len(records) / wall_time if wall_time else 0.0,
+        "claim_latency_p50": percentile(claim_latencies, 50),
+        "claim_latency_p99": percentile(claim_latencies, 99),
+        "slot_utilization": {model: fake.utilization(wall_time) for model, fake in fake_servers.items()},
+        "model_requests": {model: fake.requests for model, fake in fake_servers.items()},
+        "next_task_calls": nextcloud.next_calls,
+        "next_task_empty": nextcloud.empty_calls,
+        "stream_updates": nextcloud.stream_updates,
+        "progress_updates": nextcloud.progress_updates,
+        "latency": {
+            task_type: {"count": len(values), "p50": percentile(values, 50), "p99": percentile(values, 99)}
+            for task_type, values in sorted(by_type.items())
+        },
+    }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(
+            f"{results['tasks']} tasks ({results['errors']} failed) in {wall_time:.2f}s: "
+            f"{results['tasks_per_second']:.2f} tasks/s{' (timed out)' if timed_out else ''}"
+        )
+        print(f"claim latency p50 {results['claim_latency_p50']:.3f}s p99 {results['claim_latency_p99']:.3f}s")
+        print(f"next_task calls {nextcloud.next_calls} ({nextcloud.empty_calls} empty), "
+              f"stream updates {nextcloud.stream_updates}, progress updates {nextcloud.progress_updates}")
+        for model, utilization in results["slot_utilization"].items():
+            print(f"slot utilization {model}: {utilization:.1%} ({results['model_requests'][model]} requests)")
+        print(f"{'task type':<32} {'count':>6} {'p50':>8} {'p99':>8}")
+        for task_type, stats in results["latency"].items():
+            print(f"{task_type:<32} {stats['count']:>6} {stats['p50']:>7.2f}s {stats['p99']:>7.2f}s")
+    return 1 if timed_out or results["errors"] else 0
+
+
+if __name__ == "__main__":
+    main()
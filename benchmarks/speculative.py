@@ -0,0 +1,184 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+"""Benchmark of speculative decoding with a draft model
+
+Starts lib/llama_server.py for the target model once without and once with the draft model,
+sends the same chat completions to both and compares the generation speed. For the draft
+run it also reports how many of the drafted tokens the target model accepted, from the
+timings llama-server adds to its responses. Generation is greedy, so both runs produce the
+same text and only the speed differs.
+
+Usage: python benchmarks/speculative.py --model target.gguf --draft draft.gguf
+           [--draft-max 16] [--draft-min 0] [--draft-p-min 0.75] [--requests 8] [--parallel 1] [--json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from threading import Thread
+
+LIB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib")
+sys.path.insert(0, LIB_PATH)
+
+import niquests  # noqa: E402
+
+from server_pool import ServerLogPipe, stop_process, wait_for_server  # noqa: E402
+
+SERVER_SCRIPT_PATH = os.path.join(LIB_PATH, "llama_server.py")
+
+# Long generations over varied content, where speculative decoding matters most
+PROMPTS = [
+    "Write a detailed summary of the history of the printing press and its effects on European society.",
+    "Explain step by step how a hash map works, including collision handling and resizing.",
+    "Draft a polite email to a customer explaining that their order will be delayed by two weeks.",
+    "List twenty practical tips for keeping a small vegetable garden healthy through a dry summer.",
+    "Describe the water cycle to a ten year old, using simple words and a few examples.",
+    "Rewrite the following sentence in five different tones: The meeting has been moved to Friday.",
+    "Write a Python function that parses ISO 8601 dates and explain each line of it.",
+    "Compare trains and planes for a 600 km trip in terms of cost, time, comfort and emissions.",
+]
+
+
+def find_free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def run_server(args: argparse.Namespace, draft: bool) -> dict:
+    port = find_free_port()
+    config = {
+        "model_path": args.model,
+        "hostname": "127.0.0.1",
+        "port": port,
+        "n_ctx": args.n_ctx,
+        "n_parallel": args.parallel,
+        "n_gpu_layers": args.n_gpu_layers,
+        "cont_batching": True,
+        **({
+            "draft_model": args.draft,
+            "draft_max": args.draft_max,
+            "draft_min": args.draft_min,
+            "draft_p_min": args.draft_p_min,
+            "draft_n_gpu_layers": args.n_gpu_layers,
+        } if draft else {}),
+    }
+    proc = subprocess.Popen(
+        [sys.executable, SERVER_SCRIPT_PATH, json.dumps(config)],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        bufsize=1,
+    )
+    log_pipe = ServerLogPipe("draft" if draft else "target")
+    Thread(target=log_pipe.consume, args=(proc.stdout,), daemon=True).start()
+    try:
+        await wait_for_server(proc, f"http://127.0.0.1:{port}", log_pipe)
+        return await run_requests(args, port)
+    finally:
+        stop_process(proc, timeout=5)
+
+
+async def run_requests(args: argparse.Namespace, port: int) -> dict:
+    semaphore = asyncio.Semaphore(args.parallel)
+    timings: list[dict] = []
+    completion_tokens = 0
+
+    async def request(session: niquests.AsyncSession, prompt: str) -> None:
+        nonlocal completion_tokens
+        async with semaphore:
+            resp = await session.post(
+                f"http://127.0.0.1:{port}/v1/chat/completions",
+                json={
+                    "messages": [{"role": "user", "content": prompt}],
+                    "max_tokens": args.max_tokens,
+                    "temperature": 0,
+                },
+                timeout=args.timeout,
+            )
+            resp.raise_for_status()
+            data = resp.json()
+            completion_tokens += data["usage"]["completion_tokens"]
+            timings.append(data.get("timings", {}))
+
+    prompts = [PROMPTS[i % len(PROMPTS)] for i in range(args.requests)]
+    async with niquests.AsyncSession() as session:
+        # Warm-up, so the first measured request doesn't pay for loading the weights into the caches
+        await request(session, PROMPTS[0])
+        timings.clear()
+        completion_tokens = 0
+        started = time.perf_counter()
+        await asyncio.gather(*(request(session, prompt) for prompt in prompts))
+        elapsed = time.perf_counter() - started
+
+    drafted = sum(t.get("draft_n", 0) for t in timings)
+    accepted = sum(t.get("draft_n_accepted", 0) for t in timings)
+    return {
+        "requests": len(prompts),
+        "completion_tokens": completion_tokens,
+        "seconds": elapsed,
+        "tokens_per_second": completion_tokens / elapsed if elapsed else 0.0,
+        "drafted_tokens": drafted,
+        "accepted_tokens": accepted,
+        "acceptance_rate": accepted / drafted if drafted else 0.0,
+    }
+
+
+async def run(args: argparse.Namespace) -> dict:
+    results = {}
+    if args.mode in ("both", "target"):
+        results["target"] = await run_server(args, draft=False)
+    if args.mode in ("both", "draft"):
+        results["draft"] = await run_server(args, draft=True)
+    if "target" in results and "draft" in results and results["target"]["tokens_per_second"]:
+        results["speedup"] = results["draft"]["tokens_per_second"] / results["target"]["tokens_per_second"]
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", required=True, help="GGUF file of the target model")
+    parser.add_argument("--draft", help="GGUF file of the draft model, with the target's vocabulary")
+    parser.add_argument("--mode", choices=("both", "target", "draft"), default="both")
+    parser.add_argument("--draft-max", type=int, default=16, help="most tokens to draft per step")
+    parser.add_argument("--draft-min", type=int, default=0, help="fewest tokens to draft per step")
+    parser.add_argument("--draft-p-min", type=float, default=0.75, help="least draft probability to keep drafting")
+    parser.add_argument("--requests", type=int, default=8)
+    parser.add_argument("--parallel", type=int, default=1, help="n_parallel and concurrent requests")
+    parser.add_argument("--max-tokens", type=int, default=512)
+    parser.add_argument("--n-ctx", type=int, default=8192)
+    parser.add_argument("--n-gpu-layers", type=int, default=0, help="0 to run on the CPU")
+    parser.add_argument("--timeout", type=float, default=900)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+    if args.mode != "target" and not args.draft:
+        parser.error("--draft is required unless --mode is target")
+
+    results = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for name in ("target", "draft"):
+        if name not in results:
+            continue
+        stats = results[name]
+        line = (
+            f"{name + ':':<8} {stats['tokens_per_second']:7.2f} tokens/s "
+            f"({stats['completion_tokens']} tokens in {stats['seconds']:.1f}s)"
+        )
+        if stats["drafted_tokens"]:
+            line += (
+                f", accepted {stats['accepted_tokens']}/{stats['drafted_tokens']} drafted tokens "
+                f"({stats['acceptance_rate']:.1%})"
+            )
+        print(line)
+    if "speedup" in results:
+        print(f"speedup  {results['speedup']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
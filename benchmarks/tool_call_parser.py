@@ -0,0 +1,129 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+"""Benchmark of the streamed tool call parsing of the chat with tools processor
+
+Streams long responses with many tool calls in token-sized chunks and compares rebuilding
+the payload from the whole text for every chunk (build_streaming_payload) with
+ToolCallStreamParser. Both must end with the same result as try_parse_tool_calls().
+
+Every payload holds the whole visible text, so building one costs linear time in any case;
+--payload-every N builds it only every N chunks, like rate-limited stream updates do.
+
+Usage: python benchmarks/tool_call_parser.py [--calls 25 50 100] [--chunk-size 4] [--payload-every 1]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import re
+import sys
+import time
+from typing import Any
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+
+from chatwithtools import try_parse_tool_calls  # noqa: E402
+from tool_call_parser import ToolCallStreamParser  # noqa: E402
+
+PROSE = "Let me look that up for you, this could take a moment while I check the sources. "
+
+
+def strip_tool_calls_for_streaming(content: str) -> str:
+    sanitized = re.sub(r"<tool_call>.*?</tool_call>", "", content, flags=re.DOTALL)
+    sanitized = re.sub(r"<function_calls>.*?</function_calls>", "", sanitized, flags=re.DOTALL)
+    sanitized = re.sub(r"```tool_call\n.*?\n```", "", sanitized, flags=re.DOTALL)
+
+    partial_markers = [
+        index
+        for index in (sanitized.find("<tool"), sanitized.find("<function_calls"), sanitized.find("```tool"))
+        if index != -1
+    ]
+    if partial_markers:
+        sanitized = sanitized[:min(partial_markers)]
+
+    return re.sub(r"<\|im_end\|>$", "", sanitized)
+
+
+def build_streaming_payload(content: str) -> dict[str, Any] | None:
+    """The baseline: the stream payload as the processor built it from the whole text for every chunk."""
+    payload: dict[str, Any] = {}
+    cleaned_output = strip_tool_calls_for_streaming(content)
+    parsed_response = try_parse_tool_calls(content)
+    tool_calls = parsed_response.get('tool_calls')
+
+    if cleaned_output or tool_calls:
+        payload['output'] = cleaned_output
+    if tool_calls:
+        payload['tool_calls'] = json.dumps(tool_calls)
+
+    return payload or None
+
+
+def make_response(tool_call_format: str, calls: int) -> str:
+    parts = []
+    for i in range(calls):
+        parts.append(PROSE * 3)
+        arguments = {"query": f"search term {i}", "limit": i % 7, "tags": ["a", "b", "c"]}
+        if tool_call_format == "qwen":
+            parts.append('<tool_call>' + json.dumps({"name": f"tool_{i}", "arguments": arguments}) + '</tool_call>\n')
+        elif tool_call_format == "olmo":
+            parts.append(f'<function_calls>tool_{i}(query="search term {i}", limit={i % 7})</function_calls>\n')
+        else:
+            parts.append('```tool_call\n' + json.dumps({"name": f"tool_{i}", "arguments": arguments}) + '\n```\n')
+    return "".join(parts)
+
+
+def chunks_of(text: str, size: int) -> list[str]:
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def run_full_rescan(chunks: list[str]) -> tuple[float, dict | None]:
+    start = time.perf_counter()
+    content = ""
+    payload = None
+    for chunk in chunks:
+        content += chunk
+        payload = build_streaming_payload(content)
+    return time.perf_counter() - start, payload
+
+
+def run_incremental(chunks: list[str], payload_every: int) -> tuple[float, dict | None, dict]:
+    start = time.perf_counter()
+    parser = ToolCallStreamParser()
+    payload = None
+    for i, chunk in enumerate(chunks):
+        parser.push(chunk)
+        if i % payload_every == 0 or i == len(chunks) - 1:
+            payload = parser.payload()
+    result = parser.finish("".join(chunks))
+    return time.perf_counter() - start, payload, result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, nargs="+", default=[25, 50, 100])
+    parser.add_argument("--chunk-size", type=int, default=4, help="characters per streamed chunk")
+    parser.add_argument("--payload-every", type=int, default=1, help="build the incremental payload every N chunks")
+    args = parser.parse_args()
+
+    print(f"{'format':<7} {'calls':>6} {'chars':>8} {'chunks':>7} {'full rescan':>12} {'incremental':>12} {'speedup':>8}")
+    for tool_call_format in ("qwen", "olmo", "gemma"):
+        for calls in args.calls:
+            text = make_response(tool_call_format, calls)
+            chunks = chunks_of(text, args.chunk_size)
+            with contextlib.redirect_stdout(io.StringIO()):
+                full_time, full_payload = run_full_rescan(chunks)
+                incremental_time, incremental_payload, result = run_incremental(chunks, max(1, args.payload_every))
+                expected = try_parse_tool_calls(text)
+            assert result == expected, f"{tool_call_format}: final result differs from try_parse_tool_calls"
+            assert incremental_payload == full_payload, f"{tool_call_format}: final streamed payload differs"
+            assert len(result["tool_calls"]) == calls
+            print(
+                f"{tool_call_format:<7} {calls:>6} {len(text):>8} {len(chunks):>7}"
+                f" {full_time:>11.3f}s {incremental_time:>11.3f}s {full_time / incremental_time:>7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+"""Microbenchmark of the per-request overhead between the app and a llama-server
+
+Sends minimal chat completions through ChatOpenAI over:
+- loopback TCP with the client's own default connection pool, as before servers got sockets
+- loopback TCP with the shared connection pool sized from the slots
+- a Unix domain socket with the shared connection pool, as the app does now
+
+The server is a stand-in that answers right away, so the difference between the transports
+is not drowned out by generation; with --model, real llama-servers for a GGUF file generate a
+single token instead. Requests are sent one after another for the latency and --concurrency
+at a time for the throughput.
+
+Usage: python benchmarks/transport.py [--requests 2000] [--concurrency 4] [--model model.gguf] [--json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+LIB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib")
+sys.path.insert(0, LIB_PATH)
+
+# The app modules read these when they are imported
+os.environ.setdefault("APP_ID", "llm2")
+os.environ.setdefault("APP_VERSION", "0.0.0")
+os.environ.setdefault("APP_SECRET", "benchmark")
+os.environ.setdefault("APP_PERSISTENT_STORAGE", tempfile.mkdtemp(prefix="llm2-bench-"))
+
+import httpx  # noqa: E402
+from langchain_openai import ChatOpenAI  # noqa: E402
+
+from server_pool import (  # noqa: E402
+    ServerLogPipe, server_socket_path, stop_process, unix_socket_url, wait_for_server,
+)
+from task_processors import _server_http_clients  # noqa: E402
+
+COMPLETION = {
+    "id": "chatcmpl-benchmark", "object": "chat.completion", "created": 0, "model": "benchmark",
+    "choices": [{"index": 0, "message": {"role": "assistant", "content": "ok"}, "finish_reason": "stop"}],
+    "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+}
+
+
+def serve(address: str) -> None:
+    """Runs the stand-in server on a TCP port or a socket path ending with .sock."""
+    import uvicorn
+    from fastapi import FastAPI
+
+    app = FastAPI()
+
+    @app.get("/health")
+    async def health() -> dict:
+        return {"status": "ok"}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions() -> dict:
+        return COMPLETION
+
+    if address.endswith(".sock"):
+        uvicorn.run(app, uds=address, log_level="warning")
+    else:
+        uvicorn.run(app, host="127.0.0.1", port=int(address), log_level="warning")
+
+
+def find_free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(args: argparse.Namespace, address: str) -> subprocess.Popen:
+    if args.model:
+        config = {
+            "model_path": args.model,
+            "hostname": address if address.endswith(".sock") else "127.0.0.1",
+            "port": 0 if address.endswith(".sock") else int(address),
+            "n_ctx": 512 * args.concurrency,
+            "n_parallel": args.concurrency,
+            "n_gpu_layers": 0,
+        }
+        command = [sys.executable, os.path.join(LIB_PATH, "llama_server.py"), json.dumps(config)]
+    else:
+        command = [sys.executable, os.path.abspath(__file__), "--serve", address]
+    return subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered) + 0.5) - 1))]
+
+
+async def measure(llm: ChatOpenAI, args: argparse.Namespace) -> dict:
+    messages = [("user", "hi")]
+    for _ in range(args.warmup):
+        await llm.ainvoke(messages)
+
+    latencies = []
+    for _ in range(args.requests):
+        started = time.perf_counter()
+        await llm.ainvoke(messages)
+        latencies.append(time.perf_counter() - started)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def request() -> None:
+        async with semaphore:
+            await llm.ainvoke(messages)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(request() for _ in range(args.requests)))
+    elapsed = time.perf_counter() - started
+    return {
+        "latency_mean_ms": 1000 * sum(latencies) / len(latencies),
+        "latency_p50_ms": 1000 * percentile(latencies, 50),
+        "latency_p99_ms": 1000 * percentile(latencies, 99),
+        "requests_per_second": args.requests / elapsed,
+    }
+
+
+async def run(args: argparse.Namespace) -> dict:
+    port = find_free_port()
+    socket_path = server_socket_path("benchmark")
+    servers = [start_server(args, str(port)), start_server(args, socket_path)]
+    try:
+        tcp_url = f"http://127.0.0.1:{port}"
+        await wait_for_server(servers[0], tcp_url, ServerLogPipe("tcp"))
+        await wait_for_server(servers[1], unix_socket_url(socket_path), ServerLogPipe("unix"))
+
+        limits = httpx.Limits(max_connections=2 * args.concurrency, max_keepalive_connections=args.concurrency)
+        _, uds_client = _server_http_clients(socket_path, args.concurrency)
+        clients = {
+            "tcp, default client": ChatOpenAI(base_url=tcp_url + "/v1", api_key="not-needed", max_tokens=1),
+            "tcp, shared pool": ChatOpenAI(
+                base_url=tcp_url + "/v1", api_key="not-needed", max_tokens=1,
+                http_async_client=httpx.AsyncClient(limits=limits),
+            ),
+            "unix socket, shared pool": ChatOpenAI(
+                base_url="http://localhost/v1", api_key="not-needed", max_tokens=1, http_async_client=uds_client,
+            ),
+        }
+        return {name: await measure(llm, args) for name, llm in clients.items()}
+    finally:
+        for server in servers:
+            stop_process(server, 5)
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=4, help="concurrent requests, and slots of the model")
+    parser.add_argument("--model", help="GGUF file to measure against real llama-servers")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--serve", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve)
+        return
+
+    results = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'transport':<26} {'mean':>9} {'p50':>9} {'p99':>9} {'req/s':>9}")
+    for name, stats in results.items():
+        print(
+            f"{name:<26} {stats['latency_mean_ms']:>7.3f}ms {stats['latency_p50_ms']:>7.3f}ms "
+            f"{stats['latency_p99_ms']:>7.3f}ms {stats['requests_per_second']:>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -5,8 +5,11 @@
 import json
 from typing import Any
 
+from langchain_core.messages import HumanMessage, convert_to_messages
 from langchain_core.runnables import Runnable
 
+from chat_history import ChatHistoryWindow
+from slot_routing import SlotRouter, conversation_key, pinned_to_slot
 from streaming import StreamContext, run_runnable_with_streaming
 
 
@@ -17,8 +20,17 @@ class ChatProcessor:
 
     runnable: Runnable
 
-    def __init__(self, runner: Runnable):
+    def __init__(
+            self,
+            runner: Runnable,
+            history_window: ChatHistoryWindow | None = None,
+            slot_router: SlotRouter | None = None,
+    ):
         self.runnable = runner
+        # Fits long histories into the context, None sends the whole history
+        self.history_window = history_window
+        # Keeps each conversation on the slot that has its history cached, None lets the server choose
+        self.slot_router = slot_router
 
     async def __call__(
             self,
@@ -28,17 +40,25 @@ class ChatProcessor:
         system_prompt = inputs['system_prompt']
         if inputs.get('memories'):
             system_prompt += "\n\nYou can remember things from other conversations with the user. If they are relevant, take into account the following memories: \n" + "\n\n".join(inputs['memories']) + "\n\n"
-        messages = [('human', system_prompt)] + [
+        history = convert_to_messages([
             (message['role'], message['content'])
             for message in [json.loads(message) for message in inputs['history']]
-        ] + [('human', inputs['input'])]
+        ])
+        first = HumanMessage(content=system_prompt)
+        new_messages = [HumanMessage(content=inputs['input'])]
+        if self.history_window is not None:
+            messages = await self.history_window.fit(first, history, new_messages)
+        else:
+            messages = [first, *history, *new_messages]
+        key = conversation_key(inputs['system_prompt'], (history[0] if history else new_messages[0]).content)
         reasoning_sink: dict[str, str] = {}
-        output = await run_runnable_with_streaming(
-            self.runnable,
-            messages,
-            context,
-            reasoning_sink=reasoning_sink,
-        )
+        with pinned_to_slot(self.runnable, self.slot_router, key) as runnable:
+            output = await run_runnable_with_streaming(
+                runnable,
+                messages,
+                context,
+                reasoning_sink=reasoning_sink,
+            )
         return {
             'output': output,
             'reasoning': reasoning_sink.get('reasoning', ''),
@@ -0,0 +1,188 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+"""Token-budgeted window over a chat's history
+
+A chat sends its whole history every turn, so long conversations make every turn's prefill
+longer until the prompt overflows the slot's context. The window keeps the first message
+(the system prompt), the latest turns and the new input, and as many further recent turns as
+fit the budget. The turns before them are replaced by a summary appended to the first message.
+
+The summary rolls forward: it is cached under a hash of the conversation prefix it covers, so
+the next turn only folds the turns that newly dropped out of the window into the cached summary
+instead of summarizing the whole prefix again.
+"""
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+from typing import Any
+
+from langchain_core.messages import BaseMessage, HumanMessage
+from langchain_core.runnables import Runnable
+
+from streaming import extract_text_content
+
+logger = logging.getLogger(__name__)
+
+# Tokens of the chat template around each message, e.g. the role markers
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+class ChatHistoryWindow:
+    summary_prompt = """
+Summarize the following part of a conversation between a user and an AI assistant, so that the conversation can be continued without it.
+Keep the facts, names, numbers, decisions, preferences and open questions that may matter later, and leave out pleasantries.
+Write the summary in the language of the conversation. Output only the summary.
+
+{previous_summary}Conversation:
+{transcript}
+"""
+    summary_header = "\n\nSummary of the earlier conversation with the user:\n"
+
+    def __init__(
+            self,
+            runnable: Runnable,
+            tokenizer: Any,
+            budget_tokens: int,
+            summary_tokens: int = 512,
+            min_turns: int = 1,
+            cache_size: int = 256,
+    ) -> None:
+        self.runnable = runnable
+        self.tokenizer = tokenizer
+        # Tokens of the whole prompt: first message, history and new input
+        self.budget_tokens = budget_tokens
+        self.summary_tokens = summary_tokens
+        # Latest turns that are always kept, e.g. the tool call that the new input answers
+        self.min_turns = min_turns
+        self.cache_size = cache_size
+        # hash of a conversation prefix -> summary of it
+        self._summaries: OrderedDict[str, str] = OrderedDict()
+
+    async def fit(
+            self,
+            first: BaseMessage,
+            history: list[BaseMessage],
+            new_messages: list[BaseMessage],
+    ) -> list[BaseMessage]:
+        """The messages to send: `first`, the fitting part of `history` and `new_messages`."""
+        turns = _split_turns(history)
+        fixed_tokens = await self._count_all([first, *new_messages])
+        turn_tokens = [await self._count_all(turn) for turn in turns]
+        if fixed_tokens + sum(turn_tokens) <= self.budget_tokens:
+            return [first, *history, *new_messages]
+
+        # Newest turns first, while they fit next to a summary of the older ones
+        available = self.budget_tokens - fixed_tokens - self.summary_tokens - MESSAGE_OVERHEAD_TOKENS
+        kept = 0
+        for tokens in reversed(turn_tokens):
+            if kept >= self.min_turns and tokens > available:
+                break
+            available -= tokens
+            kept += 1
+        if available < 0:
+            logger.warning(
+                f"The latest {kept} turns of the chat exceed its budget of {self.budget_tokens} tokens, "
+                f"sending them anyway"
+            )
+        dropped = turns[:len(turns) - kept]
+        if not dropped:
+            return [first, *history, *new_messages]
+
+        summary = await self._summary(dropped)
+        first = first.model_copy(update={"content": extract_text_content(first) + self.summary_header + summary})
+        return [first, *(message for turn in turns[len(dropped):] for message in turn), *new_messages]
+
+    async def _summary(self, turns: list[list[BaseMessage]]) -> str:
+        hashes = _prefix_hashes(turns)
+        # Resume from the summary of the longest prefix that was summarized before
+        start, summary = 0, ""
+        for index in range(len(turns) - 1, -1, -1):
+            cached = self._summaries.get(hashes[index])
+            if cached is not None:
+                self._summaries.move_to_end(hashes[index])
+                start, summary = index + 1, cached
+                break
+
+        # Fold the remaining turns into the summary in batches that fit a request
+        batch_budget = self.budget_tokens - 2 * self.summary_tokens
+        while start < len(turns):
+            end, batch_tokens = start, 0
+            while end < len(turns):
+                tokens = await self._count_all(turns[end])
+                if end > start and batch_tokens + tokens > batch_budget:
+                    break
+                batch_tokens += tokens
+                end += 1
+            # A single turn can be larger than a request, it is shortened then
+            shorten = min(1.0, batch_budget / batch_tokens) if batch_tokens > 0 else 1.0
+            summary = await self._summarize(summary, turns[start:end], shorten)
+            self._remember(hashes[end - 1], summary)
+            start = end
+        return summary
+
+    async def _summarize(self, previous_summary: str, turns: list[list[BaseMessage]], shorten: float = 1.0) -> str:
+        transcript = "\n\n".join(
+            f"{_speaker(message)}: {_shortened(_message_text(message), shorten)}" for turn in turns for message in turn
+        )
+        prompt = self.summary_prompt.format(
+            previous_summary=f"Summary of the conversation before this part:\n{previous_summary}\n\n"
+            if previous_summary else "",
+            transcript=transcript,
+        )
+        output = await self.runnable.bind(max_tokens=self.summary_tokens).ainvoke([HumanMessage(content=prompt)])
+        return extract_text_content(output).strip()
+
+    def _remember(self, key: str, summary: str) -> None:
+        self._summaries[key] = summary
+        self._summaries.move_to_end(key)
+        while len(self._summaries) > self.cache_size:
+            self._summaries.popitem(last=False)
+
+    async def _count_all(self, messages: list[BaseMessage]) -> int:
+        # The tokenizer caches its counts, so the history of earlier turns is not tokenized again
+        total = 0
+        for message in messages:
+            total += await self.tokenizer.count(_message_text(message)) + MESSAGE_OVERHEAD_TOKENS
+        return total
+
+
+def _split_turns(history: list[BaseMessage]) -> list[list[BaseMessage]]:
+    """Groups the history into turns that each start with a user message, so tool calls and
+    their results stay together."""
+    turns: list[list[BaseMessage]] = []
+    for message in history:
+        if not turns or isinstance(message, HumanMessage):
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def _prefix_hashes(turns: list[list[BaseMessage]]) -> list[str]:
+    """Hash of the conversation up to and including each turn."""
+    hashes = []
+    digest = hashlib.sha256()
+    for turn in turns:
+        for message in turn:
+            serialized = json.dumps([message.type, _message_text(message)], ensure_ascii=False)
+            digest.update(serialized.encode("utf-8", "surrogatepass"))
+        hashes.append(digest.copy().hexdigest())
+    return hashes
+
+
+def _message_text(message: BaseMessage) -> str:
+    text = extract_text_content(message)
+    tool_calls = getattr(message, "tool_calls", None)
+    if tool_calls:
+        text += json.dumps([{"name": call["name"], "args": call["args"]} for call in tool_calls], ensure_ascii=False)
+    return text
+
+
+def _shortened(text: str, ratio: float) -> str:
+    if ratio >= 1.0:
+        return text
+    return text[:int(len(text) * ratio)] + " […]"
+
+
+def _speaker(message: BaseMessage) -> str:
+    return {"human": "User", "ai": "Assistant", "tool": "Tool result"}.get(message.type, message.type)
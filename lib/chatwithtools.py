@@ -2,18 +2,25 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 """A chat chain
 """
-import ast
 import json
-import hashlib
-import pprint
-import re
+import logging
 from typing import Any
 
 from langchain_core.language_models import BaseChatModel
-from langchain_core.messages import SystemMessage, HumanMessage
+from langchain_core.messages import BaseMessage, SystemMessage, HumanMessage, ToolMessage
 from langchain_core.messages.ai import AIMessage
+from openai import APIStatusError
 
-from streaming import StreamContext, run_runnable_with_streaming
+from chat_history import ChatHistoryWindow
+from prefix_cache import PREFIX_SENTINEL
+from slot_routing import SlotRouter, conversation_key, pinned_to_slot
+from streaming import StreamContext, extract_text_content, run_runnable_with_streaming
+from tool_call_parser import (
+    TOOL_CALL_FORMATS, NativeToolCallAccumulator, ToolCallStreamParser, generate_tool_call_id, parse_tool_call_match,
+    select_tool_calls, tool_call_response,
+)
+
+logger = logging.getLogger(__name__)
 
 def generate_tool_call(tool_call: dict):
     content = '<tool_call>'
@@ -22,152 +29,50 @@ def generate_tool_call(tool_call: dict):
     return content
 
 
-def generate_tool_call_id(tool_call: dict) -> str:
-    stable_payload = json.dumps(
-        {
-            "name": tool_call.get("name"),
-            "args": tool_call.get("args", tool_call.get("arguments", {})),
-        },
-        sort_keys=True,
-    )
-    return hashlib.sha1(stable_payload.encode("utf-8")).hexdigest()[:16]
-
-def _parse_python_function_call(call_str: str) -> dict | None:
-    """Parse a Python-style call like `name(a="x", b=1)` into {name, arguments}."""
-    try:
-        tree = ast.parse(call_str.strip(), mode='eval')
-    except SyntaxError:
-        return None
-    if not isinstance(tree.body, ast.Call):
-        return None
-    func = tree.body.func
-    if isinstance(func, ast.Name):
-        name = func.id
-    elif isinstance(func, ast.Attribute):
-        name = func.attr
-    else:
-        return None
-    args: dict[str, Any] = {}
-    for kw in tree.body.keywords:
-        if kw.arg is None:
-            continue
-        try:
-            args[kw.arg] = ast.literal_eval(kw.value)
-        except (ValueError, SyntaxError):
-            return None
-    return {'name': name, 'arguments': args}
+def _lacks_native_tool_support(error: APIStatusError) -> bool:
+    """Whether the server rejected the request because it can't pass tools to the model's chat template."""
+    if not 400 <= error.status_code < 500 or error.status_code in (408, 429):
+        return False
+    message = str(error).lower()
+    return any(word in message for word in ("tool", "template", "jinja"))
 
 
 def try_parse_tool_calls(content: str):
     """Try parse the tool calls."""
-    tool_calls = []
-    offset = 0
-    found = False
-    # Qwen-style tool call, works with Llama 3.1
-    # <tool_call>{"name": "function_name", "arguments": {"param1": "value1", "param2": "value2"}}</tool_call>
-    for i, m in enumerate(re.finditer(r"<tool_call>\s*(.+?)\s*</?tool_call>", content, re.DOTALL)):
-        if i == 0:
-            offset = m.start()
-        try:
-            try:
-                func = json.loads(m.group(1))
-            except json.JSONDecodeError as e:
-                func = json.loads(m.group(1)[0:-1])
-            tool_calls.append(func)
-            if isinstance(func.get("arguments", None), str):
-                func["arguments"] = json.loads(func["arguments"])
-            if 'arguments' in func:
-                func['args'] = func['arguments']
-                del func['arguments']
-            if not 'id' in func:
-                func['id'] = generate_tool_call_id(func)
-            if 'type' not in func:
-                func['type'] = 'tool_call'
-            found = True
-        except json.JSONDecodeError as e:
-            print(f"Failed to parse tool calls: the content is {m.group(1)} and {e}")
-            pass
-
-    if not found:
-        # Olmo-style tool call
-        # <function_calls>function_name(param1="value1", param2="value2")</function_calls>
-        for i, m in enumerate(re.finditer(r"<function_calls>\s*(.+?)\s*</?function_calls>", content, re.DOTALL)):
-            if i == 0:
-                offset = m.start()
-            func = _parse_python_function_call(m.group(1))
-            if func is None:
-                print(f"Failed to parse tool call: the content is {m.group(1)}")
-                continue
-            func['args'] = func.pop('arguments', {})
-            func.setdefault('id', generate_tool_call_id(func))
-            func.setdefault('type', 'tool_call')
-            tool_calls.append(func)
-            found = True
-
-    if not found:
-        # Gemma-style tool call
-        # ```tool_call
-        # {"name": "function_name", "arguments": {"param1": "value1", "param2": "value2"}}
-        # ```
-        for i, m in enumerate(re.finditer(r"```tool_call\s*\n(.+?)\n\s*```", content, re.DOTALL)):
-            if i == 0:
-                offset = m.start()
-            try:
-                try:
-                    func = json.loads(m.group(1))
-                except json.JSONDecodeError as e:
-                    func = json.loads(m.group(1)[0:-1])
-                tool_calls.append(func)
-                if isinstance(func["arguments"], str):
-                    func["arguments"] = json.loads(func["arguments"])
-                if 'arguments' in func:
-                    func['args'] = func['arguments']
-                    del func['arguments']
-                if not 'id' in func:
-                    func['id'] = generate_tool_call_id(func)
-                if 'type' not in func:
-                    func['type'] = 'tool_call'
-            except json.JSONDecodeError as e:
-                print(f"Failed to parse tool calls: the content is {m.group(1)} and {e}")
-                pass
-
-    if tool_calls:
-        if offset > 0 and content[:offset].strip():
-            c = content[:offset]
-        else:
-            c = ""
-        return {"role": "assistant", "content": c, "tool_calls": tool_calls}
-    return {"role": "assistant", "content": re.sub(r"<\|im_end\|>$", "", content)}
-
-
-def strip_tool_calls_for_streaming(content: str) -> str:
-    sanitized = re.sub(r"<tool_call>.*?</tool_call>", "", content, flags=re.DOTALL)
-    sanitized = re.sub(r"<function_calls>.*?</function_calls>", "", sanitized, flags=re.DOTALL)
-    sanitized = re.sub(r"```tool_call\n.*?\n```", "", sanitized, flags=re.DOTALL)
-
-    partial_markers = [
-        index
-        for index in (sanitized.find("<tool"), sanitized.find("<function_calls"), sanitized.find("```tool"))
-        if index != -1
+    parsed = [
+        [parse_tool_call_match(tool_call_format, m) for m in tool_call_format.pattern.finditer(content)]
+        for tool_call_format in TOOL_CALL_FORMATS
     ]
-    if partial_markers:
-        sanitized = sanitized[:min(partial_markers)]
-
-    return re.sub(r"<\|im_end\|>$", "", sanitized)
-
-
-def build_streaming_payload(content: str) -> dict[str, Any] | None:
-    payload: dict[str, Any] = {}
-    cleaned_output = strip_tool_calls_for_streaming(content)
-    parsed_response = try_parse_tool_calls(content)
-    tool_calls = parsed_response.get('tool_calls')
+    tool_calls, offset = select_tool_calls(parsed)
+    return tool_call_response(content, tool_calls, offset)
+
+
+def to_openai_tools(tools: Any) -> list[dict]:
+    """Brings tool specs into the OpenAI format: {"type": "function", "function": {name, description, parameters}}."""
+    if isinstance(tools, dict):
+        tools = [tools]
+    if not isinstance(tools, list):
+        raise ValueError("the tools are not a list")
+    openai_tools = []
+    for tool in tools:
+        if not isinstance(tool, dict):
+            raise ValueError(f"invalid tool specification {tool!r}")
+        if tool.get("type") == "function" and isinstance(tool.get("function"), dict):
+            openai_tools.append(tool)
+        elif "name" in tool:
+            openai_tools.append({"type": "function", "function": tool})
+        else:
+            raise ValueError(f"invalid tool specification {tool!r}")
+    return openai_tools
 
-    if cleaned_output or tool_calls:
-        payload['output'] = cleaned_output
-    if tool_calls:
-        payload['tool_calls'] = json.dumps(tool_calls)
 
-    return payload or None
+def _history_tool_call(tool_call: dict) -> dict:
+    args = tool_call.get("args", tool_call.get("arguments", {}))
+    if isinstance(args, str):
+        args = json.loads(args) if args.strip() else {}
+    call = {"name": tool_call["name"], "args": args}
+    call["id"] = tool_call.get("id") or generate_tool_call_id(call)
+    return call
 
 class ChatWithToolsProcessor:
     """
@@ -176,13 +81,9 @@ class ChatWithToolsProcessor:
 
     model: BaseChatModel
 
-    def __init__(self, runner: BaseChatModel):
-        self.model = runner
-
-    async def _process_single_input(self, input_data: dict[str, Any], context: StreamContext | None = None) -> dict[str, Any]:
-        system_prompt = """
-{downstream_system_prompt}
-
+    # Kept in front of the downstream system prompt and the tool list, so it is a fixed
+    # prompt prefix that the prefix KV cache can restore instead of prefilling it every turn.
+    tool_instructions = """
 You have tools at your disposal that you can call on behalf of the user.
 You can call a tool by responding with a tool call.
 A tool call starts with an opening `tool_call` xml tag, then a JSON object with the name of the function and the arguments, and finally it ends with a closing `tool_call` xml tag.
@@ -193,15 +94,128 @@ Here is a second example:
 {tool_call_example2}
 
 When calling tools, do not output anything else, except the tool call. Do not add sample output of the tool call. Do not output the result of the tool call yourself.
+""".format(
+        tool_call_example='<tool_call>{"name": "the_function_to_call", "arguments": {"param1": "the first argument", "param2": "second argument"}}</tool_call>',
+        tool_call_example2='<tool_call>{"name": "search_the_web", "arguments": {"search_query": "Frank Sinatra"}}</tool_call>'
+    )
+
+    def __init__(
+            self,
+            runner: BaseChatModel,
+            native_tools: bool = False,
+            history_window: ChatHistoryWindow | None = None,
+            slot_router: SlotRouter | None = None,
+    ):
+        self.model = runner
+        # Use the server's tool calling API (the chat template renders the tools, and a grammar
+        # constrains the calls while they are generated) instead of the text protocol
+        self.native_tools = native_tools
+        # Fits long histories into the context, None sends the whole history
+        self.history_window = history_window
+        # Keeps each conversation on the slot that has its history cached, None lets the server choose
+        self.slot_router = slot_router
+
+    @staticmethod
+    def _conversation_key(input_data: dict[str, Any], messages: list[BaseMessage]) -> str:
+        """`messages` are the system prompt followed by the conversation, before fitting the history."""
+        return conversation_key(input_data['system_prompt'] + input_data['tools'], extract_text_content(messages[1]))
+
+    async def _fit_history(self, messages: list[BaseMessage], history_length: int) -> list[BaseMessage]:
+        """`messages` are the system prompt, `history_length` history messages and the new ones."""
+        if self.history_window is None:
+            return messages
+        return await self.history_window.fit(
+            messages[0], messages[1:1 + history_length], messages[1 + history_length:],
+        )
+
+    def _build_system_prompt(self, downstream_system_prompt: str, tools: str) -> str:
+        return """{tool_instructions}
+{downstream_system_prompt}
+
 The following is a JSON specification of the tools you can call and their parameters.
 {tools}
 """.format(
-            tools=input_data['tools'],
-            downstream_system_prompt=input_data['system_prompt'],
-            tool_call_example='<tool_call>{"name": "the_function_to_call", "arguments": {"param1": "the first argument", "param2": "second argument"}}</tool_call>',
-            tool_call_example2='<tool_call>{"name": "search_the_web", "arguments": {"search_query": "Frank Sinatra"}}</tool_call>'
+            tool_instructions=self.tool_instructions,
+            downstream_system_prompt=downstream_system_prompt,
+            tools=tools,
         )
 
+    def cache_prefix_messages(self) -> list[BaseMessage] | None:
+        if self.native_tools:
+            # The chat template places the tools, so there is no fixed prefix to cache
+            return None
+        return [SystemMessage(content=self._build_system_prompt(PREFIX_SENTINEL, ""))]
+
+    async def _process_native(self, input_data: dict[str, Any], context: StreamContext | None = None) -> dict[str, Any]:
+        tools = to_openai_tools(json.loads(input_data['tools'])) if input_data['tools'] else []
+
+        messages: list[BaseMessage] = [SystemMessage(content=input_data['system_prompt'])]
+
+        last_tool_calls: list[dict] = []
+        for raw_message in input_data['history']:
+            message = json.loads(raw_message)
+            if message['role'] == 'assistant':
+                last_tool_calls = [_history_tool_call(call) for call in message.get('tool_calls') or []]
+                messages.append(AIMessage(content=message['content'], tool_calls=last_tool_calls))
+            elif message['role'] == 'human':
+                messages.append(HumanMessage(content=message['content']))
+        history_length = len(messages) - 1
+
+        if input_data['input'] != '':
+            messages.append(HumanMessage(content=input_data['input']))
+        elif 'tool_message' in input_data and input_data['tool_message'] != '':
+            ids_by_name = {call['name']: call['id'] for call in last_tool_calls}
+            for tool_message in json.loads(input_data['tool_message']):
+                tool_call_id = (
+                    tool_message.get('tool_call_id')
+                    or ids_by_name.get(tool_message['name'])
+                    or generate_tool_call_id({"name": tool_message['name'], "args": {}})
+                )
+                messages.append(ToolMessage(
+                    content=tool_message['content'], tool_call_id=tool_call_id, name=tool_message['name'],
+                ))
+        else:
+            messages.append(HumanMessage(content=''))
+
+        key = self._conversation_key(input_data, messages)
+        messages = await self._fit_history(messages, history_length)
+        if not messages[0].content:
+            messages = messages[1:]
+        logger.debug(f"Native tool calling messages: {messages}")
+        reasoning_sink: dict[str, str] = {}
+        native_tool_calls = NativeToolCallAccumulator()
+        with pinned_to_slot(self.model, self.slot_router, key) as model:
+            response_content = await run_runnable_with_streaming(
+                model.bind(tools=tools) if tools else model,
+                messages,
+                context,
+                suppress_empty_stream_updates=True,
+                reasoning_sink=reasoning_sink,
+                chunk_sink=native_tool_calls.add,
+            )
+        tool_calls = native_tool_calls.tool_calls()
+
+        return {
+            'output': response_content,
+            'tool_calls': json.dumps(tool_calls),
+            'reasoning': reasoning_sink.get('reasoning', ''),
+        }
+
+    async def _process_single_input(self, input_data: dict[str, Any], context: StreamContext | None = None) -> dict[str, Any]:
+        if self.native_tools:
+            try:
+                return await self._process_native(input_data, context)
+            except APIStatusError as e:
+                # Server errors, rate limits or a full context say nothing about the model's tool support
+                if not _lacks_native_tool_support(e):
+                    raise
+                logger.warning(f"Native tool calling is not supported, using the text protocol from now on: {e}")
+                self.native_tools = False
+            except (ValueError, KeyError) as e:
+                logger.warning(f"Tools or history not usable for native tool calling, using the text protocol: {e}")
+
+        system_prompt = self._build_system_prompt(input_data['system_prompt'], input_data['tools'])
+
         messages = []
         messages.append(SystemMessage(content=system_prompt))
 
@@ -214,6 +228,7 @@ The following is a JSON specification of the tools you can call and their parame
                     messages.append(AIMessage(content=message['content']))
             elif message['role'] == 'human':
                 messages.append(HumanMessage(content=message['content']))
+        history_length = len(messages) - 1
 
         if input_data['input'] != '':
             messages.append(HumanMessage(content=input_data['input']))
@@ -234,23 +249,26 @@ The following is a JSON specification of the tools you can call and their parame
                         content=message_content
                     ))
             except json.JSONDecodeError as e:
-                print('Failed to parse tool message')
-                print(e)
+                logger.warning(f"Failed to parse tool message: {e}")
         else:
             messages.append(HumanMessage(content=''))
 
-        pprint.pprint(messages)
+        key = self._conversation_key(input_data, messages)
+        messages = await self._fit_history(messages, history_length)
+        logger.debug(f"Text tool calling messages: {messages}")
         reasoning_sink: dict[str, str] = {}
-        response_content = await run_runnable_with_streaming(
-            self.model,
-            messages,
-            context,
-            stream_payload_transform=build_streaming_payload,
-            suppress_empty_stream_updates=True,
-            reasoning_sink=reasoning_sink,
-        )
-
-        response = AIMessage(**try_parse_tool_calls(response_content))
+        tool_call_parser = ToolCallStreamParser()
+        with pinned_to_slot(self.model, self.slot_router, key) as model:
+            response_content = await run_runnable_with_streaming(
+                model,
+                messages,
+                context,
+                stream_payload_transform=tool_call_parser,
+                suppress_empty_stream_updates=True,
+                reasoning_sink=reasoning_sink,
+            )
+
+        response = AIMessage(**tool_call_parser.finish(response_content))
 
         return {
             'output': response.content,
@@ -0,0 +1,131 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+"""Registry of the tasks being generated, to stop generating for tasks that are gone
+
+Nextcloud doesn't tell the app when a task is cancelled, deleted or given up after a timeout,
+so without checking, a generation runs to its token budget and holds a slot for nothing. Every
+progress update returns the task's status, so the registry resends the last progress of each
+task as a heartbeat once its status is older than TASK_HEARTBEAT_INTERVAL. The task's own
+progress updates count as heartbeats, and a failed stream update triggers a heartbeat right away.
+
+A generation is cancelled once its task no longer runs, or once Nextcloud rejected the
+heartbeats of the task several times in a row. Cancelling closes the model request's HTTP
+connection, which makes llama-server stop generating and free the slot.
+"""
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Coroutine, TypeVar
+
+from metrics import TASK_CANCELLATIONS, count_cancelled_requests
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+RUNNING_STATUS = "STATUS_RUNNING"
+# Heartbeats in a row that Nextcloud rejects, e.g. because the task was deleted, before giving up the task
+MAX_HEARTBEAT_FAILURES = 3
+
+try:
+    TASK_HEARTBEAT_INTERVAL = float(os.getenv("TASK_HEARTBEAT_INTERVAL", "15"))
+    if TASK_HEARTBEAT_INTERVAL < 0:
+        raise ValueError
+except (TypeError, ValueError):
+    logger.warning("Invalid TASK_HEARTBEAT_INTERVAL env variable, falling back to default 15 seconds")
+    TASK_HEARTBEAT_INTERVAL = 15.0
+
+# Returns the status of the task, "" when Nextcloud rejected the request, None when it was not reached
+Heartbeat = Callable[[], Awaitable[str | None]]
+
+
+class TaskGone(Exception):
+    """The task's generation was cancelled because the task no longer runs in Nextcloud."""
+
+    def __init__(self, task_id: int, reason: str) -> None:
+        super().__init__(f"Task {task_id} is gone ({reason}), its generation was cancelled")
+        self.task_id = task_id
+        self.reason = reason
+
+
+@dataclass
+class _InflightTask:
+    task_id: int
+    heartbeat: Heartbeat
+    generation: asyncio.Task
+    # When the task was last seen running or last checked
+    last_checked_at: float = field(default_factory=time.monotonic)
+    failures: int = 0
+    # Why the generation was cancelled, None while it runs
+    reason: str | None = None
+    check_now: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+class InflightTasks:
+    def __init__(self, interval: float = TASK_HEARTBEAT_INTERVAL) -> None:
+        # 0 disables the checks
+        self.interval = interval
+        self._tasks: dict[int, _InflightTask] = {}
+
+    async def run(self, task_id: int, heartbeat: Heartbeat, generation: Coroutine[None, None, T]) -> T:
+        """Runs the generation of a task until it finishes or the task is gone, see `TaskGone`."""
+        if not self.interval:
+            return await generation
+        entry = _InflightTask(task_id, heartbeat, asyncio.ensure_future(generation))
+        self._tasks[task_id] = entry
+        watcher = asyncio.ensure_future(self._watch(entry))
+        try:
+            # Cancelling the caller cancels the generation as well
+            return await entry.generation
+        except asyncio.CancelledError:
+            current = asyncio.current_task()
+            if entry.reason is not None and not (current is not None and current.cancelling()):
+                count_cancelled_requests()
+                raise TaskGone(task_id, entry.reason) from None
+            raise
+        finally:
+            watcher.cancel()
+            self._tasks.pop(task_id, None)
+
+    def report_status(self, task_id: int, status: str | None) -> None:
+        """Takes the task status from a progress update, see `Heartbeat` for the values."""
+        entry = self._tasks.get(task_id)
+        if entry is None or entry.reason is not None or status is None:
+            return
+        if status == RUNNING_STATUS:
+            entry.last_checked_at = time.monotonic()
+            entry.failures = 0
+        elif status:
+            self._cancel(entry, status.removeprefix("STATUS_").lower())
+        else:
+            entry.failures += 1
+            if entry.failures >= MAX_HEARTBEAT_FAILURES:
+                self._cancel(entry, "rejected")
+
+    def check_soon(self, task_id: int) -> None:
+        """Sends a heartbeat for the task right away, e.g. after a stream update failed."""
+        entry = self._tasks.get(task_id)
+        if entry is not None:
+            entry.check_now.set()
+
+    async def _watch(self, entry: _InflightTask) -> None:
+        while entry.reason is None:
+            due = entry.last_checked_at + self.interval - time.monotonic()
+            if due > 0 and not entry.check_now.is_set():
+                try:
+                    await asyncio.wait_for(entry.check_now.wait(), timeout=due)
+                except asyncio.TimeoutError:
+                    continue
+            entry.check_now.clear()
+            # None (Nextcloud is unreachable) says nothing about the task, it is checked again later
+            status = await entry.heartbeat()
+            entry.last_checked_at = time.monotonic()
+            self.report_status(entry.task_id, status)
+
+    def _cancel(self, entry: _InflightTask, reason: str) -> None:
+        logger.info(f"Task {entry.task_id} is no longer running in Nextcloud ({reason}), cancelling its generation")
+        entry.reason = reason
+        entry.generation.cancel()
+        TASK_CANCELLATIONS.inc(reason=reason)
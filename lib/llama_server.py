@@ -4,8 +4,9 @@
 
 Spawned by task_processors.generate_chat_model with a JSON config blob as argv[1].
 Any key in SERVER_KEYS that is present in the config is applied to xllamacpp's
-CommonParams; client-side keys (temperature, max_tokens, stop) are ignored here
-and consumed by the LangChain client instead.
+CommonParams, and the DRAFT_KEYS configure speculative decoding with a draft model;
+client-side keys (temperature, max_tokens, stop) are ignored here and consumed by the
+LangChain client instead.
 """
 import json
 import sys
@@ -23,7 +24,7 @@ SERVER_KEYS = (
     # Memory
     "use_mmap", "use_mlock",
     "cache_type_k", "cache_type_v",
-    "cache_prompt", "cache_idle_slots", "cache_ram_mib",
+    "cache_prompt", "cache_idle_slots", "cache_ram_mib", "slot_save_path",
     # RoPE / YaRN
     "rope_freq_base", "rope_freq_scale", "rope_scaling_type",
     "yarn_attn_factor", "yarn_beta_fast", "yarn_beta_slow",
@@ -39,6 +40,34 @@ SERVER_KEYS = (
     "model_alias", "verbosity",
 )
 
+# Draft model for speculative decoding, named like llama-server's command line options
+DRAFT_KEYS = {
+    "draft_model": ("mparams", "path"),
+    "draft_max": ("n_max",),
+    "draft_min": ("n_min",),
+    "draft_p_min": ("p_min",),
+    "draft_n_ctx": ("n_ctx",),
+    "draft_n_gpu_layers": ("n_gpu_layers",),
+}
+
+
+def apply_draft_config(p: "xlc.CommonParams", cfg: dict) -> None:
+    if not cfg.get("draft_model"):
+        return
+    draft = p.speculative.draft
+    for k, attrs in DRAFT_KEYS.items():
+        if k not in cfg:
+            continue
+        target = draft
+        for attr in attrs[:-1]:
+            target = getattr(target, attr)
+        try:
+            setattr(target, attrs[-1], cfg[k])
+        except AttributeError:
+            # e.g. newer llama.cpp sizes the draft context like the target's
+            print(f"{k} is not supported by this llama.cpp build, ignoring it", flush=True)
+    p.speculative.types = [xlc.common_speculative_type.COMMON_SPECULATIVE_TYPE_DRAFT_SIMPLE]
+
 
 def main() -> None:
     cfg = json.loads(sys.argv[1])
@@ -47,6 +76,7 @@ def main() -> None:
     for k in SERVER_KEYS:
         if k in cfg:
             setattr(p, k, cfg[k])
+    apply_draft_config(p, cfg)
 
     server = xlc.Server(p)  # noqa: F841 — held to keep the C++ server thread alive
     while True:
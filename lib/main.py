@@ -11,11 +11,27 @@ import traceback
 from contextlib import asynccontextmanager
 from json import JSONDecodeError
 from threading import Event
+from typing import Callable
 
 from niquests import RequestException
+from inflight_tasks import InflightTasks, TaskGone
+from metrics import (
+    MISSED_TRIGGERS, MODEL_INFLIGHT_TASKS, MODEL_SLOTS, NEXT_TASK_CALLS, NEXT_TASK_EMPTY, NEXT_TASK_ERRORS,
+    POLLING_INTERVAL, POLLING_WAKEUPS, QUEUE_WAIT, REGISTRY, REMOTE_ENDPOINT_OUTSTANDING, REMOTE_ENDPOINT_UP,
+    RESULT_CACHE_LOOKUPS, RUNNING_TASKS, SERVER_RSS,
+    STREAM_UPDATES, TASK_DURATION, TASK_SETUP, TASKS, TRIGGERS, TRIGGERS_LIVE, process_rss_bytes, track_task,
+)
+from polling import PollingPolicy
+from result_cache import ResultCache, result_cache_key
+from scheduler import PriorityScheduler, load_cold_model_delay, load_priority_classes
 from streaming import StreamContext
-from task_processors import generate_task_processors, get_n_parallel, stop_all_servers
+from task_slots import TaskSlots, use_task_slots
+from task_processors import (
+    SERVER_POOL, deterministic_sampling, generate_task_processors, get_n_parallel, is_remote_model, model_can_serve,
+    model_is_warm, remote_backends, result_cache_scope, start_model, stop_all_servers,
+)
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 from nc_py_api import AsyncNextcloudApp, NextcloudApp, NextcloudException
 from nc_py_api.ex_app import LogLvl, persistent_storage, run_app, set_handlers
 from nc_py_api.ex_app.providers.task_processing import ShapeDescriptor, ShapeType, TaskProcessingProvider, \
@@ -31,6 +47,8 @@ class NextcloudTaskStreamResult:
         self.nc = nc
         self.task_id = task_id
         self.enabled = enabled
+        # Last reported progress, sent again by the heartbeats of INFLIGHT_TASKS
+        self.progress = 0.0
 
     async def send(self, output: dict) -> None:
         if not self.enabled:
@@ -44,14 +62,26 @@ class NextcloudTaskStreamResult:
         except (NextcloudException, RequestException, JSONDecodeError) as e:
             logger.warning(f"Streaming intermediate task output failed for task {self.task_id}: {e}")
             self.enabled = False
+            # e.g. the task was cancelled
+            INFLIGHT_TASKS.check_soon(self.task_id)
 
     async def set_progress(self, progress: float) -> bool:
+        self.progress = progress
+        status = await self.heartbeat()
+        INFLIGHT_TASKS.report_status(self.task_id, status)
+        return bool(status)
+
+    async def heartbeat(self) -> str | None:
+        """Reports the last progress again and returns the task's status, see inflight_tasks.Heartbeat."""
         try:
-            await self.nc.providers.task_processing.set_progress(self.task_id, progress)
+            response = await self.nc.providers.task_processing.set_progress(self.task_id, self.progress)
         except (NextcloudException, RequestException, JSONDecodeError) as e:
             logger.warning(f"Updating progress failed for task {self.task_id}: {e}")
-            return False
-        return True
+            return None
+        if not response:
+            # nc_py_api returns nothing when Nextcloud answered with an error, e.g. for a deleted task
+            return ""
+        return (response.get("task") or {}).get("status")
 
 
 async def log(nc: AsyncNextcloudApp, level, content):
@@ -87,9 +117,20 @@ NUM_RUNNING_TASKS_LOCK = asyncio.Lock()
 MODEL_INFLIGHT: dict[str, int] = {}
 MODEL_INFLIGHT_LOCK = asyncio.Lock()
 MODEL_SLOT_FREED = asyncio.Event()
+# Notified under MODEL_INFLIGHT_LOCK whenever MODEL_INFLIGHT goes down, for running tasks that wait for a slot
+MODEL_SLOT_RELEASED = asyncio.Condition(MODEL_INFLIGHT_LOCK)
+
+# Orders and filters the offered providers by task-type priority class; its per-class
+# counters are guarded by MODEL_INFLIGHT_LOCK as well.
+SCHEDULER = PriorityScheduler(load_priority_classes(), cold_model_delay=load_cold_model_delay())
 
 SHUTDOWN_EVENT = asyncio.Event()
 
+RESULT_CACHE = ResultCache(os.path.join(persistent_storage(), "result_cache"))
+
+# Cancels the generations of tasks that were cancelled in Nextcloud in the meantime
+INFLIGHT_TASKS = InflightTasks()
+
 try:
     CHECK_INTERVAL = float(os.getenv('TASK_POLLING_INTERVAL', '5'))
     if CHECK_INTERVAL <= 0:
@@ -99,33 +140,184 @@ except (TypeError, ValueError):
     logger.warning("Invalid TASK_POLLING_INTERVAL env variable, falling back to default 5 seconds")
     CHECK_INTERVAL = 5
 
+try:
+    MIN_CHECK_INTERVAL = float(os.getenv('TASK_POLLING_MIN_INTERVAL', '0.5'))
+    if MIN_CHECK_INTERVAL <= 0:
+        logger.warning("Invalid TASK_POLLING_MIN_INTERVAL env variable, falling back to default 0.5 seconds")
+        MIN_CHECK_INTERVAL = 0.5
+except (TypeError, ValueError):
+    logger.warning("Invalid TASK_POLLING_MIN_INTERVAL env variable, falling back to default 0.5 seconds")
+    MIN_CHECK_INTERVAL = 0.5
+
+# Models whose servers are started in the background when the app is enabled:
+# empty (default) for none, "all", or a comma-separated list of model names
+PRELOAD_MODELS = os.getenv('PRELOAD_MODELS', '').strip()
+
 CHECK_INTERVAL_WITH_TRIGGER = 5 * 60
 CHECK_INTERVAL_ON_ERROR = 10
-SCAN_INTERVAL = 5 * 60
 
+# Polls quickly after activity and backs off up to CHECK_INTERVAL while the queue is empty,
+# or up to CHECK_INTERVAL_WITH_TRIGGER while Nextcloud announces new tasks with triggers
+POLLING = PollingPolicy(
+    min_interval=min(MIN_CHECK_INTERVAL, CHECK_INTERVAL),
+    max_interval=CHECK_INTERVAL,
+    trigger_interval=CHECK_INTERVAL_WITH_TRIGGER,
+)
+SCAN_INTERVAL = 5 * 60
 
-async def wait_for_tasks(interval: float | None = None) -> None:
-    global CHECK_INTERVAL
-    actual_interval = CHECK_INTERVAL if interval is None else interval
-    try:
-        await asyncio.wait_for(trigger.wait(), timeout=actual_interval)
-        CHECK_INTERVAL = CHECK_INTERVAL_WITH_TRIGGER
-    except asyncio.TimeoutError:
-        pass
+# How tasks are claimed in one polling round:
+#   single     - at most one next_task call per round (legacy behaviour)
+#   sequential - back-to-back next_task calls until every free slot is filled or the queue is empty
+#   parallel   - one concurrent next_task call per free slot, grouped by model
+TASK_CLAIM_MODES = ('single', 'sequential', 'parallel')
+TASK_CLAIM_MODE = os.getenv('TASK_CLAIM_MODE', 'sequential').strip().lower()
+if TASK_CLAIM_MODE not in TASK_CLAIM_MODES:
+    logger.warning("Invalid TASK_CLAIM_MODE env variable, falling back to default 'sequential'")
+    TASK_CLAIM_MODE = 'sequential'
+
+
+async def wait_for_tasks(interval: float, *, wake_on_slot_freed: bool = False) -> None:
+    """Waits for a trigger, the interval, or optionally for a task to give back its model slot."""
+    POLLING_INTERVAL.set(interval)
+    waiters = {asyncio.ensure_future(trigger.wait()): "trigger"}
+    if wake_on_slot_freed:
+        waiters[asyncio.ensure_future(MODEL_SLOT_FREED.wait())] = "slot_freed"
+    done, pending = await asyncio.wait(waiters, timeout=interval, return_when=asyncio.FIRST_COMPLETED)
+    for waiter in pending:
+        waiter.cancel()
+    POLLING_WAKEUPS.inc(reason=waiters[next(iter(done))] if done else "interval")
     trigger.clear()
+    if wake_on_slot_freed:
+        MODEL_SLOT_FREED.clear()
 
 
 def _model_of(processor_name: str) -> str:
     return processor_name.split(":", 1)[0]
 
 
-async def available_provider_ids(task_processors: dict) -> list[str]:
+def _task_type_of(processor_name: str) -> str:
+    return processor_name.split(":", 1)[1]
+
+
+async def available_provider_ids(task_processors: dict, *, model: str | None = None, pending: int = 0) -> list[str]:
     async with MODEL_INFLIGHT_LOCK:
-        return [
-            "llm2:" + name
-            for name in task_processors
-            if MODEL_INFLIGHT.get(_model_of(name), 0) < get_n_parallel(_model_of(name))
-        ]
+        return SCHEDULER.provider_ids(
+            task_processors, MODEL_INFLIGHT, get_n_parallel, model=model, pending=pending,
+            # Models that would need to evict a busy server are skipped until memory frees up
+            model_available=model_can_serve,
+            # Warm models first; cold ones only once the warm ones are saturated for a while
+            model_warm=model_is_warm,
+        )
+
+
+async def free_slots_per_model(task_processors: dict) -> dict[str, int]:
+    async with MODEL_INFLIGHT_LOCK:
+        free = {}
+        for model in {_model_of(name) for name in task_processors}:
+            if not model_can_serve(model):
+                continue
+            slots = get_n_parallel(model) - MODEL_INFLIGHT.get(model, 0)
+            if slots > 0:
+                free[model] = slots
+        return free
+
+
+async def reserve_slot(response: dict) -> None:
+    processor_name = response["provider"]["name"][5:]
+    model = _model_of(processor_name)
+    async with MODEL_INFLIGHT_LOCK:
+        MODEL_INFLIGHT[model] = MODEL_INFLIGHT.get(model, 0) + 1
+        queue_wait = SCHEDULER.claimed(model, _task_type_of(processor_name), response["task"])
+    if queue_wait is not None:
+        priority_class = SCHEDULER.class_of(_task_type_of(processor_name)).name
+        QUEUE_WAIT.observe(queue_wait, model=model, task_type=_task_type_of(processor_name), priority_class=priority_class)
+        logger.info(f"Claimed task {response['task'].get('id')} ({priority_class}) after {round(queue_wait, 2)}s in the queue")
+
+
+async def next_task(nc: AsyncNextcloudApp, provider_ids: list[str], task_type_ids: set[str]) -> dict:
+    NEXT_TASK_CALLS.inc()
+    try:
+        response = await nc.providers.task_processing.next_task(provider_ids, list(task_type_ids))
+    except Exception:
+        NEXT_TASK_ERRORS.inc()
+        raise
+    if not response:
+        NEXT_TASK_EMPTY.inc()
+    return response
+
+
+async def claim_tasks(
+        nc: AsyncNextcloudApp,
+        task_processors: dict,
+        task_type_ids: set[str],
+        start_task: Callable[[dict], None],
+) -> tuple[int, bool]:
+    """Claim up to one task per free model slot in a single polling round.
+
+    Every claimed task has its slot reserved and is handed to ``start_task`` right away,
+    so processing starts while the remaining slots are still being filled.
+    Returns the number of claimed tasks and whether the queue was found empty.
+    """
+    if TASK_CLAIM_MODE == 'parallel':
+        return await _claim_tasks_parallel(nc, task_processors, task_type_ids, start_task)
+
+    claimed = 0
+    while True:
+        available = await available_provider_ids(task_processors)
+        if not available:
+            return claimed, False
+        response = await next_task(nc, available, task_type_ids)
+        if not response:
+            return claimed, True
+        # Reserve the slot before yielding to the loop again,
+        # so the next available_provider_ids() call sees this task counted.
+        await reserve_slot(response)
+        start_task(response)
+        claimed += 1
+        if TASK_CLAIM_MODE == 'single':
+            return claimed, False
+
+
+async def _claim_tasks_parallel(
+        nc: AsyncNextcloudApp,
+        task_processors: dict,
+        task_type_ids: set[str],
+        start_task: Callable[[dict], None],
+) -> tuple[int, bool]:
+    free_slots = await free_slots_per_model(task_processors)
+
+    # Each request only offers the providers of one model, so a model never
+    # receives more tasks than it has free slots, even though all requests are in flight at once.
+    # The k-th request of a model counts the k requests before it as taken, so lower priority
+    # classes drop out of the later requests once only reserved slots are left.
+    requests = []
+    for model, slots in free_slots.items():
+        for pending in range(slots):
+            provider_ids = await available_provider_ids(task_processors, model=model, pending=pending)
+            if not provider_ids:
+                break
+            requests.append(next_task(nc, provider_ids, task_type_ids))
+    if not requests:
+        return 0, False
+
+    claimed = 0
+    drained = False
+    error: BaseException | None = None
+    for response in await asyncio.gather(*requests, return_exceptions=True):
+        if isinstance(response, BaseException):
+            error = error or response
+        elif not response:
+            drained = True
+        else:
+            await reserve_slot(response)
+            start_task(response)
+            claimed += 1
+    # Tasks claimed by the successful requests are already running; only surface the error afterwards.
+    if error is not None and claimed == 0:
+        raise error
+    if error is not None:
+        logger.warning(f"Some task claims failed: {error}")
+    return claimed, drained
 
 
 async def handle_task(task: dict, provider: dict, nc: AsyncNextcloudApp, task_processors: dict) -> None:
@@ -133,12 +325,25 @@ async def handle_task(task: dict, provider: dict, nc: AsyncNextcloudApp, task_pr
 
     task_processor_name = provider["name"][5:]
     model_name = _model_of(task_processor_name)
+    task_type = _task_type_of(task_processor_name)
+    time_claimed = time.perf_counter()
+    # Labels the generation metrics of the model requests made for this task
+    track_task(model_name, task_type)
+    # Parallel requests of the task run on free slots of the model that it borrows
+    use_task_slots(TaskSlots(
+        borrow=lambda count: borrow_model_slots(model_name, task_type, count),
+        give_back=lambda count: give_back_model_slots(model_name, count),
+    ))
 
     async with NUM_RUNNING_TASKS_LOCK:
         NUM_RUNNING_TASKS += 1
+    # Keeps the model's server from being evicted while the task runs
+    SERVER_POOL.acquire(model_name)
+    slot_released = False
 
     try:
-        await log(nc, LogLvl.INFO, f"Processing: {task_processor_name}")
+        priority_class = SCHEDULER.class_of(task_type).name
+        await log(nc, LogLvl.INFO, f"Processing: {task_processor_name} (priority class: {priority_class})")
 
         task_processor_loader = task_processors.get(task_processor_name)
         if task_processor_loader is None:
@@ -147,26 +352,77 @@ async def handle_task(task: dict, provider: dict, nc: AsyncNextcloudApp, task_pr
             )
             return
 
-        # task_processor_loader() calls generate_chat_model() which may start the llama-cpp-server
-        # on first use (blocking I/O). Run it in the executor to avoid stalling the event loop.
-        loop = asyncio.get_running_loop()
-        processor = await loop.run_in_executor(None, task_processor_loader)
-
-        stream_result = NextcloudTaskStreamResult(nc, task["id"], bool(task.get("preferStreaming")))
-        stream_context = StreamContext(
-            stream_result=stream_result.send if stream_result.enabled else None,
-            progress_callback=stream_result.set_progress if stream_result.enabled else None,
-        )
+        async def release_slot() -> None:
+            # The task waits for an identical one instead of generating, so its model slot is free again
+            nonlocal slot_released
+            slot_released = True
+            await release_model_slot(model_name, task_type)
+
+        async def take_slot_again() -> None:
+            # The identical task it waited for is gone, so this task generates after all,
+            # once its priority class may take a slot of the model again
+            nonlocal slot_released
+            async with MODEL_SLOT_RELEASED:
+                await MODEL_SLOT_RELEASED.wait_for(lambda: _usable_slots(model_name, task_type) > 0)
+                MODEL_INFLIGHT[model_name] = MODEL_INFLIGHT.get(model_name, 0) + 1
+                SCHEDULER.claimed(model_name, task_type, {})
+            slot_released = False
+
+        async def generate() -> dict:
+            # Starts the llama-cpp-server on first use without blocking the event loop;
+            # concurrent first tasks for the same model wait for the same startup.
+            time_setup = time.perf_counter()
+            await start_model(model_name)
+            processor = task_processor_loader()
+            TASK_SETUP.observe(time.perf_counter() - time_setup, model=model_name, task_type=task_type)
+
+            stream_result = NextcloudTaskStreamResult(nc, task["id"], bool(task.get("preferStreaming")))
+            stream_context = StreamContext(
+                stream_result=stream_result.send if stream_result.enabled else None,
+                progress_callback=stream_result.set_progress if stream_result.enabled else None,
+            )
+            result = await INFLIGHT_TASKS.run(
+                task["id"], stream_result.heartbeat, processor(task.get("input"), context=stream_context),
+            )
+            # The last streamed update must not arrive after the final result
+            await stream_context.flush()
+            if stream_context.stats.sent:
+                stats = stream_context.stats
+                STREAM_UPDATES.inc(stats.sent, outcome="sent")
+                STREAM_UPDATES.inc(stats.dropped, outcome="superseded")
+                logger.info(
+                    f"Streamed {stats.sent} updates ({stats.sent_bytes} bytes, {stats.dropped} superseded) for task {task['id']},"
+                    f" lag mean {round(stats.mean_lag, 2)}s max {round(stats.max_lag, 2)}s, rtt {round(stats.rtt, 3)}s"
+                )
+            return result
 
         time_start = time.perf_counter()
-        result = await processor(task.get("input"), context=stream_context)
+        if RESULT_CACHE.enabled_for(task_type) and deterministic_sampling(model_name, task_type):
+            cache_key = result_cache_key(result_cache_scope(model_name, task_type), task_type, task.get("input"))
+            result, outcome = await RESULT_CACHE.get_or_generate(
+                cache_key, generate, on_coalesce=release_slot, on_take_over=take_slot_again, abandoned=(TaskGone,),
+            )
+            RESULT_CACHE_LOOKUPS.inc(outcome=outcome)
+            if outcome != "miss":
+                stats = RESULT_CACHE.stats()
+                await log(nc, LogLvl.INFO, f"Result cache {outcome} for task {task['id']} (hits: {stats['hits']}, coalesced: {stats['coalesced']}, misses: {stats['misses']})")
+        else:
+            result = await generate()
         await log(nc, LogLvl.INFO, f"Done in {round(time.perf_counter() - time_start, 2)}s: {result}")
         await nc.providers.task_processing.report_result(task["id"], result)
+        TASK_DURATION.observe(time.perf_counter() - time_claimed, model=model_name, task_type=task_type)
+        TASKS.inc(model=model_name, task_type=task_type, outcome="success")
 
+    except TaskGone as e:
+        # Nobody waits for a result anymore; tasks that waited for this one generate themselves
+        TASKS.inc(model=model_name, task_type=task_type, outcome="cancelled")
+        await log(nc, LogLvl.INFO, str(e))
     except (NextcloudException, RequestException, JSONDecodeError) as e:
+        TASKS.inc(model=model_name, task_type=task_type, outcome="error")
         tb_str = ''.join(traceback.format_exception(e))
         await log(nc, LogLvl.ERROR, f"Network error handling task: {tb_str}")
     except Exception as e:
+        TASKS.inc(model=model_name, task_type=task_type, outcome="error")
         tb_str = ''.join(traceback.format_exception(e))
         await log(nc, LogLvl.ERROR, f"Error handling task: {tb_str}")
         try:
@@ -174,11 +430,45 @@ async def handle_task(task: dict, provider: dict, nc: AsyncNextcloudApp, task_pr
         except (NextcloudException, RequestException):
             pass
     finally:
+        SERVER_POOL.release(model_name)
         async with NUM_RUNNING_TASKS_LOCK:
             NUM_RUNNING_TASKS -= 1
-        async with MODEL_INFLIGHT_LOCK:
-            MODEL_INFLIGHT[model_name] = max(0, MODEL_INFLIGHT.get(model_name, 0) - 1)
-        MODEL_SLOT_FREED.set()
+        if not slot_released:
+            await release_model_slot(model_name, task_type)
+
+
+async def release_model_slot(model_name: str, task_type: str) -> None:
+    async with MODEL_INFLIGHT_LOCK:
+        MODEL_INFLIGHT[model_name] = max(0, MODEL_INFLIGHT.get(model_name, 0) - 1)
+        SCHEDULER.released(model_name, task_type)
+        MODEL_SLOT_RELEASED.notify_all()
+    # Follow-up tasks (e.g. the next chat message) tend to arrive right after a task finished
+    POLLING.note_activity()
+    MODEL_SLOT_FREED.set()
+
+
+async def borrow_model_slots(model_name: str, task_type: str, count: int) -> int:
+    """Charges up to `count` further free slots of the model to a running task, for its parallel requests.
+
+    Only slots that the task's priority class could claim are lent, so reservations of higher classes hold.
+    """
+    async with MODEL_INFLIGHT_LOCK:
+        borrowed = max(0, min(count, _usable_slots(model_name, task_type)))
+        MODEL_INFLIGHT[model_name] = MODEL_INFLIGHT.get(model_name, 0) + borrowed
+    return borrowed
+
+
+async def give_back_model_slots(model_name: str, count: int) -> None:
+    async with MODEL_INFLIGHT_LOCK:
+        MODEL_INFLIGHT[model_name] = max(0, MODEL_INFLIGHT.get(model_name, 0) - count)
+        MODEL_SLOT_RELEASED.notify_all()
+    MODEL_SLOT_FREED.set()
+
+
+def _usable_slots(model_name: str, task_type: str) -> int:
+    """Free slots of the model the task type's priority class may take; call under MODEL_INFLIGHT_LOCK."""
+    usable = SCHEDULER.usable_slots(model_name, get_n_parallel(model_name), MODEL_INFLIGHT.get(model_name, 0))
+    return usable[SCHEDULER.class_of(task_type).name]
 
 
 async def background_task_loop() -> None:
@@ -213,8 +503,8 @@ async def _background_task_loop_inner() -> None:
                 last_scan = time.monotonic()
                 REFRESH_PROCESSORS.clear()
 
-            available = await available_provider_ids(task_processors)
-            if not available:
+            free_slots = await free_slots_per_model(task_processors)
+            if not free_slots:
                 # Every model is at its n_parallel cap. Wait for a slot to free
                 # rather than pulling tasks NC would otherwise mark "running".
                 try:
@@ -224,31 +514,24 @@ async def _background_task_loop_inner() -> None:
                 MODEL_SLOT_FREED.clear()
                 continue
 
+            def start_task(response: dict) -> None:
+                if POLLING.note_claimed(response["task"].get("scheduledAt")):
+                    MISSED_TRIGGERS.inc()
+                tg.create_task(handle_task(response["task"], response["provider"], nc, task_processors))
+
+            # Only slots freed from now on are news for the wait after this round
+            MODEL_SLOT_FREED.clear()
             try:
-                response = await nc.providers.task_processing.next_task(
-                    available, list(task_type_ids)
-                )
+                claimed, drained = await claim_tasks(nc, task_processors, task_type_ids, start_task)
             except (NextcloudException, RequestException, JSONDecodeError) as e:
                 await log(nc, LogLvl.ERROR, f"Network error fetching the next task: {e}")
                 await wait_for_tasks(CHECK_INTERVAL_ON_ERROR)
                 continue
 
-            if not response:
-                async with NUM_RUNNING_TASKS_LOCK:
-                    no_tasks_running = NUM_RUNNING_TASKS == 0
-                if no_tasks_running:
-                    await wait_for_tasks()
-                else:
-                    await asyncio.sleep(2)
-                continue
-
-            # Reserve the slot synchronously, before yielding to the loop again,
-            # so the next available_provider_ids() call sees this task counted.
-            pulled_model = _model_of(response["provider"]["name"][5:])
-            async with MODEL_INFLIGHT_LOCK:
-                MODEL_INFLIGHT[pulled_model] = MODEL_INFLIGHT.get(pulled_model, 0) + 1
-
-            tg.create_task(handle_task(response["task"], response["provider"], nc, task_processors))
+            if claimed == 0 or drained:
+                # Nothing to claim for the free slots right now. A finished task frees a slot
+                # that tasks of other priority classes, or follow-up tasks, may be waiting for.
+                await wait_for_tasks(POLLING.next_interval(), wake_on_slot_freed=True)
     # TaskGroup exits only after all spawned handle_task coroutines finish — graceful drain on shutdown
 
 
@@ -274,6 +557,39 @@ async def lifespan(_app: FastAPI):
 
 APP = FastAPI(lifespan=lifespan)
 
+
+def _collect_metrics() -> None:
+    """Sets the gauges from the current state right before a scrape."""
+    RUNNING_TASKS.set(NUM_RUNNING_TASKS)
+    TRIGGERS_LIVE.set(int(POLLING.triggers_live))
+    servers = SERVER_POOL.state()["servers"]
+    backends = remote_backends()
+    MODEL_INFLIGHT_TASKS.clear()
+    MODEL_SLOTS.clear()
+    for model in set(MODEL_INFLIGHT) | set(servers) | set(backends):
+        MODEL_INFLIGHT_TASKS.set(MODEL_INFLIGHT.get(model, 0), model=model)
+        MODEL_SLOTS.set(get_n_parallel(model), model=model)
+    SERVER_RSS.clear()
+    for model, server in servers.items():
+        rss = process_rss_bytes(server["pid"]) if server["alive"] else None
+        if rss is not None:
+            SERVER_RSS.set(rss, model=model)
+    REMOTE_ENDPOINT_UP.clear()
+    REMOTE_ENDPOINT_OUTSTANDING.clear()
+    for model, backend in backends.items():
+        for endpoint in backend.endpoints:
+            REMOTE_ENDPOINT_UP.set(int(endpoint.healthy), model=model, endpoint=endpoint.url)
+            REMOTE_ENDPOINT_OUTSTANDING.set(endpoint.outstanding, model=model, endpoint=endpoint.url)
+
+
+REGISTRY.on_collect(_collect_metrics)
+
+
+@APP.get("/metrics")
+async def metrics_endpoint() -> PlainTextResponse:
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
 def get_optional_input_shape(task: str) -> list[ShapeDescriptor]:
     if task == "core:text2text:chat":
         return [
@@ -329,6 +645,15 @@ def get_optional_input_defaults(task: str) -> dict[str, str]:
         }
     return {}
 
+def preload_model_names(task_processors: dict) -> list[str]:
+    models = [
+        model for model in dict.fromkeys(_model_of(name) for name in task_processors) if not is_remote_model(model)
+    ]
+    if PRELOAD_MODELS.lower() == 'all':
+        return models
+    requested = [name.strip().split('.gguf')[0] for name in PRELOAD_MODELS.split(',') if name.strip()]
+    return [model for model in requested if model in models]
+
 async def enabled_handler(enabled: bool, nc: AsyncNextcloudApp) -> str:
     await log(nc, LogLvl.INFO, f"enabled={enabled}")
 
@@ -372,6 +697,11 @@ async def enabled_handler(enabled: bool, nc: AsyncNextcloudApp) -> str:
             except Exception as e:
                 await log(nc, LogLvl.ERROR, f"Failed to register {model} - {task}, Error: {e}\n")
                 break
+
+        models_to_preload = preload_model_names(task_processors)
+        if app_enabled.is_set() and models_to_preload:
+            await log(nc, LogLvl.INFO, f"Preloading models: {', '.join(models_to_preload)}")
+            SERVER_POOL.preload(models_to_preload)
     else:
         app_enabled.clear()
         for task_processor_name in task_processors:
@@ -386,6 +716,8 @@ async def enabled_handler(enabled: bool, nc: AsyncNextcloudApp) -> str:
 
 
 async def trigger_handler(providerId: str):
+    POLLING.note_trigger()
+    TRIGGERS.inc()
     trigger.set()
 
 
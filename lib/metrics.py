@@ -0,0 +1,428 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+"""Performance metrics in the Prometheus text exposition format
+
+A small registry of counters, gauges and histograms, served by the /metrics route of the app.
+Generation metrics (time to first token, tokens per second) are collected by a LangChain
+callback on every model client and labelled with the task that is running in the current
+asyncio context, see `track_task()`.
+"""
+import asyncio
+import bisect
+import math
+import os
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Callable
+from uuid import UUID
+
+from langchain_core.callbacks import AsyncCallbackHandler
+from langchain_core.outputs import LLMResult
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+TOKENS_PER_SECOND_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 40, 60, 80, 100, 150, 200, 400)
+
+LabelValues = tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    metric_type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+
+    def _key(self, labels: dict[str, Any]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects the labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: LabelValues, extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {_escape(self.documentation)}",
+            f"# TYPE {self.name} {self.metric_type}",
+            *self.samples(),
+        ]
+
+
+class Counter(_Metric):
+    metric_type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        # Metrics without labels are exported from the start, with labels once they are used
+        self._values: dict[LabelValues, float] = {} if labelnames else {(): 0}
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        return [f"{self.name}{self._labels(key)} {_format_value(value)}" for key, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    metric_type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        # Metrics without labels are exported from the start, with labels once they are used
+        self._values: dict[LabelValues, float] = {} if labelnames else {(): 0}
+
+    def set(self, value: float, **labels: Any) -> None:
+        self._values[self._key(labels)] = value
+
+    def clear(self) -> None:
+        """Forgets all label sets, e.g. before setting the values of the models that still exist."""
+        self._values.clear()
+
+    def samples(self) -> list[str]:
+        return [f"{self.name}{self._labels(key)} {_format_value(value)}" for key, value in self._values.items()]
+
+
+@dataclass
+class _HistogramValues:
+    buckets: list[int]
+    count: int = 0
+    total: float = 0.0
+
+
+class Histogram(_Metric):
+    metric_type = "histogram"
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: tuple[str, ...] = (),
+            buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.bounds = sorted(buckets)
+        self._values: dict[LabelValues, _HistogramValues] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        values = self._values.get(key)
+        if values is None:
+            values = self._values[key] = _HistogramValues([0] * len(self.bounds))
+        index = bisect.bisect_left(self.bounds, value)
+        if index < len(self.bounds):
+            values.buckets[index] += 1
+        values.count += 1
+        values.total += value
+
+    def samples(self) -> list[str]:
+        lines = []
+        for key, values in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.bounds, values.buckets):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{self._labels(key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{self._labels(key, le)} {values.count}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {_format_value(values.total)}")
+            lines.append(f"{self.name}_count{self._labels(key)} {values.count}")
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: list[_Metric] = []
+        self._collectors: list[Callable[[], None]] = []
+
+    def register(self, metric: _Metric) -> Any:
+        self._metrics.append(metric)
+        return metric
+
+    def on_collect(self, collector: Callable[[], None]) -> None:
+        """Runs `collector` before every scrape, e.g. to set gauges from the current state."""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self._collectors:
+            collector()
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+QUEUE_WAIT = REGISTRY.register(Histogram(
+    "llm2_queue_wait_seconds", "Time from scheduling a task until it was claimed",
+    ("model", "task_type", "priority_class"),
+))
+TASK_SETUP = REGISTRY.register(Histogram(
+    "llm2_task_setup_seconds",
+    "Time to start the model server (cold start) and build the task processor", ("model", "task_type"),
+))
+TIME_TO_FIRST_TOKEN = REGISTRY.register(Histogram(
+    "llm2_time_to_first_token_seconds", "Time from a streamed model request until its first token",
+    ("model", "task_type"),
+))
+TASK_DURATION = REGISTRY.register(Histogram(
+    "llm2_task_duration_seconds", "Time from claiming a task until its result was reported", ("model", "task_type"),
+))
+TOKENS_PER_SECOND = REGISTRY.register(Histogram(
+    "llm2_generation_tokens_per_second", "Generated tokens per second of a model request after its first token",
+    ("model", "task_type"), buckets=TOKENS_PER_SECOND_BUCKETS,
+))
+GENERATED_TOKENS = REGISTRY.register(Counter(
+    "llm2_generated_tokens_total", "Tokens generated by the models", ("model", "task_type"),
+))
+PROMPT_TOKENS = REGISTRY.register(Counter(
+    "llm2_prompt_tokens_total", "Prompt tokens of the model requests", ("model", "task_type"),
+))
+CACHED_PROMPT_TOKENS = REGISTRY.register(Counter(
+    "llm2_cached_prompt_tokens_total",
+    "Prompt tokens that were reused from the KV cache instead of prefilled", ("model", "task_type"),
+))
+SLOT_ROUTES = REGISTRY.register(Counter(
+    "llm2_slot_routes_total",
+    "Chat requests by the slot they were routed to (pinned: the conversation's slot, moved: another slot "
+    "because it was busy, new: first request of the conversation, all_busy: left to the server)",
+    ("model", "outcome"),
+))
+GENERATIONS = REGISTRY.register(Counter(
+    "llm2_generations_total",
+    "Model requests by why the generation ended (stop, length: the token budget ran out, tool_calls)",
+    ("model", "task_type", "finish_reason"),
+))
+TASKS = REGISTRY.register(Counter(
+    "llm2_tasks_total", "Processed tasks by outcome (success, error, cancelled)", ("model", "task_type", "outcome"),
+))
+TASK_CANCELLATIONS = REGISTRY.register(Counter(
+    "llm2_task_cancellations_total",
+    "Generations cancelled because their task no longer runs in Nextcloud, by the task status "
+    "(cancelled, failed, ..., or rejected: Nextcloud rejected its heartbeats)", ("reason",),
+))
+CANCELLED_TOKENS_SAVED = REGISTRY.register(Counter(
+    "llm2_cancelled_tokens_saved_total",
+    "Tokens that cancelled model requests did not generate, estimated from the rest of their max_tokens",
+    ("model", "task_type"),
+))
+NEXT_TASK_CALLS = REGISTRY.register(Counter("llm2_next_task_calls_total", "Calls to next_task"))
+NEXT_TASK_EMPTY = REGISTRY.register(Counter(
+    "llm2_next_task_empty_total", "Calls to next_task that returned no task",
+))
+NEXT_TASK_ERRORS = REGISTRY.register(Counter("llm2_next_task_errors_total", "Calls to next_task that failed"))
+RESULT_CACHE_LOOKUPS = REGISTRY.register(Counter(
+    "llm2_result_cache_lookups_total", "Result cache lookups by outcome (hit, coalesced, miss)", ("outcome",),
+))
+STREAM_UPDATES = REGISTRY.register(Counter(
+    "llm2_stream_updates_total", "Streamed output updates by outcome (sent, superseded)", ("outcome",),
+))
+TRIGGERS = REGISTRY.register(Counter("llm2_triggers_total", "Triggers received from Nextcloud"))
+MISSED_TRIGGERS = REGISTRY.register(Counter(
+    "llm2_missed_triggers_total", "Claimed tasks that Nextcloud did not announce with a trigger",
+))
+TRIGGERS_LIVE = REGISTRY.register(Gauge(
+    "llm2_triggers_live", "1 while Nextcloud announces new tasks with triggers, 0 while polling",
+))
+POLLING_INTERVAL = REGISTRY.register(Gauge(
+    "llm2_polling_interval_seconds", "Interval of the current wait for new tasks",
+))
+POLLING_WAKEUPS = REGISTRY.register(Counter(
+    "llm2_polling_wakeups_total", "Waits for new tasks that ended by reason (trigger, slot_freed, interval)",
+    ("reason",),
+))
+MODEL_INFLIGHT_TASKS = REGISTRY.register(Gauge(
+    "llm2_model_inflight_tasks", "Tasks holding a slot of the model", ("model",),
+))
+MODEL_SLOTS = REGISTRY.register(Gauge("llm2_model_slots", "Parallel slots of the model (n_parallel)", ("model",)))
+RUNNING_TASKS = REGISTRY.register(Gauge("llm2_running_tasks", "Tasks being processed"))
+SERVER_RSS = REGISTRY.register(Gauge(
+    "llm2_server_rss_bytes", "Resident memory of the model's llama-server process", ("model",),
+))
+REMOTE_ENDPOINT_UP = REGISTRY.register(Gauge(
+    "llm2_remote_endpoint_up", "Whether a remote endpoint of the model passed its last health check",
+    ("model", "endpoint"),
+))
+REMOTE_ENDPOINT_OUTSTANDING = REGISTRY.register(Gauge(
+    "llm2_remote_endpoint_outstanding", "Requests in flight to a remote endpoint of the model",
+    ("model", "endpoint"),
+))
+
+
+def process_rss_bytes(pid: int) -> int | None:
+    """Resident memory of a process, from /proc on Linux; None where that is not available."""
+    try:
+        with open(f"/proc/{pid}/statm", encoding="ascii") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+# (model, task type) of the task processed in the current asyncio context
+_current_task: ContextVar[tuple[str, str] | None] = ContextVar("llm2_current_task", default=None)
+# Model requests in flight of the task processed in the current asyncio context, by run id
+_task_requests: ContextVar[dict[UUID, "_Generation"] | None] = ContextVar("llm2_task_requests", default=None)
+
+
+def track_task(model: str, task_type: str) -> None:
+    """Attributes the model requests made from the current asyncio task (and its children) to a task."""
+    _current_task.set((model, task_type))
+    _task_requests.set({})
+
+
+def count_cancelled_requests() -> None:
+    """Counts the model requests of the current task that are still in flight as cancelled.
+
+    Cancelled streams are counted by the callback, but LangChain doesn't report cancelled
+    requests that were not streamed.
+    """
+    requests = _task_requests.get()
+    if not requests:
+        return
+    for run_id, generation in list(requests.items()):
+        GENERATION_METRICS.forget(run_id)
+        _count_saved_tokens(generation)
+
+
+@dataclass
+class _Generation:
+    labels: tuple[str, str]
+    started: float = field(default_factory=time.perf_counter)
+    first_token: float = 0.0
+    last_token: float = 0.0
+    tokens: int = 0
+    # Token budget of the request, 0 when unknown
+    max_tokens: int = 0
+    # The requests in flight of the task the request belongs to
+    task_requests: dict | None = None
+
+
+class GenerationMetricsCallback(AsyncCallbackHandler):
+    """Records time to first token and token rates of the model requests made for tasks."""
+
+    def __init__(self) -> None:
+        self._generations: dict[UUID, _Generation] = {}
+
+    async def on_chat_model_start(
+            self, serialized: dict[str, Any], messages: list, *, run_id: UUID, **kwargs: Any,
+    ) -> None:
+        labels = _current_task.get()
+        if labels is not None:
+            params = kwargs.get("invocation_params") or {}
+            # max_tokens is the budget bound to the request, max_completion_tokens the client's default
+            max_tokens = params.get("max_tokens") or params.get("max_completion_tokens") or 0
+            task_requests = _task_requests.get()
+            generation = _Generation(labels, max_tokens=max_tokens, task_requests=task_requests)
+            self._generations[run_id] = generation
+            if task_requests is not None:
+                task_requests[run_id] = generation
+
+    async def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> None:
+        generation = self._generations.get(run_id)
+        if generation is None:
+            return
+        now = time.perf_counter()
+        if not generation.first_token:
+            generation.first_token = now
+        generation.last_token = now
+        generation.tokens += 1
+
+    async def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        generation = self.forget(run_id)
+        if generation is None:
+            return
+        end = time.perf_counter()
+        model, task_type = generation.labels
+        tokens = _output_tokens(response) or generation.tokens
+        if tokens:
+            GENERATED_TOKENS.inc(tokens, model=model, task_type=task_type)
+        prompt_tokens, cached_tokens = _prompt_tokens(response)
+        if prompt_tokens:
+            PROMPT_TOKENS.inc(prompt_tokens, model=model, task_type=task_type)
+            CACHED_PROMPT_TOKENS.inc(cached_tokens, model=model, task_type=task_type)
+        for finish_reason in _finish_reasons(response):
+            GENERATIONS.inc(model=model, task_type=task_type, finish_reason=finish_reason)
+        if generation.first_token:
+            TIME_TO_FIRST_TOKEN.observe(generation.first_token - generation.started, model=model, task_type=task_type)
+            decode_time = generation.last_token - generation.first_token
+            if generation.tokens > 1 and decode_time > 0:
+                TOKENS_PER_SECOND.observe((generation.tokens - 1) / decode_time, model=model, task_type=task_type)
+        elif tokens and end > generation.started:
+            # Not streamed: the rate includes the prompt processing
+            TOKENS_PER_SECOND.observe(tokens / (end - generation.started), model=model, task_type=task_type)
+
+    async def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        generation = self.forget(run_id)
+        # A cancelled stream is closed, which LangChain reports as GeneratorExit
+        if generation is not None and isinstance(error, (asyncio.CancelledError, GeneratorExit)):
+            _count_saved_tokens(generation)
+
+    def forget(self, run_id: UUID) -> _Generation | None:
+        generation = self._generations.pop(run_id, None)
+        if generation is not None and generation.task_requests is not None:
+            generation.task_requests.pop(run_id, None)
+        return generation
+
+
+def _count_saved_tokens(generation: _Generation) -> None:
+    """Counts the rest of the token budget of a cancelled request as saved."""
+    model, task_type = generation.labels
+    saved = generation.max_tokens - generation.tokens
+    if saved > 0:
+        CANCELLED_TOKENS_SAVED.inc(saved, model=model, task_type=task_type)
+
+
+def _output_tokens(response: LLMResult) -> int:
+    tokens = 0
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                tokens += usage.get("output_tokens", 0)
+    return tokens
+
+
+def _prompt_tokens(response: LLMResult) -> tuple[int, int]:
+    """Prompt tokens of the requests and how many of them were in the KV cache already."""
+    prompt_tokens = cached_tokens = 0
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                prompt_tokens += usage.get("input_tokens", 0)
+                cached_tokens += (usage.get("input_token_details") or {}).get("cache_read", 0)
+    return prompt_tokens, cached_tokens
+
+
+def _finish_reasons(response: LLMResult) -> list[str]:
+    reasons = []
+    for generations in response.generations:
+        for generation in generations:
+            info = generation.generation_info or {}
+            metadata = getattr(getattr(generation, "message", None), "response_metadata", None) or {}
+            reasons.append(info.get("finish_reason") or metadata.get("finish_reason") or "unknown")
+    return reasons
+
+
+GENERATION_METRICS = GenerationMetricsCallback()
@@ -0,0 +1,77 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+"""When to ask Nextcloud for the next task
+
+Right after a task was claimed or finished, or a trigger arrived, more tasks are likely, so
+the queue is polled again quickly. While it stays empty the interval doubles, with jitter so
+that many app instances don't poll in lockstep, up to `max_interval`. As long as Nextcloud
+announces new tasks with triggers, polling is only a safety net and backs off to
+`trigger_interval`; a task that was waiting without a trigger switches back to polling.
+"""
+import logging
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PollingPolicy:
+    min_interval: float = 0.5
+    # Longest interval while idle without working triggers
+    max_interval: float = 5.0
+    # Longest interval while triggers arrive
+    trigger_interval: float = 5 * 60
+    backoff: float = 2.0
+    jitter: float = 0.2
+    # A claimed task that waited longer than this without a trigger counts as a missed trigger
+    missed_trigger_grace: float = 10.0
+    random: Callable[[], float] = random.random
+    interval: float = field(default=0.0, init=False)
+    triggers_live: bool = field(default=False, init=False)
+    last_trigger_at: float = field(default=0.0, init=False)
+
+    def __post_init__(self) -> None:
+        self.interval = self.min_interval
+
+    def note_activity(self) -> None:
+        """A task was claimed or finished: poll quickly again."""
+        self.interval = self.min_interval
+
+    def note_trigger(self) -> None:
+        self.last_trigger_at = time.time()
+        if not self.triggers_live:
+            logger.info("Receiving task triggers, polling less often")
+            self.triggers_live = True
+        self.note_activity()
+
+    def note_claimed(self, scheduled_at: float | None) -> bool:
+        """Checks whether Nextcloud announced the claimed task; `scheduled_at` is its Unix time.
+
+        Returns whether a trigger was missed, which switches back to polling.
+        """
+        self.note_activity()
+        if not self.triggers_live or not isinstance(scheduled_at, (int, float)) or scheduled_at <= 0:
+            return False
+        now = time.time()
+        # scheduledAt has whole seconds and comes from the Nextcloud server's clock
+        if now - scheduled_at <= self.missed_trigger_grace or self.last_trigger_at >= scheduled_at - 1:
+            return False
+        self.triggers_live = False
+        logger.warning(
+            f"A task waited {round(now - scheduled_at)}s without a trigger, "
+            f"polling at least every {self.max_interval}s until triggers arrive again"
+        )
+        return True
+
+    @property
+    def cap(self) -> float:
+        return self.trigger_interval if self.triggers_live else self.max_interval
+
+    def next_interval(self) -> float:
+        """Interval until the next poll of an empty queue, backing off for the one after it."""
+        interval = min(self.interval, self.cap)
+        self.interval = min(self.cap, self.interval * self.backoff)
+        return interval * (1 + self.jitter * (2 * self.random() - 1))
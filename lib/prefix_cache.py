@@ -0,0 +1,186 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+"""Persistent KV cache for the fixed prompt prefixes of the task processors
+
+Every processor starts its prompt with the same system prompt and instructions. Once a
+model server is ready, the KV state of each (model, processor) prefix is restored from
+disk into a server slot, or computed with a warm-up request and saved with llama-server's
+slot save/restore API. Requests that share the prefix then skip most of the prefill,
+also right after a server restart.
+"""
+import hashlib
+import json
+import logging
+import os
+from typing import Any
+
+import niquests
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+
+logger = logging.getLogger(__name__)
+
+PREFIX_KV_CACHE = os.getenv('PREFIX_KV_CACHE', '0').strip().lower() in ('1', 'true', 'yes', 'on')
+
+# Stands in for the task input when rendering a processor's prompt; the prefix ends right before it
+PREFIX_SENTINEL = "<<LLM2_PREFIX_END>>"
+
+# Server settings that change the layout of a saved slot; a change invalidates the saved files
+_KV_LAYOUT_KEYS = ("n_ctx", "n_parallel", "n_batch", "n_ubatch", "cache_type_k", "cache_type_v", "kv_unified", "swa_full")
+
+
+def processor_prefix_messages(processor: Any) -> list[BaseMessage] | None:
+    """The messages a processor always starts with, with PREFIX_SENTINEL in place of the task input.
+
+    Processors can define `cache_prefix_messages()` themselves; otherwise the prefix is built
+    from their `system_prompt` and `user_prompt` attributes.
+    """
+    custom = getattr(processor, "cache_prefix_messages", None)
+    if callable(custom):
+        return custom()
+
+    system_prompt = getattr(processor, "system_prompt", None)
+    if not isinstance(system_prompt, str):
+        return None
+    messages: list[BaseMessage] = [SystemMessage(content=system_prompt)]
+    user_prompt = getattr(processor, "user_prompt", None)
+    if user_prompt is not None:
+        messages.append(HumanMessage(content=user_prompt.format(
+            **{name: PREFIX_SENTINEL for name in user_prompt.input_variables}
+        )))
+    else:
+        messages.append(HumanMessage(content=PREFIX_SENTINEL))
+    return messages
+
+
+def _to_openai_message(message: BaseMessage) -> dict[str, str]:
+    if isinstance(message, SystemMessage):
+        role = "system"
+    elif isinstance(message, AIMessage):
+        role = "assistant"
+    else:
+        role = "user"
+    return {"role": role, "content": message.content}
+
+
+def slot_save_path(storage_dir: str, model_name: str) -> str:
+    return os.path.join(storage_dir, "kv_cache", model_name)
+
+
+class PrefixCache:
+    """Restores or computes the prefix KV state of every processor of one model server."""
+
+    def __init__(self, base_url: str, save_path: str, model_identity: str, n_parallel: int) -> None:
+        self.base_url = base_url.rstrip("/")
+        self.save_path = save_path
+        self.model_identity = model_identity
+        self.n_parallel = max(1, n_parallel)
+
+    @staticmethod
+    def model_identity_of(model_path: str, loader_config: dict) -> str:
+        try:
+            stat = os.stat(model_path)
+            file_identity = f"{os.path.basename(model_path)}:{stat.st_size}:{int(stat.st_mtime)}"
+        except OSError:
+            file_identity = os.path.basename(model_path)
+        layout = {key: loader_config.get(key) for key in _KV_LAYOUT_KEYS}
+        return file_identity + ":" + json.dumps(layout, sort_keys=True)
+
+    def _file_name(self, prefix: str) -> str:
+        digest = hashlib.sha256((self.model_identity + "\0" + prefix).encode("utf-8")).hexdigest()
+        return digest[:32] + ".bin"
+
+    async def warm(self, prefixes: dict[str, list[BaseMessage]]) -> None:
+        """Loads the prefixes into the slots, round-robin over the slots.
+
+        When there are more prefixes than slots, the shorter prefixes only stay in llama-server's
+        host prompt cache (if enabled), but their slot files are still kept up to date on disk.
+        """
+        os.makedirs(self.save_path, exist_ok=True)
+        used_files = set()
+        async with niquests.AsyncSession() as session:
+            rendered = []
+            for name, messages in prefixes.items():
+                prefix = await self._render_prefix(session, messages)
+                if prefix:
+                    rendered.append((name, prefix))
+
+            # Longer prefixes save more prefill, so they get the slots first. They are loaded last,
+            # which leaves them resident once every prefix has been restored or saved.
+            rendered.sort(key=lambda item: len(item[1]), reverse=True)
+            for index, (name, prefix) in reversed(list(enumerate(rendered))):
+                slot = index % self.n_parallel
+                file_name = self._file_name(prefix)
+                used_files.add(file_name)
+                try:
+                    if os.path.exists(os.path.join(self.save_path, file_name)):
+                        if await self._slot_action(session, slot, "restore", file_name):
+                            logger.info(f"Restored prefix KV cache of {name} into slot {slot}")
+                            continue
+                    await self._prefill(session, slot, prefix)
+                    if await self._slot_action(session, slot, "save", file_name):
+                        logger.info(f"Saved prefix KV cache of {name} from slot {slot}")
+                except Exception as e:
+                    logger.warning(f"Warming up the prefix KV cache of {name} failed: {e}")
+
+        if used_files:
+            self._remove_stale_files(used_files)
+
+    async def _render_prefix(self, session: niquests.AsyncSession, messages: list[BaseMessage]) -> str | None:
+        resp = await session.post(
+            self.base_url + "/apply-template",
+            json={"messages": [_to_openai_message(m) for m in messages]},
+            timeout=30,
+        )
+        if resp.status_code != 200:
+            logger.warning(f"Rendering the chat template failed with status {resp.status_code}")
+            return None
+        prompt = resp.json().get("prompt", "")
+        end = prompt.find(PREFIX_SENTINEL)
+        return prompt[:end] if end > 0 else None
+
+    async def _prefill(self, session: niquests.AsyncSession, slot: int, prefix: str) -> None:
+        resp = await session.post(
+            self.base_url + "/completion",
+            json={"prompt": prefix, "n_predict": 1, "id_slot": slot, "cache_prompt": True},
+            timeout=600,
+        )
+        if resp.status_code != 200:
+            raise RuntimeError(f"prefill request failed with status {resp.status_code}: {resp.text}")
+
+    async def _slot_action(self, session: niquests.AsyncSession, slot: int, action: str, file_name: str) -> bool:
+        resp = await session.post(
+            f"{self.base_url}/slots/{slot}?action={action}",
+            json={"filename": file_name},
+            timeout=120,
+        )
+        if resp.status_code != 200:
+            logger.warning(f"Slot {action} of {file_name} failed with status {resp.status_code}: {resp.text}")
+            return False
+        return True
+
+    def _remove_stale_files(self, used_files: set[str]) -> None:
+        try:
+            for entry in os.scandir(self.save_path):
+                if entry.name.endswith(".bin") and entry.name not in used_files:
+                    os.remove(entry.path)
+        except OSError as e:
+            logger.warning(f"Cleaning up stale prefix KV cache files failed: {e}")
+
+
+async def warm_prefix_cache(
+        base_url: str,
+        save_path: str,
+        model_path: str,
+        loader_config: dict,
+        prefixes: dict[str, list[BaseMessage]],
+) -> None:
+    cache = PrefixCache(
+        base_url,
+        save_path,
+        PrefixCache.model_identity_of(model_path, loader_config),
+        loader_config.get("n_parallel", 1),
+    )
+    try:
+        await cache.warm(prefixes)
+    except Exception as e:
+        logger.warning(f"Warming up the prefix KV cache failed: {e}")
@@ -1,18 +1,34 @@
 # SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import bisect
+import re
+import unicodedata
+from functools import partial
 from typing import Any
 from langchain.prompts import PromptTemplate
 from langchain.schema.prompt_template import BasePromptTemplate
 from langchain_core.messages import SystemMessage, HumanMessage
 from langchain_core.runnables import Runnable
 
-from streaming import StreamContext
+from streaming import StreamContext, extract_text_content
+from task_slots import gather_with_task_slots
+from text_splitter import EstimatingTokenizer, TokenBudgetSplitter, chunk_token_budget
+
+_WORD_PATTERN = re.compile(r"\w+")
+_SENTENCE_END_PATTERN = re.compile(r"[.!?。！？\n]")
+
+
+def _is_opening(char: str) -> bool:
+    return unicodedata.category(char) in ("Ps", "Pi") or char in "\"'¿¡*-–—"
 
 
 class ReformatParagraphsProcessor:
     """
     Segments text by subject changes; model returns anchor phrases only.
+
+    Texts longer than the context are segmented in overlapping windows, concurrently across the
+    model's slots. Each window decides the breaks in its half of the overlaps.
     """
     system_prompt = (
         "You output anchors from a continuous text based on subject changes."
@@ -44,8 +60,19 @@ Continuous text to segment:
 
     runnable: Runnable
 
-    def __init__(self, runnable: Runnable):
+    def __init__(
+            self,
+            runnable: Runnable,
+            n_ctx: int = 8000,
+            n_parallel: int = 1,
+            max_tokens: int = 2048,
+            tokenizer: Any = None,
+    ):
         self.runnable = runnable
+        self.n_ctx = n_ctx
+        self.n_parallel = max(1, n_parallel)
+        self.max_tokens = max_tokens
+        self.tokenizer = tokenizer if tokenizer is not None else EstimatingTokenizer()
 
     @staticmethod
     def _parse_anchors_from_model_output(raw: str) -> list[str]:
@@ -60,35 +87,143 @@ Continuous text to segment:
         return anchors
 
     @staticmethod
-    def _insert_paragraph_breaks_by_anchors(text: str, anchors: list[str]) -> str:
-        if len(anchors) < 2:
-            return text
-        result = text
-        search_offset = 0
-        delta = 0
-        for i in range(1, len(anchors)):
-            anchor = anchors[i]
-            pos = text.find(anchor, search_offset)
-            if pos == -1:
+    def _anchor_positions(text: str, anchors: list[str]) -> list[int]:
+        """Positions in `text` where the anchors start, in order; anchors that are not found are skipped.
+
+        Anchors are matched on an index of the text's casefolded words, so differences in whitespace,
+        punctuation and case don't matter. An anchor whose last words or first word differ is still
+        placed by the remaining words, at the start of its sentence if that is a few words before.
+        """
+        words = [
+            (match.group(0).casefold(), match.start(), match.end()) for match in _WORD_PATTERN.finditer(text)
+        ]
+        # word -> indices of its occurrences, ascending
+        occurrences: dict[str, list[int]] = {}
+        for index, (word, _, _) in enumerate(words):
+            occurrences.setdefault(word, []).append(index)
+
+        def find(anchor_words: list[str], from_word: int) -> int:
+            candidates = occurrences.get(anchor_words[0], [])
+            for index in candidates[bisect.bisect_left(candidates, from_word):]:
+                if all(
+                        index + offset < len(words) and words[index + offset][0] == word
+                        for offset, word in enumerate(anchor_words[1:], start=1)
+                ):
+                    return index
+            return -1
+
+        positions: list[int] = []
+        next_word = 0
+        for anchor in anchors:
+            anchor_words = [word.casefold() for word in _WORD_PATTERN.findall(anchor)]
+            if not anchor_words:
+                continue
+            # Word prefixes down to two words, then without the first word; single-word anchors (e.g.
+            # from scripts without spaces) must match the beginning of a word
+            attempts = [(anchor_words[:n], 0) for n in range(len(anchor_words), min(2, len(anchor_words)) - 1, -1)]
+            if len(anchor_words) >= 3:
+                attempts.append((anchor_words[1:], 1))
+            found = -1
+            for attempt, skipped in attempts:
+                found = find(attempt, next_word + skipped)
+                if found != -1:
+                    break
+            if found == -1 and len(anchor_words) == 1:
+                found = next(
+                    (
+                        index for index in range(next_word, len(words))
+                        if words[index][0].startswith(anchor_words[0])
+                    ),
+                    -1,
+                )
+            if found == -1:
                 continue
-            insert_at = pos + delta
-            replace_from = insert_at
-            while replace_from > 0 and result[replace_from - 1].isspace():
+            for previous in range(found - 1, max(next_word, found - 3) - 1, -1):
+                if _SENTENCE_END_PATTERN.search(text, words[previous][2], words[previous + 1][1]):
+                    found = previous + 1
+                    break
+            # Keep opening quotes or brackets in front of the word with the new paragraph
+            start = words[found][1]
+            while start > 0 and _is_opening(text[start - 1]):
+                start -= 1
+            positions.append(start)
+            next_word = found + 1
+        return positions
+
+    @staticmethod
+    def _insert_paragraph_breaks(text: str, positions: list[int]) -> str:
+        """Replaces the whitespace in front of each position with a paragraph break, in one pass."""
+        pieces: list[str] = []
+        last = 0
+        for position in sorted(set(positions)):
+            replace_from = position
+            while replace_from > last and text[replace_from - 1].isspace():
                 replace_from -= 1
-            result = result[:replace_from] + "\n\n" + result[insert_at:]
-            delta += 2 - (insert_at - replace_from)
-            search_offset = pos + len(anchor)
-        return result
-
-    def __call__(self, inputs: dict[str, Any], context: StreamContext) -> dict[str, Any]:
-        messages = [
-            SystemMessage(content=self.system_prompt),
-            HumanMessage(content=self.user_prompt.format(
-                text=inputs['input']
-            ))
-        ]
-        output = self.runnable.invoke(messages)
-        raw = output.content
-        anchors = self._parse_anchors_from_model_output(raw)
-        reformatted = self._insert_paragraph_breaks_by_anchors(inputs["input"], anchors)
-        return {"output": reformatted}
\ No newline at end of file
+            # Nothing to separate at the beginning of the text
+            if last == 0 and text[:replace_from].strip() == "":
+                continue
+            pieces.append(text[last:replace_from])
+            pieces.append("\n\n")
+            last = position
+        pieces.append(text[last:])
+        return "".join(pieces)
+
+    @classmethod
+    def _insert_paragraph_breaks_by_anchors(cls, text: str, anchors: list[str]) -> str:
+        if len(anchors) < 2:
+            return text
+        return cls._insert_paragraph_breaks(text, cls._anchor_positions(text, anchors))
+
+    async def __call__(self, inputs: dict[str, Any], context: StreamContext | None = None) -> dict[str, Any]:
+        text = inputs["input"]
+        overhead = await self.tokenizer.count(self.system_prompt) + await self.tokenizer.count(
+            self.user_prompt.format(text=""),
+        )
+        chunk_tokens = chunk_token_budget(self.n_ctx, self.n_parallel, overhead, self.max_tokens)
+        splitter = TokenBudgetSplitter(self.tokenizer, chunk_tokens, overlap_tokens=chunk_tokens // 8)
+        windows = self._locate_windows(text, await splitter.split_text(text))
+
+        done = 0
+
+        async def segment(start: int, end: int) -> list[int]:
+            nonlocal done
+            output = await self.runnable.ainvoke([
+                SystemMessage(content=self.system_prompt),
+                HumanMessage(content=self.user_prompt.format(text=text[start:end])),
+            ])
+            anchors = self._parse_anchors_from_model_output(extract_text_content(output))
+            done += 1
+            if context is not None and len(windows) > 1:
+                context.set_progress(min(99.0, done / len(windows) * 100))
+            return [start + position for position in self._anchor_positions(text[start:end], anchors)]
+
+        # On as many slots of the model as the task can borrow
+        found = await gather_with_task_slots(
+            [partial(segment, start, end) for start, end in windows], self.n_parallel,
+        )
+
+        positions: list[int] = []
+        for i, (start, end) in enumerate(windows):
+            first_char = end - len(text[start:end].lstrip())
+            # A window owns the breaks up to the middle of its overlaps with its neighbours,
+            # the first anchor of a window only marks where the window starts
+            owned_from = (start + windows[i - 1][1]) // 2 if i > 0 else 0
+            owned_to = (windows[i + 1][0] + end) // 2 if i + 1 < len(windows) else len(text)
+            positions += [
+                position for position in found[i]
+                if owned_from <= position < owned_to and position > first_char
+            ]
+        return {"output": self._insert_paragraph_breaks(text, positions)}
+
+    @staticmethod
+    def _locate_windows(text: str, chunks: list[str]) -> list[tuple[int, int]]:
+        """(start, end) of each chunk of the splitter in `text`; consecutive chunks may overlap."""
+        windows: list[tuple[int, int]] = []
+        search_from = 0
+        for chunk in chunks:
+            start = text.find(chunk, search_from)
+            if start == -1:
+                start = search_from
+            windows.append((start, start + len(chunk)))
+            search_from = start + 1
+        return windows
@@ -0,0 +1,207 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+"""Remote OpenAI-compatible inference endpoints of a model
+
+A model whose config lists `endpoints` is served by those servers instead of a local
+llama-server. Requests go to the healthy endpoint with the fewest outstanding requests per
+slot; an endpoint that refuses a request is marked down and the request is retried on the
+next one. Endpoints are health-checked in the background and return once they answer again.
+"""
+import asyncio
+import logging
+import os
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable
+
+import niquests
+from langchain_core.runnables import Runnable, RunnableConfig
+from openai import APIConnectionError, InternalServerError
+
+logger = logging.getLogger(__name__)
+
+# Errors after which a request is retried on another endpoint
+FAILOVER_ERRORS = (APIConnectionError, InternalServerError)
+
+try:
+    REMOTE_HEALTH_CHECK_INTERVAL = float(os.getenv("REMOTE_HEALTH_CHECK_INTERVAL", "10"))
+    if REMOTE_HEALTH_CHECK_INTERVAL <= 0:
+        raise ValueError
+except (TypeError, ValueError):
+    logger.warning("Invalid REMOTE_HEALTH_CHECK_INTERVAL env variable, falling back to default 10 seconds")
+    REMOTE_HEALTH_CHECK_INTERVAL = 10.0
+
+
+@dataclass
+class Endpoint:
+    # OpenAI-compatible base URL, e.g. http://gpu-1:8080/v1
+    url: str
+    slots: int
+    # The LangChain client talking to this endpoint
+    llm: Any
+    api_key: str = ""
+    healthy: bool = True
+    outstanding: int = 0
+    # llama-server's /health, or the OpenAI /models for other servers
+    health_url: str = ""
+
+    @property
+    def load(self) -> float:
+        return self.outstanding / self.slots
+
+
+def parse_endpoints(config: Any) -> list[dict]:
+    """Validated `endpoints` entries of a model config: {"url": ..., "slots": 1, "api_key": "", "model": ...}."""
+    if not isinstance(config, list):
+        raise ValueError("endpoints must be a list")
+    endpoints = []
+    for entry in config:
+        if not isinstance(entry, dict) or not isinstance(entry.get("url"), str) or not entry["url"]:
+            raise ValueError(f"endpoint {entry!r} has no url")
+        slots = entry.get("slots", 1)
+        if not isinstance(slots, int) or slots < 1:
+            raise ValueError(f"endpoint {entry['url']} needs a positive number of slots")
+        endpoints.append({**entry, "url": entry["url"].rstrip("/"), "slots": slots})
+    if not endpoints:
+        raise ValueError("endpoints is empty")
+    return endpoints
+
+
+class RemoteBackend:
+    def __init__(
+            self,
+            model_name: str,
+            endpoints: list[Endpoint],
+            health_interval: float = REMOTE_HEALTH_CHECK_INTERVAL,
+    ) -> None:
+        self.model_name = model_name
+        self.endpoints = endpoints
+        self.health_interval = health_interval
+        self.chat_model = BalancedChatModel(self)
+        self._health_task: asyncio.Task | None = None
+        self._checked = asyncio.Event()
+
+    @property
+    def slots(self) -> int:
+        """Slots of the healthy endpoints, the model's capacity for claiming tasks."""
+        return sum(endpoint.slots for endpoint in self.endpoints if endpoint.healthy)
+
+    def is_available(self) -> bool:
+        return any(endpoint.healthy for endpoint in self.endpoints)
+
+    async def start(self) -> None:
+        """Starts the health checks on first use and waits for the first round."""
+        if self._health_task is None or self._health_task.done():
+            self._health_task = asyncio.ensure_future(self._health_loop())
+        await self._checked.wait()
+        if not self.is_available():
+            raise RuntimeError(f"No endpoint of {self.model_name} is reachable")
+
+    def stop(self) -> None:
+        if self._health_task is not None:
+            self._health_task.cancel()
+
+    def candidates(self) -> list[Endpoint]:
+        """Endpoints in the order to try them: healthy ones by load, the others as a last resort."""
+        return sorted(self.endpoints, key=lambda endpoint: (not endpoint.healthy, endpoint.load, endpoint.outstanding))
+
+    def mark_failed(self, endpoint: Endpoint, error: BaseException) -> None:
+        if endpoint.healthy:
+            logger.warning(f"Endpoint {endpoint.url} of {self.model_name} failed, trying the others: {error}")
+        endpoint.healthy = False
+
+    async def _health_loop(self) -> None:
+        async with niquests.AsyncSession() as session:
+            while True:
+                await asyncio.gather(*(self._check(session, endpoint) for endpoint in self.endpoints))
+                self._checked.set()
+                await asyncio.sleep(self.health_interval)
+
+    async def _check(self, session: niquests.AsyncSession, endpoint: Endpoint) -> None:
+        headers = {"Authorization": f"Bearer {endpoint.api_key}"} if endpoint.api_key else {}
+        healthy = False
+        urls = [endpoint.health_url] if endpoint.health_url else [
+            endpoint.url.removesuffix("/v1") + "/health", endpoint.url + "/models",
+        ]
+        for url in urls:
+            try:
+                resp = await session.get(url, headers=headers, timeout=5)
+            except Exception:
+                break
+            if resp.status_code == 404:
+                continue
+            healthy = resp.status_code == 200
+            endpoint.health_url = url
+            break
+        if healthy != endpoint.healthy:
+            if healthy:
+                logger.info(f"Endpoint {endpoint.url} of {self.model_name} is up")
+            else:
+                logger.warning(f"Endpoint {endpoint.url} of {self.model_name} is down")
+        endpoint.healthy = healthy
+
+
+class BalancedChatModel(Runnable):
+    """Chat model that spreads requests over the endpoints of a RemoteBackend, failing over between them.
+
+    Streams only fail over before their first chunk; after that, the error is raised.
+    """
+
+    def __init__(self, backend: RemoteBackend) -> None:
+        self.backend = backend
+
+    # Like ChatOpenAI, for the tokenizer of the model
+    @property
+    def model_name(self) -> str:
+        return self.backend.endpoints[0].llm.model_name
+
+    @property
+    def openai_api_base(self) -> str:
+        return self.backend.candidates()[0].url
+
+    def invoke(self, input: Any, config: RunnableConfig | None = None, **kwargs: Any) -> Any:
+        return self._call(lambda endpoint: endpoint.llm.invoke(input, config, **kwargs))
+
+    async def ainvoke(self, input: Any, config: RunnableConfig | None = None, **kwargs: Any) -> Any:
+        error: BaseException | None = None
+        for endpoint in self.backend.candidates():
+            endpoint.outstanding += 1
+            try:
+                return await endpoint.llm.ainvoke(input, config, **kwargs)
+            except FAILOVER_ERRORS as e:
+                self.backend.mark_failed(endpoint, e)
+                error = e
+            finally:
+                endpoint.outstanding -= 1
+        raise error
+
+    async def astream(self, input: Any, config: RunnableConfig | None = None, **kwargs: Any) -> AsyncIterator[Any]:
+        error: BaseException | None = None
+        for endpoint in self.backend.candidates():
+            started = False
+            endpoint.outstanding += 1
+            try:
+                async for chunk in endpoint.llm.astream(input, config, **kwargs):
+                    started = True
+                    yield chunk
+                return
+            except FAILOVER_ERRORS as e:
+                if started:
+                    raise
+                self.backend.mark_failed(endpoint, e)
+                error = e
+            finally:
+                endpoint.outstanding -= 1
+        raise error
+
+    def _call(self, request: Callable[[Endpoint], Any]) -> Any:
+        error: BaseException | None = None
+        for endpoint in self.backend.candidates():
+            endpoint.outstanding += 1
+            try:
+                return request(endpoint)
+            except FAILOVER_ERRORS as e:
+                self.backend.mark_failed(endpoint, e)
+                error = e
+            finally:
+                endpoint.outstanding -= 1
+        raise error
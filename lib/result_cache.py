@@ -0,0 +1,295 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+"""Content-addressed cache of task results
+
+Only results of task types that sample deterministically (temperature 0 or a fixed seed, see
+`deterministic_sampling` in task_processors.py) are cached, so regenerating a sampled task
+still gives a new text. Results are keyed by a hash of the model file, the task type, the
+normalized task input and the sampling config. Recent results are kept in memory, all of them on disk below the
+persistent storage, both bounded in size and age. Identical tasks that arrive while the
+result is still being generated wait for that generation instead of running their own.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+# Chats depend on more than their input (the tools, the time of day), so they are never cached
+UNCACHEABLE_TASK_TYPES = frozenset({"core:text2text:chat", "core:text2text:chatwithtools"})
+
+
+def _env_number(name: str, default: float) -> float:
+    try:
+        value = float(os.getenv(name, str(default)))
+        if value < 0:
+            raise ValueError
+        return value
+    except (TypeError, ValueError):
+        logger.warning(f"Invalid {name} env variable, falling back to default {default}")
+        return default
+
+
+RESULT_CACHE_TTL = _env_number('RESULT_CACHE_TTL', 7 * 24 * 3600)
+RESULT_CACHE_MEMORY_ENTRIES = int(_env_number('RESULT_CACHE_MEMORY_ENTRIES', 256))
+RESULT_CACHE_DISK_MB = _env_number('RESULT_CACHE_DISK_MB', 256)
+# Comma-separated task types that are never cached, or "all" to disable the cache
+RESULT_CACHE_DISABLED_TASK_TYPES = os.getenv('RESULT_CACHE_DISABLED_TASK_TYPES', '').strip()
+
+
+def _normalize(value: Any) -> Any:
+    """Makes inputs that only differ in line endings, Unicode form or surrounding whitespace equal."""
+    if isinstance(value, str):
+        return unicodedata.normalize("NFC", value.replace("\r\n", "\n")).strip()
+    if isinstance(value, dict):
+        return {str(key): _normalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(item) for item in value]
+    return value
+
+
+def result_cache_key(scope: dict[str, Any], task_type: str, task_input: Any) -> str:
+    """`scope` identifies the model file and its sampling config."""
+    payload = json.dumps(
+        {"scope": scope, "task_type": task_type, "input": _normalize(task_input)},
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class _GenerationAbandoned(Exception):
+    """The generation that identical tasks wait for stopped without a result, one of them takes over."""
+
+
+@dataclass
+class _DiskEntry:
+    size: int
+    stored_at: float
+
+
+class ResultCache:
+    def __init__(
+            self,
+            directory: str,
+            ttl: float = RESULT_CACHE_TTL,
+            memory_entries: int = RESULT_CACHE_MEMORY_ENTRIES,
+            disk_bytes: int = int(RESULT_CACHE_DISK_MB * 1024 * 1024),
+            disabled_task_types: str = RESULT_CACHE_DISABLED_TASK_TYPES,
+    ) -> None:
+        self.directory = directory
+        self.ttl = ttl
+        self.memory_entries = memory_entries
+        self.disk_bytes = disk_bytes
+        self.disabled_all = disabled_task_types.lower() == "all"
+        self.disabled_task_types = {name.strip() for name in disabled_task_types.split(",") if name.strip()}
+        # key -> (stored at, result), least recently used first
+        self._memory: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        # key -> disk entry, oldest first; loaded lazily from the directory
+        self._disk: OrderedDict[str, _DiskEntry] | None = None
+        self._disk_used = 0
+        self._disk_lock = threading.Lock()
+        self._inflight: dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def enabled_for(self, task_type: str) -> bool:
+        if self.disabled_all or (self.memory_entries == 0 and self.disk_bytes == 0):
+            return False
+        return task_type not in UNCACHEABLE_TASK_TYPES and task_type not in self.disabled_task_types
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "memory_entries": len(self._memory),
+            "disk_entries": len(self._disk) if self._disk is not None else 0,
+            "disk_bytes": self._disk_used,
+        }
+
+    async def get_or_generate(
+            self,
+            key: str,
+            generate: Callable[[], Awaitable[dict]],
+            on_coalesce: Callable[[], Awaitable[None]] | None = None,
+            on_take_over: Callable[[], Awaitable[None]] | None = None,
+            abandoned: tuple[type[Exception], ...] = (),
+    ) -> tuple[dict, str]:
+        """Returns the result and whether it was a "hit", "coalesced" or a "miss" that was generated.
+
+        `on_coalesce` runs before waiting for an identical generation, e.g. to give back a model slot.
+        When that generation is cancelled or fails with one of the `abandoned` exceptions, which only
+        concern the task it was for, the first waiting task generates instead and the others wait for
+        it; `on_take_over` runs before it does, e.g. to take the model slot again.
+        """
+        # Everything from looking up the generation up to registering a new one runs without
+        # yielding to the event loop, so identical tasks never start two generations
+        waited = False
+        while True:
+            result = self._get_memory(key)
+            if result is not None:
+                self.hits += 1
+                return result, "hit"
+
+            pending = self._inflight.get(key)
+            if pending is None:
+                break
+            if not waited:
+                waited = True
+                self.coalesced += 1
+                if on_coalesce is not None:
+                    await on_coalesce()
+            try:
+                # shield: a waiter that is cancelled must not cancel the generation the others wait for
+                return await asyncio.shield(pending), "coalesced"
+            except _GenerationAbandoned:
+                continue
+
+        future = asyncio.get_running_loop().create_future()
+        # Retrieve a failure even when nobody waits for it, to keep asyncio from logging it
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._inflight[key] = future
+        outcome = "hit"
+        try:
+            if waited and on_take_over is not None:
+                await on_take_over()
+            result = await self._get_disk(key)
+            if result is None:
+                outcome = "miss"
+                self.misses += 1
+                result = await generate()
+        except (asyncio.CancelledError, *abandoned):
+            future.set_exception(_GenerationAbandoned())
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        future.set_result(result)
+        if outcome == "hit":
+            self.hits += 1
+        else:
+            await self.put(key, result)
+        return result, outcome
+
+    def _get_memory(self, key: str) -> dict | None:
+        cached = self._memory.get(key)
+        if cached is None:
+            return None
+        if time.time() - cached[0] > self.ttl:
+            del self._memory[key]
+            return None
+        self._memory.move_to_end(key)
+        return cached[1]
+
+    async def _get_disk(self, key: str) -> dict | None:
+        if self.disk_bytes == 0:
+            return None
+        entry = await asyncio.to_thread(self._locked, self._read_disk, key, time.time())
+        if entry is None:
+            return None
+        self._remember(key, *entry)
+        return entry[1]
+
+    async def put(self, key: str, result: dict) -> None:
+        stored_at = time.time()
+        self._remember(key, stored_at, result)
+        if self.disk_bytes == 0:
+            return
+        try:
+            await asyncio.to_thread(self._locked, self._write_disk, key, stored_at, result)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"Storing a result in the result cache failed: {e}")
+
+    def _remember(self, key: str, stored_at: float, result: dict) -> None:
+        if self.memory_entries == 0:
+            return
+        self._memory[key] = (stored_at, result)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    # Disk store: one JSON file per key, evicted oldest first. Runs in worker threads.
+
+    def _locked(self, func: Callable, *args: Any) -> Any:
+        with self._disk_lock:
+            return func(*args)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def _load_index(self) -> OrderedDict[str, _DiskEntry]:
+        if self._disk is not None:
+            return self._disk
+        entries = []
+        if os.path.isdir(self.directory):
+            for root, _, files in os.walk(self.directory):
+                for name in files:
+                    if not name.endswith(".json"):
+                        continue
+                    try:
+                        stat = os.stat(os.path.join(root, name))
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, name[:-5], stat.st_size))
+        entries.sort()
+        self._disk = OrderedDict((key, _DiskEntry(size, mtime)) for mtime, key, size in entries)
+        self._disk_used = sum(entry.size for entry in self._disk.values())
+        return self._disk
+
+    def _read_disk(self, key: str, now: float) -> tuple[float, dict] | None:
+        index = self._load_index()
+        entry = index.get(key)
+        if entry is None:
+            return None
+        if now - entry.stored_at > self.ttl:
+            self._remove(key)
+            return None
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                return entry.stored_at, json.load(f)["result"]
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Reading a result from the result cache failed: {e}")
+            self._remove(key)
+            return None
+
+    def _write_disk(self, key: str, stored_at: float, result: dict) -> None:
+        index = self._load_index()
+        data = json.dumps({"stored_at": stored_at, "result": result}, ensure_ascii=False).encode("utf-8")
+        if len(data) > self.disk_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        os.utime(path, (stored_at, stored_at))
+
+        if key in index:
+            self._disk_used -= index.pop(key).size
+        index[key] = _DiskEntry(len(data), stored_at)
+        self._disk_used += len(data)
+        while self._disk_used > self.disk_bytes or (index and time.time() - next(iter(index.values())).stored_at > self.ttl):
+            self._remove(next(iter(index)))
+
+    def _remove(self, key: str) -> None:
+        entry = self._disk.pop(key, None) if self._disk is not None else None
+        if entry is not None:
+            self._disk_used -= entry.size
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
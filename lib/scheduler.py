@@ -0,0 +1,223 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+"""Task-type priority classes for the polling loop
+
+Every task type belongs to one priority class. Each class can reserve slots on every model,
+so a burst of long batch tasks cannot take the capacity that interactive requests need.
+The provider list passed to next_task is ordered by class priority, and lower classes are
+only offered while the reservations of all higher classes can still be honoured.
+
+Within a class, models whose server is already running come first, least loaded first. A
+task type is only offered for a cold model when no running model serves it, or when the
+running models that do have had no free slot for it for `cold_model_delay` seconds: a slot
+of a running model usually frees up long before a cold server has loaded its model.
+"""
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PRIORITY_CLASSES = [
+    {
+        "name": "interactive",
+        "task_types": ["core:text2text:chat", "core:text2text:chatwithtools"],
+        "reserved": 1,
+    },
+    {
+        "name": "short_edit",
+        "task_types": [
+            "core:text2text", "core:text2text:headline", "core:text2text:topics",
+            "core:text2text:proofread", "core:text2text:changetone", "core:text2text:simplification",
+            "core:text2text:reformulation", "core:text2text:improve", "core:contextwrite",
+        ],
+        "reserved": 0,
+    },
+    {
+        "name": "batch",
+        "task_types": ["core:text2text:summary", "core:text2text:reformatparagraphs"],
+        "reserved": 0,
+    },
+]
+
+
+@dataclass
+class PriorityClass:
+    name: str
+    task_types: frozenset[str]
+    reserved: int = 0
+
+
+@dataclass
+class PriorityScheduler:
+    classes: list[PriorityClass]
+    # (model, class name) -> number of tasks of that class currently running on the model
+    inflight: dict[tuple[str, str], int] = field(default_factory=dict)
+    cold_model_delay: float = 0.0
+    # task type -> since when no warm model had a free slot for it
+    warm_saturated_since: dict[str, float] = field(default_factory=dict)
+
+    def class_of(self, task_type: str) -> PriorityClass:
+        for priority_class in self.classes:
+            if task_type in priority_class.task_types:
+                return priority_class
+        # Task types nobody configured are treated as the lowest priority
+        return self.classes[-1]
+
+    def usable_slots(
+            self,
+            model: str,
+            n_parallel: int,
+            total_inflight: int,
+            pending: int = 0,
+            served_classes: set[str] | None = None,
+    ) -> dict[str, int]:
+        """Number of slots each class may still take on `model`.
+
+        A class can only use the free slots that are not held back for the unmet
+        reservations of the classes above it. `pending` counts claims that are in
+        flight but whose class is not known yet. Reservations of classes the model
+        does not serve (`served_classes`) are ignored.
+        """
+        free = n_parallel - total_inflight - pending
+        # Never reserve every slot, otherwise the lowest class would starve on small models
+        max_reserved = max(0, n_parallel - 1)
+        usable = {}
+        held_back = 0
+        for priority_class in self.classes:
+            usable[priority_class.name] = max(0, free - min(held_back, max_reserved))
+            if served_classes is not None and priority_class.name not in served_classes:
+                continue
+            running = self.inflight.get((model, priority_class.name), 0)
+            held_back += max(0, priority_class.reserved - running)
+        return usable
+
+    def provider_ids(
+            self,
+            task_processors: dict,
+            model_inflight: dict[str, int],
+            get_n_parallel: Callable[[str], int],
+            *,
+            model: str | None = None,
+            pending: int = 0,
+            model_available: Callable[[str], bool] | None = None,
+            model_warm: Callable[[str], bool] | None = None,
+    ) -> list[str]:
+        """Provider ids that may be offered to next_task, highest priority class first.
+
+        Only the providers of `model` are returned if it is given; the other models are still
+        looked at to decide whether a cold `model` is offered. `pending` counts against `model`,
+        or against every model if it is not given. Models for which `model_available` returns
+        False are not offered at all. Without `model_warm`, every model counts as warm.
+        """
+        served: dict[str, set[str]] = {}
+        unavailable: set[str] = set()
+        for name in task_processors:
+            model_name, task_type = name.split(":", 1)
+            if model_name in unavailable:
+                continue
+            if model_name not in served and model_available is not None and not model_available(model_name):
+                unavailable.add(model_name)
+                continue
+            served.setdefault(model_name, set()).add(self.class_of(task_type).name)
+        usable_by_model = {
+            model_name: self.usable_slots(
+                model_name,
+                get_n_parallel(model_name),
+                model_inflight.get(model_name, 0),
+                pending if model is None or model_name == model else 0,
+                classes,
+            )
+            for model_name, classes in served.items()
+        }
+        warm = {model_name: model_warm is None or model_warm(model_name) for model_name in served}
+
+        # task type -> whether a warm model has a free slot for it, for the types warm models serve
+        warm_free: dict[str, bool] = {}
+        for name in task_processors:
+            model_name, task_type = name.split(":", 1)
+            if model_name in usable_by_model and warm[model_name]:
+                has_slot = usable_by_model[model_name][self.class_of(task_type).name] > 0
+                warm_free[task_type] = warm_free.get(task_type, False) or has_slot
+        now = time.monotonic()
+        for task_type, has_slot in warm_free.items():
+            if has_slot:
+                self.warm_saturated_since.pop(task_type, None)
+            else:
+                self.warm_saturated_since.setdefault(task_type, now)
+
+        ranked = []
+        for name in task_processors:
+            model_name, task_type = name.split(":", 1)
+            if model_name not in usable_by_model or (model is not None and model_name != model):
+                continue
+            priority_class = self.class_of(task_type)
+            if usable_by_model[model_name][priority_class.name] <= 0:
+                continue
+            if not warm[model_name] and task_type in warm_free and (
+                    warm_free[task_type] or now - self.warm_saturated_since[task_type] < self.cold_model_delay
+            ):
+                continue
+            load = model_inflight.get(model_name, 0) / max(1, get_n_parallel(model_name))
+            ranked.append(((self.classes.index(priority_class), not warm[model_name], load), "llm2:" + name))
+        # sort is stable, so equally loaded models keep their order
+        ranked.sort(key=lambda item: item[0])
+        return [provider_id for _, provider_id in ranked]
+
+    def claimed(self, model: str, task_type: str, task: dict) -> float | None:
+        """Count a claimed task against its class and return how long it waited in the queue, if known."""
+        key = (model, self.class_of(task_type).name)
+        self.inflight[key] = self.inflight.get(key, 0) + 1
+
+        scheduled_at = task.get("scheduledAt")
+        if not isinstance(scheduled_at, (int, float)) or scheduled_at <= 0:
+            return None
+        return max(0.0, time.time() - scheduled_at)
+
+    def released(self, model: str, task_type: str) -> None:
+        key = (model, self.class_of(task_type).name)
+        self.inflight[key] = max(0, self.inflight.get(key, 0) - 1)
+
+
+def _build_priority_classes(config: list) -> list[PriorityClass]:
+    classes = []
+    for entry in config:
+        try:
+            classes.append(PriorityClass(
+                name=str(entry["name"]),
+                task_types=frozenset(entry.get("task_types", [])),
+                reserved=max(0, int(entry.get("reserved", 0))),
+            ))
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            logger.warning(f"Ignoring invalid priority class {entry!r}: {e}")
+    return classes
+
+
+def load_cold_model_delay() -> float:
+    try:
+        delay = float(os.getenv("COLD_MODEL_OFFER_DELAY", "30"))
+        if delay < 0:
+            raise ValueError
+        return delay
+    except (TypeError, ValueError):
+        logger.warning("Invalid COLD_MODEL_OFFER_DELAY env variable, falling back to default 30 seconds")
+        return 30.0
+
+
+def load_priority_classes() -> list[PriorityClass]:
+    raw = os.getenv("TASK_PRIORITY_CLASSES")
+    if raw:
+        try:
+            config = json.loads(raw)
+            if not isinstance(config, list):
+                raise ValueError("expected a list")
+            classes = _build_priority_classes(config)
+            if classes:
+                return classes
+            logger.warning("TASK_PRIORITY_CLASSES env variable defines no usable class, falling back to the defaults")
+        except (TypeError, ValueError) as e:
+            logger.warning(f"Invalid TASK_PRIORITY_CLASSES env variable, falling back to the defaults: {e}")
+    return _build_priority_classes(DEFAULT_PRIORITY_CLASSES)
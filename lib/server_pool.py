@@ -0,0 +1,429 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+"""Pool of llama-server subprocesses, one per model
+
+Servers are started on demand. Concurrent callers share one startup per model, and readiness
+is polled asynchronously, so a cold start never blocks the event loop or an executor thread.
+When a RAM budget is configured, starting a server evicts the least recently used servers that
+have no tasks in flight until the new one fits, and servers that stayed idle for longer than
+the idle timeout are stopped in the background.
+
+Servers listen on Unix domain sockets in a private runtime directory, which avoids the race
+between picking a free TCP port and the server binding it, and the TCP overhead per request.
+"""
+import asyncio
+import logging
+import os
+import secrets
+import subprocess
+import tempfile
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from threading import Event, Lock, Thread
+from typing import Any, Awaitable, Callable
+from urllib.parse import quote
+
+import niquests
+
+logger = logging.getLogger(__name__)
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        value = float(os.getenv(name, str(default)))
+        if value < 0:
+            raise ValueError(value)
+        return value
+    except (TypeError, ValueError):
+        logger.warning(f"Invalid {name} env variable, falling back to default {default}")
+        return default
+
+
+# 0 disables the limit
+SERVER_RAM_BUDGET_MB = _env_float('LLM_SERVER_RAM_BUDGET_MB', 0)
+# Seconds without tasks after which a server is stopped, 0 keeps servers running until shutdown
+SERVER_IDLE_TIMEOUT = _env_float('LLM_SERVER_IDLE_TIMEOUT', 0)
+
+
+class ServerLogPipe:
+    """Forward a subprocess pipe to the logger, keeping the last lines for error context."""
+    def __init__(self, model_name: str, tail_lines: int = 50) -> None:
+        self.prefix = f"[llama-cpp-server:{model_name}] "
+        self._tail: deque[str] = deque(maxlen=tail_lines)
+
+    def consume(self, stream) -> None:
+        try:
+            for line in stream:
+                line = line.rstrip()
+                self._tail.append(line)
+                logger.info(self.prefix + line)
+        except Exception:
+            pass
+
+    def tail(self) -> str:
+        return "\n".join(self._tail)
+
+
+_runtime_dir: str | None = None
+_runtime_dir_lock = Lock()
+
+
+def server_socket_path(model_name: str) -> str:
+    """A new Unix domain socket path for a model's server.
+
+    llama-server listens on a socket instead of a TCP port when its hostname ends with .sock.
+    The name is kept short, since socket paths are limited to about 100 bytes.
+    """
+    global _runtime_dir
+    with _runtime_dir_lock:
+        if _runtime_dir is None:
+            # Only readable by the app itself
+            _runtime_dir = tempfile.mkdtemp(prefix="llm2-", dir=os.getenv("XDG_RUNTIME_DIR"))
+    return os.path.join(_runtime_dir, f"{model_name[:32]}-{secrets.token_hex(4)}.sock")
+
+
+def unix_socket_url(path: str) -> str:
+    """Base URL of a server listening on a Unix domain socket, for niquests."""
+    return "http+unix://" + quote(path, safe="")
+
+
+async def wait_for_server(
+        proc: subprocess.Popen,
+        base_url: str,
+        log_pipe: ServerLogPipe,
+        timeout: float = 300.0,
+        initial_delay: float = 0.1,
+        max_delay: float = 2.0,
+) -> None:
+    """Poll the server's health endpoint with exponential backoff until it is ready."""
+    url = f"{base_url}/health"
+    deadline = time.monotonic() + timeout
+    delay = initial_delay
+    async with niquests.AsyncSession() as session:
+        while time.monotonic() < deadline:
+            exit_code = proc.poll()
+            if exit_code is not None:
+                raise RuntimeError(
+                    f"llama-server exited with code {exit_code} before becoming ready. "
+                    f"Last output:\n{log_pipe.tail()}"
+                )
+            try:
+                resp = await session.get(url, timeout=5)
+                if resp.status_code == 200:
+                    return
+            except Exception:
+                pass
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_delay)
+    raise RuntimeError(
+        f"llama-server at {base_url} did not become ready within {timeout}s. "
+        f"Last output:\n{log_pipe.tail()}"
+    )
+
+
+def stop_process(proc: subprocess.Popen, timeout: float = 15) -> None:
+    try:
+        proc.terminate()
+        proc.wait(timeout=timeout)
+    except Exception:
+        try:
+            proc.kill()
+        except Exception:
+            pass
+
+
+@dataclass
+class ModelServer:
+    model_name: str
+    proc: subprocess.Popen
+    # Root URL of the server, http+unix://... when it listens on a Unix domain socket
+    base_url: str
+    # The LangChain client talking to this server
+    llm: Any
+    log_pipe: ServerLogPipe
+    # The Unix domain socket the server listens on, removed once it stopped
+    socket_path: str | None = None
+    memory_bytes: int = 0
+    last_used: float = field(default_factory=time.monotonic)
+
+    def is_alive(self) -> bool:
+        return self.proc.poll() is None
+
+    def stop(self, timeout: float = 15) -> None:
+        logger.info(f"Stopping llama-cpp-server for {self.model_name}")
+        stop_process(self.proc, timeout)
+        if self.socket_path is not None:
+            try:
+                os.unlink(self.socket_path)
+            except FileNotFoundError:
+                pass
+
+
+class ServerPool:
+    """Keeps llama-server processes within a RAM budget, least recently used first out."""
+
+    def __init__(
+            self,
+            spawn_server: Callable[[str], ModelServer],
+            estimate_memory: Callable[[str], int],
+            ram_budget_bytes: int = 0,
+            idle_timeout: float = 0,
+            on_ready: Callable[[ModelServer], Awaitable[None]] | None = None,
+    ) -> None:
+        # Spawns the server process of a model without waiting for it to become ready
+        self._spawn_server = spawn_server
+        # Runs in the background every time a server became ready, e.g. to warm up caches
+        self._on_ready = on_ready
+        self._estimate_memory = estimate_memory
+        self.ram_budget_bytes = ram_budget_bytes
+        self.idle_timeout = idle_timeout
+        self._servers: dict[str, ModelServer] = {}
+        # model name -> estimated memory of servers that are being started right now
+        self._starting: dict[str, int] = {}
+        # model name -> spawned server that is not ready yet, so shutdown can stop it too
+        self._spawned: dict[str, ModelServer] = {}
+        # model name -> startup shared by every caller that needs the model while it is starting
+        self._startups: dict[str, asyncio.Task] = {}
+        self._background_tasks: set[asyncio.Task] = set()
+        self._inflight: dict[str, int] = {}
+        self._memory_estimates: dict[str, int] = {}
+        # Guards the bookkeeping; the idle reaper runs in its own thread
+        self._lock = Lock()
+        self._stopped = Event()
+        self._reaper: Thread | None = None
+
+    def get(self, model_name: str) -> ModelServer:
+        """Returns the running server of a model. Use start() to start it first."""
+        with self._lock:
+            server = self._running(model_name)
+            if server is None:
+                raise RuntimeError(f"llama-cpp-server for {model_name} is not running")
+            server.last_used = time.monotonic()
+            return server
+
+    async def start(self, model_name: str) -> ModelServer:
+        """Returns the running server of a model, starting it (and evicting others) if needed.
+
+        Concurrent callers for the same model wait for the same startup instead of spawning
+        a server each. Cancelling one caller does not cancel the startup for the others.
+        """
+        with self._lock:
+            server = self._running(model_name)
+            if server is not None:
+                server.last_used = time.monotonic()
+                return server
+
+        startup = self._startups.get(model_name)
+        if startup is None:
+            startup = asyncio.create_task(self._start(model_name))
+            self._startups[model_name] = startup
+            startup.add_done_callback(lambda _: self._startups.pop(model_name, None))
+        return await asyncio.shield(startup)
+
+    def preload(self, model_names: list[str]) -> None:
+        """Start the servers of the given models in the background, as far as the RAM budget allows."""
+        self._run_in_background(self._preload(model_names))
+
+    async def _preload(self, model_names: list[str]) -> None:
+        for model_name in model_names:
+            if self._stopped.is_set():
+                return
+            if not self.fits_without_eviction(model_name):
+                logger.info(f"Not preloading {model_name}, it does not fit into the RAM budget next to the loaded models")
+                continue
+            try:
+                await self.start(model_name)
+            except Exception as e:
+                logger.warning(f"Preloading {model_name} failed: {e}")
+
+    async def _start(self, model_name: str) -> ModelServer:
+        with self._lock:
+            memory = self._memory_of(model_name)
+            victims = self._take_eviction_victims(memory, exclude=model_name)
+            self._starting[model_name] = memory
+
+        try:
+            for victim in victims:
+                logger.info(f"Evicting llama-cpp-server for {victim.model_name} to free memory for {model_name}")
+                await asyncio.to_thread(victim.stop)
+
+            time_start = time.perf_counter()
+            server = await asyncio.to_thread(self._spawn_server, model_name)
+            with self._lock:
+                self._spawned[model_name] = server
+            try:
+                await wait_for_server(server.proc, server.base_url, server.log_pipe)
+            except BaseException:
+                await asyncio.to_thread(server.stop, 5)
+                raise
+            finally:
+                with self._lock:
+                    self._spawned.pop(model_name, None)
+            logger.info(
+                f"llama-cpp-server for {model_name} ready at {server.base_url} "
+                f"after {round(time.perf_counter() - time_start, 2)}s"
+            )
+        finally:
+            with self._lock:
+                self._starting.pop(model_name, None)
+
+        server.memory_bytes = memory
+        server.last_used = time.monotonic()
+        with self._lock:
+            self._servers[model_name] = server
+        self._ensure_reaper()
+        if self._on_ready is not None:
+            self._run_in_background(self._on_ready(server))
+        return server
+
+    def _run_in_background(self, coro: Awaitable[None]) -> None:
+        task = asyncio.ensure_future(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    def acquire(self, model_name: str) -> None:
+        """Marks a task as in flight on a model, which protects its server from eviction."""
+        with self._lock:
+            self._inflight[model_name] = self._inflight.get(model_name, 0) + 1
+            server = self._servers.get(model_name)
+            if server is not None:
+                server.last_used = time.monotonic()
+
+    def release(self, model_name: str) -> None:
+        with self._lock:
+            self._inflight[model_name] = max(0, self._inflight.get(model_name, 0) - 1)
+            server = self._servers.get(model_name)
+            if server is not None:
+                server.last_used = time.monotonic()
+
+    def is_running(self, model_name: str) -> bool:
+        with self._lock:
+            return self._running(model_name) is not None
+
+    def is_warm(self, model_name: str) -> bool:
+        """Whether the model's server is running or already starting, so its tasks pay no cold start of their own."""
+        with self._lock:
+            return self._running(model_name) is not None or model_name in self._starting
+
+    def fits_without_eviction(self, model_name: str) -> bool:
+        if not self.ram_budget_bytes:
+            return True
+        with self._lock:
+            if model_name in self._servers or model_name in self._starting:
+                return True
+            return self._used_bytes() + self._memory_of(model_name) <= self.ram_budget_bytes
+
+    def can_serve(self, model_name: str) -> bool:
+        """Whether a task for the model can start now without waiting for busy servers to finish.
+
+        True when the server is running, when it fits into the remaining budget,
+        or when enough idle servers can be evicted to make it fit.
+        """
+        if not self.ram_budget_bytes:
+            return True
+        with self._lock:
+            if model_name in self._servers or model_name in self._starting:
+                return True
+            memory = self._memory_of(model_name)
+            evictable = sum(
+                server.memory_bytes for name, server in self._servers.items()
+                if not self._inflight.get(name)
+            )
+            return self._used_bytes() - evictable + memory <= self.ram_budget_bytes
+
+    def evict_idle(self) -> None:
+        if not self.idle_timeout:
+            return
+        now = time.monotonic()
+        with self._lock:
+            victims = [
+                self._servers.pop(name)
+                for name, server in list(self._servers.items())
+                if not self._inflight.get(name) and now - server.last_used >= self.idle_timeout
+            ]
+        for victim in victims:
+            logger.info(f"llama-cpp-server for {victim.model_name} was idle for {self.idle_timeout}s")
+            victim.stop()
+
+    def state(self) -> dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "ram_budget_bytes": self.ram_budget_bytes,
+                "used_bytes": self._used_bytes(),
+                "servers": {
+                    name: {
+                        "base_url": server.base_url,
+                        "pid": server.proc.pid,
+                        "alive": server.is_alive(),
+                        "inflight": self._inflight.get(name, 0),
+                        "memory_bytes": server.memory_bytes,
+                        "idle_seconds": now - server.last_used,
+                    }
+                    for name, server in self._servers.items()
+                },
+                "starting": list(self._starting),
+            }
+
+    def stop_all(self) -> None:
+        self._stopped.set()
+        with self._lock:
+            servers = list(self._servers.values()) + list(self._spawned.values())
+            self._servers.clear()
+            self._spawned.clear()
+        for server in servers:
+            server.stop()
+
+    def _running(self, model_name: str) -> ModelServer | None:
+        server = self._servers.get(model_name)
+        if server is not None and not server.is_alive():
+            logger.warning(f"llama-cpp-server for {model_name} exited unexpectedly, it will be restarted")
+            del self._servers[model_name]
+            return None
+        return server
+
+    def _memory_of(self, model_name: str) -> int:
+        if model_name not in self._memory_estimates:
+            self._memory_estimates[model_name] = self._estimate_memory(model_name)
+        return self._memory_estimates[model_name]
+
+    def _used_bytes(self) -> int:
+        return sum(server.memory_bytes for server in self._servers.values()) + sum(self._starting.values())
+
+    def _take_eviction_victims(self, memory: int, exclude: str) -> list[ModelServer]:
+        """Removes least recently used idle servers from the pool until `memory` fits the budget."""
+        if not self.ram_budget_bytes:
+            return []
+        victims = []
+        candidates = sorted(
+            (server for name, server in self._servers.items() if name != exclude and not self._inflight.get(name)),
+            key=lambda server: server.last_used,
+        )
+        for server in candidates:
+            if self._used_bytes() + memory <= self.ram_budget_bytes:
+                break
+            victims.append(self._servers.pop(server.model_name))
+        if self._used_bytes() + memory > self.ram_budget_bytes:
+            logger.warning(
+                f"Starting llama-cpp-server for {exclude} exceeds the RAM budget of "
+                f"{self.ram_budget_bytes // (1024 * 1024)} MiB, all other servers are busy"
+            )
+        return victims
+
+    def _ensure_reaper(self) -> None:
+        if not self.idle_timeout:
+            return
+        with self._lock:
+            if self._reaper is not None:
+                return
+            self._reaper = Thread(target=self._reap, daemon=True)
+        self._reaper.start()
+
+    def _reap(self) -> None:
+        interval = min(30.0, max(1.0, self.idle_timeout / 4))
+        while not self._stopped.wait(interval):
+            try:
+                self.evict_idle()
+            except Exception:
+                logger.exception("Evicting idle llama-cpp-servers failed")
@@ -0,0 +1,81 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+"""Conversation-sticky slot routing of chat requests
+
+Every turn of a chat sends the conversation so far again. llama-server only skips the prefill of
+the part of a prompt that is still in the KV cache of the slot the request runs on, and with
+several slots the next turn often lands on another one and prefills the whole history again.
+
+Chat requests therefore carry a conversation key, a hash of the system prompt and the first
+user message, which stay the same across the turns of a conversation. The router pins each key
+to a slot and sends the conversation's requests there (`id_slot`). When the pinned slot is busy,
+the request moves to the free slot that was used least recently by the pinned conversations, and
+the key is pinned there from then on. When no slot is free, llama-server picks the slot.
+"""
+import hashlib
+import json
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator
+
+from langchain_core.runnables import Runnable
+
+from metrics import SLOT_ROUTES
+
+
+def conversation_key(system_prompt: str, first_message: str) -> str:
+    serialized = json.dumps([system_prompt, first_message], ensure_ascii=False)
+    return hashlib.sha256(serialized.encode("utf-8", "surrogatepass")).hexdigest()
+
+
+class SlotRouter:
+    """Pins conversations to the slots of one llama-server."""
+
+    def __init__(self, model_name: str, n_slots: int, capacity: int = 0) -> None:
+        self.model_name = model_name
+        self.n_slots = n_slots
+        # Most conversation keys to remember, older ones are forgotten first
+        self.capacity = capacity or 16 * n_slots
+        # conversation key -> slot, least recently used first
+        self._pins: OrderedDict[str, int] = OrderedDict()
+        # Routed requests running on each slot
+        self._busy = [0] * n_slots
+
+    def acquire(self, key: str) -> int:
+        """The slot for the next request of the conversation, -1 to let the server choose."""
+        slot = self._pins.get(key)
+        if slot is not None and not self._busy[slot]:
+            outcome = "pinned"
+        else:
+            free = [index for index in range(self.n_slots) if not self._busy[index]]
+            if not free:
+                SLOT_ROUTES.inc(model=self.model_name, outcome="all_busy")
+                return -1
+            outcome = "new" if slot is None else "moved"
+            # The slot whose cached conversation was continued least recently, unpinned slots first
+            last_used = {pinned: rank for rank, pinned in enumerate(self._pins.values())}
+            slot = min(free, key=lambda index: last_used.get(index, -1))
+        self._pins[key] = slot
+        self._pins.move_to_end(key)
+        while len(self._pins) > self.capacity:
+            self._pins.popitem(last=False)
+        self._busy[slot] += 1
+        SLOT_ROUTES.inc(model=self.model_name, outcome=outcome)
+        return slot
+
+    def release(self, slot: int) -> None:
+        if slot >= 0:
+            self._busy[slot] -= 1
+
+
+@contextmanager
+def pinned_to_slot(runnable: Runnable, router: SlotRouter | None, key: str) -> Iterator[Runnable]:
+    """`runnable` with its requests sent to the conversation's slot while the context is open."""
+    if router is None:
+        yield runnable
+        return
+    slot = router.acquire(key)
+    try:
+        yield runnable.bind(extra_body={"id_slot": slot, "cache_prompt": True}) if slot >= 0 else runnable
+    finally:
+        router.release(slot)
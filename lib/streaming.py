@@ -3,9 +3,10 @@
 from __future__ import annotations
 
 import asyncio
+import json
 from dataclasses import dataclass, field
 from time import monotonic
-from typing import Any, Awaitable, Callable
+from typing import Any, Awaitable, Callable, Protocol, runtime_checkable
 
 # langchain-openai's converters drop `reasoning_content` (emitted by llama.cpp's
 # deepseek reasoning format) from both streaming deltas and non-streaming
@@ -80,14 +81,52 @@ def extract_reasoning_content(value: Any) -> str:
     return ""
 
 
+@dataclass
+class StreamStats:
+    sent: int = 0
+    sent_bytes: int = 0
+    # Updates replaced by a newer one before they could be sent
+    dropped: int = 0
+    # Time from an update until the POST carrying it finished
+    max_lag: float = 0.0
+    total_lag: float = 0.0
+    # Smoothed round-trip time of the POSTs
+    rtt: float = 0.0
+
+    @property
+    def mean_lag(self) -> float:
+        return self.total_lag / self.sent if self.sent else 0.0
+
+
 @dataclass
 class StreamContext:
+    """Streams the growing output of one task.
+
+    Updates only bump a version; a single sender task POSTs the latest state, one request
+    at a time, so a slow server gets fewer but never stale or reordered updates. The
+    interval between updates follows the round-trip time and the token rate, within
+    `min_stream_interval` and `max_stream_interval`.
+    """
     stream_result: Callable[[dict[str, Any]], Awaitable[None] | None] | None = None
     progress_callback: Callable[[float], Awaitable[Any] | Any] | None = None
     stream_interval_seconds: float = 0.75
+    min_stream_interval: float = 0.25
+    max_stream_interval: float = 3.0
+    # Aim for about this many new tokens per update when tokens arrive slowly
+    tokens_per_update: int = 12
     current_output: dict[str, Any] = field(default_factory=dict)
+    stats: StreamStats = field(default_factory=StreamStats)
+    _version: int = field(default=0, init=False)
+    _sent_version: int = field(default=0, init=False)
+    # Version the sender should send next, and when it was requested
+    _requested_version: int = field(default=0, init=False)
+    _requested_at: float = field(default=0.0, init=False)
     _last_emit_at: float = field(default=0.0, init=False)
-    _last_emitted_output: dict[str, Any] | None = field(default=None, init=False)
+    _sender: asyncio.Task | None = field(default=None, init=False)
+    # Version of the POST in flight, 0 when none is
+    _sending_version: int = field(default=0, init=False)
+    _token_rate: float = field(default=0.0, init=False)
+    _last_token_at: float = field(default=0.0, init=False)
 
     @property
     def enabled(self) -> bool:
@@ -95,9 +134,9 @@ class StreamContext:
 
     def update_output(self, output: dict[str, Any] | None = None, *, force: bool = False, **extra: Any) -> None:
         if output:
-            self.current_output.update(output)
+            self._set_all(output)
         if extra:
-            self.current_output.update(extra)
+            self._set_all(extra)
         self.emit(force=force)
 
     def update_text(
@@ -108,32 +147,99 @@ class StreamContext:
         force: bool = False,
         **extra_output: Any,
     ) -> None:
-        self.current_output[key] = text
+        self._set(key, text)
         if extra_output:
-            self.current_output.update(extra_output)
+            self._set_all(extra_output)
         self.emit(force=force)
 
+    def _set_all(self, values: dict[str, Any]) -> None:
+        for key, value in values.items():
+            self._set(key, value)
+
+    def _set(self, key: str, value: Any) -> None:
+        if key not in self.current_output or self.current_output[key] != value:
+            self.current_output[key] = value
+            self._version += 1
+
+    def note_tokens(self, count: int = 1) -> None:
+        """Feeds the token rate that the update interval adapts to."""
+        now = monotonic()
+        if self._last_token_at:
+            elapsed = max(now - self._last_token_at, 1e-3)
+            self._token_rate = 0.9 * self._token_rate + 0.1 * (count / elapsed) if self._token_rate else count / elapsed
+        self._last_token_at = now
+
+    @property
+    def interval(self) -> float:
+        interval = self.stream_interval_seconds
+        if self._token_rate:
+            interval = self.tokens_per_update / self._token_rate
+        # Never ask for updates faster than the server can take them
+        interval = max(interval, 2 * self.stats.rtt)
+        return min(self.max_stream_interval, max(self.min_stream_interval, interval))
+
+    def emit_due(self) -> bool:
+        """Whether an update passed to update_output()/update_text() now would be sent soon."""
+        if not self.stream_result or self._sending_version:
+            return False
+        return not self._last_emit_at or monotonic() - self._last_emit_at >= self.interval
+
     def emit(self, *, force: bool = False) -> None:
         if not self.stream_result:
             return
 
-        if not self.current_output:
+        if not self.current_output or self._version == self._sent_version:
             return
 
         now = monotonic()
-        if not force and self._last_emit_at and now - self._last_emit_at < self.stream_interval_seconds:
+        if not force and self._last_emit_at and now - self._last_emit_at < self.interval:
             return
 
-        payload = dict(self.current_output)
-        if payload == self._last_emitted_output:
+        if not asyncio.iscoroutinefunction(self.stream_result):
+            self.stream_result(dict(self.current_output))
+            self._last_emit_at = now
+            self._sent_version = self._version
             return
 
-        if asyncio.iscoroutinefunction(self.stream_result):
-            asyncio.ensure_future(self.stream_result(payload))
+        if self._requested_version > max(self._sent_version, self._sending_version):
+            # The previous update has not been sent yet and is superseded by this one
+            self.stats.dropped += 1
         else:
-            self.stream_result(payload)
+            self._requested_at = now
+        self._requested_version = self._version
         self._last_emit_at = now
-        self._last_emitted_output = payload
+        if self._sender is None or self._sender.done():
+            self._sender = asyncio.ensure_future(self._send_latest())
+
+    async def _send_latest(self) -> None:
+        while self.stream_result and self._requested_version > self._sent_version:
+            version = self._version
+            requested_at = self._requested_at
+            # The payload is only copied right before sending, so superseded updates cost nothing
+            payload = dict(self.current_output)
+            self._sending_version = version
+            start = monotonic()
+            try:
+                await self.stream_result(payload)
+            finally:
+                self._sending_version = 0
+            now = monotonic()
+            rtt = now - start
+            self.stats.rtt = 0.8 * self.stats.rtt + 0.2 * rtt if self.stats.rtt else rtt
+            self.stats.sent += 1
+            self.stats.sent_bytes += len(json.dumps(payload, default=str))
+            lag = now - requested_at
+            self.stats.total_lag += lag
+            self.stats.max_lag = max(self.stats.max_lag, lag)
+            self._sent_version = version
+
+    async def flush(self) -> None:
+        """Waits until the latest update was sent, e.g. before the final result is reported."""
+        if self._sender is not None and not self._sender.done():
+            try:
+                await self._sender
+            except Exception:
+                pass
 
     def set_progress(self, progress: float) -> Any:
         if self.progress_callback is None:
@@ -145,6 +251,91 @@ class StreamContext:
         return result
 
 
+class StreamAccumulator:
+    """Collects streamed deltas; the text is only joined when it is read."""
+
+    def __init__(self) -> None:
+        self._parts: list[str] = []
+        self._text = ""
+
+    def __bool__(self) -> bool:
+        return bool(self._text) or bool(self._parts)
+
+    def append(self, delta: str) -> None:
+        self._parts.append(delta)
+
+    @property
+    def text(self) -> str:
+        if self._parts:
+            self._text += "".join(self._parts)
+            self._parts.clear()
+        return self._text
+
+
+@runtime_checkable
+class IncrementalTransform(Protocol):
+    """Builds the streamed payload from the text deltas, without rescanning the whole text."""
+
+    def push(self, delta: str) -> None:
+        ...
+
+    def payload(self) -> dict[str, Any] | None:
+        ...
+
+
+class _FullTextTransform:
+    """Adapts a transform of the full text to IncrementalTransform; it only runs when a payload is needed."""
+
+    def __init__(self, transform: Callable[[str], dict[str, Any] | None]) -> None:
+        self.transform = transform
+        self.text = StreamAccumulator()
+
+    def push(self, delta: str) -> None:
+        self.text.append(delta)
+
+    def payload(self) -> dict[str, Any] | None:
+        return self.transform(self.text.text)
+
+
+def _send_stream_update(
+    context: StreamContext,
+    text: StreamAccumulator,
+    reasoning: StreamAccumulator,
+    extra_output: dict[str, Any],
+    *,
+    final: bool,
+    output_key: str,
+    stream_text_transform: Callable[[str], str] | None,
+    payload_transform: IncrementalTransform | None,
+    suppress_empty_stream_updates: bool,
+) -> None:
+    reasoning_text = reasoning.text
+    stream_extra = dict(extra_output)
+    if reasoning_text:
+        stream_extra["reasoning"] = reasoning_text
+
+    if payload_transform is not None:
+        streamed_payload = payload_transform.payload()
+        if streamed_payload is None:
+            if reasoning_text:
+                context.update_output({"reasoning": reasoning_text, **extra_output}, force=final)
+            return
+        if stream_extra:
+            streamed_payload.update(stream_extra)
+        if suppress_empty_stream_updates and not streamed_payload:
+            return
+        context.update_output(streamed_payload, force=final)
+        return
+
+    output = text.text
+    streamed_output = stream_text_transform(output) if stream_text_transform else output
+    if not final and suppress_empty_stream_updates and streamed_output == "":
+        if reasoning_text:
+            context.update_output({"reasoning": reasoning_text, **extra_output})
+        return
+    context.update_text(streamed_output, key=output_key, force=final, **stream_extra)
+
+
 async def run_runnable_with_streaming(
     runnable: Any,
     messages: list[Any],
@@ -152,18 +343,46 @@ async def run_runnable_with_streaming(
     *,
     output_key: str = "output",
     stream_text_transform: Callable[[str], str] | None = None,
-    stream_payload_transform: Callable[[str], dict[str, Any] | None] | None = None,
+    stream_payload_transform: Callable[[str], dict[str, Any] | None] | IncrementalTransform | None = None,
     suppress_empty_stream_updates: bool = False,
     reasoning_sink: dict[str, str] | None = None,
+    chunk_sink: Callable[[Any], None] | None = None,
     **extra_output: Any,
 ) -> str:
+    """Runs the runnable, streaming the growing output to the context if it is enabled.
+
+    Every chunk costs amortized constant time: the text is only joined and transformed when
+    the context is due to send an update. `stream_payload_transform` is either a function of
+    the full text or an IncrementalTransform that is fed the deltas. `chunk_sink` receives
+    every streamed chunk (or the complete message), e.g. to collect native tool calls.
+    """
     capture_reasoning = reasoning_sink is not None
 
     if context and context.enabled:
-        text_parts: list[str] = []
-        reasoning_parts: list[str] = []
+        text = StreamAccumulator()
+        reasoning = StreamAccumulator()
+        payload_transform: IncrementalTransform | None = None
+        if isinstance(stream_payload_transform, IncrementalTransform):
+            payload_transform = stream_payload_transform
+        elif stream_payload_transform is not None:
+            payload_transform = _FullTextTransform(stream_payload_transform)
+
+        def send_update(final: bool) -> None:
+            _send_stream_update(
+                context,
+                text,
+                reasoning,
+                extra_output,
+                final=final,
+                output_key=output_key,
+                stream_text_transform=stream_text_transform,
+                payload_transform=payload_transform,
+                suppress_empty_stream_updates=suppress_empty_stream_updates,
+            )
 
         async for chunk in runnable.astream(messages):
+            if chunk_sink is not None:
+                chunk_sink(chunk)
             text_chunk = extract_text_content(chunk)
             reasoning_chunk = extract_reasoning_content(chunk) if capture_reasoning else ""
 
@@ -171,72 +390,24 @@ async def run_runnable_with_streaming(
                 continue
 
             if text_chunk:
-                text_parts.append(text_chunk)
+                context.note_tokens()
+                text.append(text_chunk)
+                if payload_transform is not None:
+                    payload_transform.push(text_chunk)
             if reasoning_chunk:
-                reasoning_parts.append(reasoning_chunk)
-
-            output = "".join(text_parts)
-            reasoning = "".join(reasoning_parts)
-
-            stream_extra = dict(extra_output)
-            if capture_reasoning and reasoning:
-                stream_extra["reasoning"] = reasoning
-
-            if stream_payload_transform:
-                streamed_payload = stream_payload_transform(output)
-                if streamed_payload is None:
-                    if capture_reasoning and reasoning:
-                        context.update_output({"reasoning": reasoning, **extra_output})
-                    continue
-                if stream_extra:
-                    streamed_payload.update(stream_extra)
-                if suppress_empty_stream_updates and not streamed_payload:
-                    continue
-                context.update_output(streamed_payload)
-                continue
+                reasoning.append(reasoning_chunk)
 
-            streamed_output = stream_text_transform(output) if stream_text_transform else output
-            if suppress_empty_stream_updates and streamed_output == "":
-                if capture_reasoning and reasoning:
-                    context.update_output({"reasoning": reasoning, **extra_output})
-                continue
-            context.update_text(
-                streamed_output,
-                key=output_key,
-                **stream_extra,
-            )
+            if context.emit_due():
+                send_update(final=False)
 
-        output = "".join(text_parts)
-        reasoning_final = "".join(reasoning_parts)
         if capture_reasoning:
-            reasoning_sink["reasoning"] = reasoning_final
-
-        stream_extra_final = dict(extra_output)
-        if capture_reasoning and reasoning_final:
-            stream_extra_final["reasoning"] = reasoning_final
-
-        if stream_payload_transform:
-            streamed_payload = stream_payload_transform(output)
-            if streamed_payload is None:
-                if capture_reasoning and reasoning_final:
-                    context.update_output({"reasoning": reasoning_final, **extra_output}, force=True)
-                return output
-            if stream_extra_final:
-                streamed_payload.update(stream_extra_final)
-            if not suppress_empty_stream_updates or streamed_payload:
-                context.update_output(streamed_payload, force=True)
-            return output
-
-        streamed_output = stream_text_transform(output) if stream_text_transform else output
-        context.update_text(
-            streamed_output,
-            key=output_key,
-            force=True,
-            **stream_extra_final,
-        )
-        return output
+            reasoning_sink["reasoning"] = reasoning.text
+        send_update(final=True)
+        return text.text
 
     result = await runnable.ainvoke(messages)
+    if chunk_sink is not None:
+        chunk_sink(result)
     if capture_reasoning:
         reasoning_sink["reasoning"] = extract_reasoning_content(result)
     return extract_text_content(result)
@@ -1,19 +1,22 @@
 # SPDX-FileCopyrightText: 2024 Nextcloud GmbH and Nextcloud contributors
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import asyncio
+from functools import partial
 from typing import Any
-from langchain.schema.messages import HumanMessage, SystemMessage
+from langchain.schema.messages import BaseMessage, HumanMessage, SystemMessage
 from langchain.prompts import PromptTemplate
 from langchain.schema.prompt_template import BasePromptTemplate
 from langchain_core.runnables import Runnable
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 
-from streaming import StreamContext, run_runnable_with_streaming
+from prefix_cache import PREFIX_SENTINEL
+from streaming import StreamContext, extract_text_content, run_runnable_with_streaming
+from task_slots import gather_with_task_slots
+from text_splitter import EstimatingTokenizer, TokenBudgetSplitter, chunk_token_budget
 
 
 class SummarizeProcessor:
     runnable: Runnable
-    text_splitter: RecursiveCharacterTextSplitter
 
     user_prompt: BasePromptTemplate = PromptTemplate(
         input_variables=["input"],
@@ -36,16 +39,19 @@ Summaries to combine:
 """
     )
 
-    def __init__(self, runnable: Runnable, n_ctx: int = 8000):
+    def __init__(
+            self,
+            runnable: Runnable,
+            n_ctx: int = 8000,
+            n_parallel: int = 1,
+            max_tokens: int = 2048,
+            tokenizer: Any = None,
+    ):
         self.runnable = runnable
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            separators=['\n\n|\\.|\\?|\\!'],
-            is_separator_regex=True,
-            chunk_size=n_ctx/4,
-            keep_separator=True,
-            chunk_overlap=600,
-            length_function=len,
-        )
+        self.n_ctx = n_ctx
+        self.n_parallel = max(1, n_parallel)
+        self.max_tokens = max_tokens
+        self.tokenizer = tokenizer if tokenizer is not None else EstimatingTokenizer()
 
     def _build_system_prompt(self, format: str, complexity: str) -> str:
         prompt = (
@@ -65,14 +71,22 @@ Summaries to combine:
             prompt += "Use simple language and vocabulary appropriate for a 5 year old. "
         return prompt
 
+    def cache_prefix_messages(self) -> list[BaseMessage]:
+        return [
+            SystemMessage(content=self._build_system_prompt("auto", "medium")),
+            HumanMessage(content=self.user_prompt.format(input=PREFIX_SENTINEL)),
+        ]
+
     async def __call__(self, inputs: dict[str, Any], context: StreamContext | None = None) -> dict[str, Any]:
         system_prompt = self._build_system_prompt(
             inputs.get("format", "auto"),
             inputs.get("complexity", "medium"),
         )
 
-        # Split text if needed
-        splits = self.text_splitter.split_text(inputs['input'])
+        # Split text if needed; chunks and merge batches share the same token budget
+        chunk_tokens = await self._chunk_tokens(system_prompt)
+        splitter = TokenBudgetSplitter(self.tokenizer, chunk_tokens, overlap_tokens=150)
+        splits = await splitter.split_text(inputs['input'])
         total_splits = len(splits)
 
         if len(splits) == 1:
@@ -87,26 +101,37 @@ Summaries to combine:
             )
             return {'output': output}
 
-        # Process each split
-        summaries = []
-        for index, split in enumerate(splits, start=1):
-            messages = [
-                SystemMessage(content=system_prompt),
-                HumanMessage(content=self.user_prompt.format(input=split))
-            ]
-            output = await self.runnable.ainvoke(messages)
-            summaries.append(output.content)
-            if context:
-                context.set_progress(index / (total_splits + 1) * 50)
-
-        # Merge summaries
+        progress = _Progress(total_splits, context)
+
+        # Map: summarize the chunks concurrently, on as many slots of the model as the task can borrow
+        summaries = await gather_with_task_slots([
+            partial(self._summarize_node, progress, system_prompt, self.user_prompt.format(input=split))
+            for split in splits
+        ], self.n_parallel)
+
+        # Reduce: merge the summaries in batches that fit the context, level by level, until one batch is left
+        while True:
+            groups = await self._group_for_merge(summaries, chunk_tokens)
+            if len(groups) == 1:
+                break
+            merges = [index for index, group in enumerate(groups) if len(group) > 1]
+            progress.add_nodes(len(merges))
+            merged = await gather_with_task_slots([
+                partial(
+                    self._summarize_node, progress, system_prompt,
+                    self.merge_prompt.format(input="\n\n".join(groups[index])),
+                )
+                for index in merges
+            ], self.n_parallel)
+            summaries = [group[0] for group in groups]
+            for index, summary in zip(merges, merged):
+                summaries[index] = summary
+
+        # The last merge is streamed to the user
         messages = [
             SystemMessage(content=system_prompt),
-            HumanMessage(content=self.merge_prompt.format(input="\n\n".join(summaries)))
+            HumanMessage(content=self.merge_prompt.format(input="\n\n".join(groups[0])))
         ]
-        if context:
-            context.set_progress(total_splits / (total_splits + 1) * 50 + 50)
-
         final_output = await run_runnable_with_streaming(
             self.runnable,
             messages,
@@ -117,3 +142,75 @@ Summaries to combine:
             context.set_progress(100)
 
         return {'output': final_output}
+
+    async def _summarize_node(
+            self,
+            progress: "_Progress",
+            system_prompt: str,
+            user_prompt: str,
+    ) -> str:
+        output = await self.runnable.ainvoke([
+            SystemMessage(content=system_prompt),
+            HumanMessage(content=user_prompt),
+        ])
+        progress.node_done()
+        return extract_text_content(output)
+
+    async def _chunk_tokens(self, system_prompt: str) -> int:
+        """Token budget for the text of one request, next to the longer of the two prompts."""
+        overhead = await self.tokenizer.count(system_prompt) + max(
+            await self.tokenizer.count(self.user_prompt.format(input="")),
+            await self.tokenizer.count(self.merge_prompt.format(input="")),
+        )
+        return chunk_token_budget(self.n_ctx, self.n_parallel, overhead, self.max_tokens)
+
+    async def _group_for_merge(self, summaries: list[str], budget: int) -> list[list[str]]:
+        """Split the summaries into consecutive batches whose combined token count fits the budget.
+
+        Every batch but a leftover last one holds at least two summaries, so each level of the reduction
+        shrinks. A leftover summary joins the previous batch only if that still fits the budget, otherwise
+        it is paired with the last summary of that batch or passed on to the next level unchanged.
+        """
+        sizes = await asyncio.gather(*(self.tokenizer.count(summary) for summary in summaries))
+        groups: list[list[str]] = []
+        group_sizes: list[list[int]] = []
+        current: list[str] = []
+        current_sizes: list[int] = []
+        for summary, size in zip(summaries, sizes):
+            if len(current) >= 2 and sum(current_sizes) + size > budget:
+                groups.append(current)
+                group_sizes.append(current_sizes)
+                current, current_sizes = [], []
+            current.append(summary)
+            current_sizes.append(size)
+        if len(current) == 1 and groups:
+            if sum(group_sizes[-1]) + current_sizes[0] <= budget:
+                groups[-1].append(current.pop())
+            elif len(groups[-1]) > 2 and group_sizes[-1][-1] + current_sizes[0] <= budget:
+                current.insert(0, groups[-1].pop())
+        if current:
+            groups.append(current)
+        return groups
+
+
+class _Progress:
+    """Reports progress per completed map or merge node; the final merge counts as the last node."""
+
+    def __init__(self, leaves: int, context: StreamContext | None):
+        self.context = context
+        self.done = 0
+        self.expected = leaves + 1
+        self.reported = 0.0
+
+    def add_nodes(self, merges: int) -> None:
+        self.expected += merges
+
+    def node_done(self) -> None:
+        self.done += 1
+        if self.context is None:
+            return
+        # Intermediate merge levels are only known once they start, so never report a lower value
+        progress = min(99.0, self.done / self.expected * 100)
+        if progress > self.reported:
+            self.reported = progress
+            self.context.set_progress(progress)
@@ -6,19 +6,21 @@
 import json
 import logging
 import os
-import socket
 import subprocess
 import sys
-import time
-from collections import deque
-from functools import cache
-from threading import Thread
+from dataclasses import dataclass
+from threading import Lock, Thread
+from typing import Any, Callable
 
-import niquests
+import httpx
+from langchain_core.runnables import Runnable
 from langchain_openai import ChatOpenAI
 from nc_py_api.ex_app import persistent_storage
 
+from metrics import GENERATION_METRICS
+
 from chat import ChatProcessor
+from chat_history import ChatHistoryWindow
 from free_prompt import FreePromptProcessor
 from headline import HeadlineProcessor
 from contextwrite import ContextWriteProcessor
@@ -31,120 +33,250 @@ from chatwithtools import ChatWithToolsProcessor
 from topics import TopicsProcessor
 from summarize import SummarizeProcessor
 from reformat_paragraphs import ReformatParagraphsProcessor
+from remote_backends import Endpoint, RemoteBackend, parse_endpoints
+from prefix_cache import PREFIX_KV_CACHE, processor_prefix_messages, slot_save_path, warm_prefix_cache
+from slot_routing import SlotRouter
+from server_pool import (
+    SERVER_IDLE_TIMEOUT, SERVER_RAM_BUDGET_MB, ModelServer, ServerLogPipe, ServerPool, server_socket_path,
+    unix_socket_url,
+)
+from text_splitter import ServerTokenizer, chunk_token_budget
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 models_folder_path = os.path.join(dir_path , "../models/")
 
-# Maps file_name -> (Popen, port) for cleanup on shutdown
-_server_processes: dict[str, tuple[subprocess.Popen, int]] = {}
-
 logger = logging.getLogger(__name__)
 
 
-class _ServerLogPipe:
-    """Forward a subprocess pipe to the logger, keeping the last lines for error context."""
-    def __init__(self, model_name: str, tail_lines: int = 50) -> None:
-        self.prefix = f"[llama-cpp-server:{model_name}] "
-        self._tail: deque[str] = deque(maxlen=tail_lines)
+@dataclass
+class _ModelConfigEntry:
+    path: str
+    mtime: float
+    config: dict
 
-    def consume(self, stream) -> None:
-        try:
-            for line in stream:
-                line = line.rstrip()
-                self._tail.append(line)
-                logger.info(self.prefix + line)
-        except Exception:
-            pass
 
-    def tail(self) -> str:
-        return "\n".join(self._tail)
+# model name -> parsed config, plus the source file and its mtime to detect changes.
+# Read by the scheduler on every polling iteration, so lookups must not touch the filesystem.
+_model_configs: dict[str, _ModelConfigEntry] = {}
+# The default config file is shared by all models without their own config file
+_default_configs: dict[str, _ModelConfigEntry] = {}
+_model_configs_lock = Lock()
 
 
-def get_model_config(file_name):
-    file_name = file_name.split('.gguf')[0]
-    if os.path.exists(os.path.join(models_folder_path, file_name + ".json")):
-        model_config_path = os.path.join(models_folder_path, file_name + ".json")
-        with open(model_config_path, "r") as f:
-            model_config = json.load(f)
-    elif os.path.exists(os.path.join(persistent_storage(), file_name + ".json")):
-        model_config_path = os.path.join(persistent_storage(), file_name + ".json")
-        with open(model_config_path, "r") as f:
-            model_config = json.load(f)
+def _model_config_path(model_name: str) -> tuple[str, bool]:
+    """Returns the config file for a model and whether it is the shared default config."""
+    for folder in (models_folder_path, persistent_storage()):
+        path = os.path.join(folder, model_name + ".json")
+        if os.path.exists(path):
+            return path, False
+    return os.path.join(dir_path, "../default_config", "config.json"), True
+
+
+def _read_json(path: str, mtime: float, cache: dict[str, _ModelConfigEntry]) -> dict:
+    entry = cache.get(path)
+    if entry is None or entry.mtime != mtime:
+        with open(path, "r") as f:
+            entry = _ModelConfigEntry(path, mtime, json.load(f))
+        cache[path] = entry
+    return entry.config
+
+
+def _load_model_config(model_name: str) -> _ModelConfigEntry:
+    path, is_default = _model_config_path(model_name)
+    mtime = os.path.getmtime(path)
+    entry = _model_configs.get(model_name)
+    if entry is not None and entry.path == path and entry.mtime == mtime:
+        return entry
+
+    if is_default:
+        default_config = _read_json(path, mtime, _default_configs)
+        model_config = default_config.get(model_name, default_config['default'])
     else:
-        model_config_path = os.path.join(dir_path, "../default_config", "config.json")
-        with open(model_config_path, "r") as f:
-            default_config = json.load(f)
+        with open(path, "r") as f:
+            model_config = json.load(f)
+    entry = _ModelConfigEntry(path, mtime, model_config)
+    _model_configs[model_name] = entry
+    return entry
 
-        if file_name in default_config:
-            model_config = default_config[file_name]
-        else:
-            model_config = default_config['default']
-    return model_config
+
+def get_model_config(file_name: str, revalidate: bool = False) -> dict:
+    """Returns the config of a model from the in-memory registry.
+
+    The config file is only read on first use, when `revalidate` is set and its mtime changed,
+    or after refresh_model_configs() noticed a change. Returned dicts must not be mutated.
+    """
+    model_name = file_name.split('.gguf')[0]
+    entry = _model_configs.get(model_name)
+    if entry is not None and not revalidate:
+        return entry.config
+    with _model_configs_lock:
+        return _load_model_config(model_name).config
+
+
+def refresh_model_configs() -> None:
+    """Re-check the config files of all known models and reload the ones that changed."""
+    with _model_configs_lock:
+        for model_name in list(_model_configs):
+            try:
+                _load_model_config(model_name)
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Failed to reload the config of {model_name}, keeping the previous one: {e}")
 
 
 def get_n_parallel(model_name: str) -> int:
+    backend = remote_backend(model_name)
+    if backend is not None:
+        return backend.slots
     return get_model_config(model_name)["loader_config"].get("n_parallel", 1)
 
 
-def _find_free_port() -> int:
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind(("127.0.0.1", 0))
-        return s.getsockname()[1]
+# Loader config keys that change what a model generates for the same prompt
+_SAMPLING_KEYS = ("temperature", "top_p", "top_k", "min_p", "max_tokens", "stop", "seed", "reasoning_budget", "chat_template")
 
 
-def _wait_for_server(proc: subprocess.Popen, port: int, log_pipe: _ServerLogPipe, timeout: float = 300.0) -> None:
-    url = f"http://127.0.0.1:{port}/health"
-    deadline = time.monotonic() + timeout
-    while time.monotonic() < deadline:
-        exit_code = proc.poll()
-        if exit_code is not None:
-            raise RuntimeError(
-                f"llama-server exited with code {exit_code} before becoming ready. "
-                f"Last output:\n{log_pipe.tail()}"
-            )
-        try:
-            resp = niquests.get(url, timeout=5)
-            if resp.status_code == 200:
-                return
-        except Exception:
-            pass
-        time.sleep(2)
-    raise RuntimeError(
-        f"llama-server on port {port} did not become ready within {timeout}s. "
-        f"Last output:\n{log_pipe.tail()}"
+# Generation parameters a task type can override per request, see task_profile()
+_PROFILE_KEYS = ("max_tokens", "temperature", "top_p", "stop", "seed")
+
+# Short outputs get short budgets, so a runaway generation doesn't hold a slot for long.
+# A model config overrides these with its own "task_profiles".
+DEFAULT_TASK_PROFILES: dict[str, dict[str, Any]] = {
+    "core:text2text:headline": {"max_tokens": 100},
+    "core:text2text:topics": {"max_tokens": 200},
+    "core:text2text:proofread": {"max_tokens": 1024},
+}
+
+
+def task_profile(model_config: dict, task_type: str) -> dict[str, Any]:
+    """Generation parameters for the requests of a task type, applied on top of the loader config.
+
+    Stop sequences add to the loader config's. The default budgets leave room for a
+    positive `reasoning_budget` of the model on top.
+    """
+    loader_config = model_config["loader_config"]
+    profile = dict(DEFAULT_TASK_PROFILES.get(task_type, {}))
+    reasoning_budget = loader_config.get("reasoning_budget", 0)
+    if "max_tokens" in profile and isinstance(reasoning_budget, int) and reasoning_budget > 0:
+        profile["max_tokens"] += reasoning_budget
+    overrides = (model_config.get("task_profiles") or {}).get(task_type) or {}
+    for key, value in overrides.items():
+        if key in _PROFILE_KEYS:
+            profile[key] = value
+        else:
+            logger.warning(f"Ignoring unknown key {key} in the task profile for {task_type}")
+    if "max_tokens" in profile and loader_config.get("max_tokens"):
+        profile["max_tokens"] = min(profile["max_tokens"], loader_config["max_tokens"])
+    if profile.get("stop"):
+        profile["stop"] = list(dict.fromkeys([*(loader_config.get("stop") or []), *profile["stop"]]))
+    return profile
+
+
+def _max_tokens(model_config: dict, task_type: str) -> int:
+    return task_profile(model_config, task_type).get("max_tokens", model_config["loader_config"].get("max_tokens", 2048))
+
+
+def _history_window(llm: ChatOpenAI, model_config: dict, task_type: str) -> ChatHistoryWindow:
+    """Fits chat histories into `history_token_budget` of the model config, by default what a slot
+    holds next to the answer."""
+    loader_config = model_config["loader_config"]
+    budget = model_config.get("history_token_budget") or chunk_token_budget(
+        loader_config["n_ctx"], loader_config.get("n_parallel", 1), 0, _max_tokens(model_config, task_type),
     )
+    return ChatHistoryWindow(llm, _tokenizer_for(llm), budget, summary_tokens=min(512, budget // 8))
 
 
-_SERVER_SCRIPT_PATH = os.path.join(dir_path, "llama_server.py")
+def deterministic_sampling(model_name: str, task_type: str) -> bool:
+    """Whether the task type's requests always generate the same text for the same prompt.
 
+    That is the case with greedy sampling (temperature 0) or a fixed seed in the task profile.
+    Only such results are cached, otherwise a regenerated task would get the same text again.
+    """
+    model_config = get_model_config(model_name)
+    profile = task_profile(model_config, task_type)
+    temperature = profile.get("temperature", model_config["loader_config"].get("temperature", 0.7))
+    seed = profile.get("seed")
+    return temperature == 0 or (isinstance(seed, int) and seed >= 0)
 
-@cache
-def generate_chat_model(file_name: str) -> ChatOpenAI:
-    model_config = get_model_config(file_name)
+
+def result_cache_scope(model_name: str, task_type: str) -> dict[str, Any]:
+    """Identifies the model file and its sampling config for the task type for the result cache."""
+    path = _model_path(model_name + ".gguf")
+    try:
+        stat = os.stat(path)
+        file_identity = f"{os.path.basename(path)}:{stat.st_size}:{int(stat.st_mtime)}"
+    except OSError:
+        file_identity = os.path.basename(path)
+    model_config = get_model_config(model_name)
     loader_config = model_config["loader_config"]
+    return {
+        "model": file_identity,
+        "sampling": {key: loader_config.get(key) for key in _SAMPLING_KEYS},
+        "profile": task_profile(model_config, task_type),
+    }
+
+
+_SERVER_SCRIPT_PATH = os.path.join(dir_path, "llama_server.py")
+# model alias -> root URL of its local server, whose chat model client only knows a placeholder host
+_server_urls: dict[str, str] = {}
+
 
+def _model_path(file_name: str) -> str:
     path = os.path.join(models_folder_path, file_name)
     if not os.path.exists(path):
         path = os.path.join(persistent_storage(), file_name)
+    return path
+
+
+def _estimate_server_memory(model_name: str) -> int:
+    """RAM a llama-server for the model is expected to take, for the server pool's budget.
+
+    Uses `memory_mb` from the loader config when set, otherwise the size of the GGUF and of the
+    draft model's GGUF plus 20% for the KV cache and buffers.
+    """
+    loader_config = get_model_config(model_name)["loader_config"]
+    if loader_config.get("memory_mb"):
+        return int(loader_config["memory_mb"] * 1024 * 1024)
+    paths = [_model_path(model_name + ".gguf")]
+    if loader_config.get("draft_model"):
+        paths.append(_model_path(loader_config["draft_model"]))
+    try:
+        return int(sum(os.path.getsize(path) for path in paths) * 1.2)
+    except OSError:
+        return 0
+
+
+def _spawn_model_server(model_name: str) -> ModelServer:
+    """Spawns the llama-server subprocess of a model; the server pool waits for it to become ready."""
+    file_name = model_name + ".gguf"
+    model_config = get_model_config(file_name)
+    loader_config = model_config["loader_config"]
+
+    path = _model_path(file_name)
 
     compute_device = os.getenv("COMPUTE_DEVICE", "CUDA")
     n_gpu_layers = -1 if compute_device != "CPU" else 0
 
-    port = _find_free_port()
     model_alias = file_name.split(".gguf")[0]
+    socket_path = server_socket_path(model_alias)
+    n_parallel = loader_config.get("n_parallel", 1)
 
     server_config = json.dumps({
         "model_path": path,
-        "hostname": "127.0.0.1",
-        "port": port,
         "n_gpu_layers": n_gpu_layers,
         "n_batch": loader_config.get("n_batch", 512),
-        "n_parallel": loader_config.get("n_parallel", 1),
+        "n_parallel": n_parallel,
         "cont_batching": True,
-        **loader_config,
+        **({"slot_save_path": slot_save_path(persistent_storage(), model_alias)} if PREFIX_KV_CACHE else {}),
+        # The OpenAI-compatible tool calling API needs the model's jinja chat template
+        **({"use_jinja": True} if model_config.get("tool_calling") == "native" else {}),
+        # The draft model of speculative decoding runs on the same device as the model
+        "draft_n_gpu_layers": n_gpu_layers,
+        **{k: v for k, v in loader_config.items() if k not in ("memory_mb", "hostname", "port")},
+        # A hostname ending with .sock makes llama-server listen on that Unix domain socket
+        "hostname": socket_path,
+        **({"draft_model": _model_path(loader_config["draft_model"])} if loader_config.get("draft_model") else {}),
     })
 
-    logger.info(f"Starting llama-server for {file_name} on port {port}")
+    logger.info(f"Starting llama-server for {file_name} on {socket_path}")
     try:
         proc = subprocess.Popen(
             [sys.executable, _SERVER_SCRIPT_PATH, server_config],
@@ -156,55 +288,169 @@ def generate_chat_model(file_name: str) -> ChatOpenAI:
     except OSError as e:
         raise RuntimeError(f"Failed to spawn llama-server subprocess for {file_name}: {e}") from e
 
-    log_pipe = _ServerLogPipe(model_alias)
+    log_pipe = ServerLogPipe(model_alias)
     Thread(target=log_pipe.consume, args=(proc.stdout,), daemon=True).start()
-    _server_processes[file_name] = (proc, port)
 
-    try:
-        _wait_for_server(proc, port, log_pipe)
-    except Exception:
-        _server_processes.pop(file_name, None)
-        try:
-            proc.terminate()
-            proc.wait(timeout=5)
-        except Exception:
-            try:
-                proc.kill()
-            except Exception:
-                pass
-        raise
-    logger.info(f"llama-cpp-server for {file_name} ready on port {port}")
+    base_url = unix_socket_url(socket_path)
+    _server_urls[model_alias] = base_url
+    http_client, http_async_client = _server_http_clients(socket_path, n_parallel)
+    # The host is ignored, requests go through the socket. Requests are always streamed, since
+    # llama-server only stops generating for a closed connection when it streams, e.g. for a
+    # cancelled task. The usage of streamed answers reports how much of the prompt was cached.
+    llm = _chat_model(
+        "http://localhost/v1", model_alias, loader_config,
+        http_client=http_client, http_async_client=http_async_client, streaming=True, stream_usage=True,
+    )
+    return ModelServer(
+        model_name=model_name, proc=proc, base_url=base_url, llm=llm, log_pipe=log_pipe, socket_path=socket_path,
+    )
+
 
+def _server_http_clients(socket_path: str, n_parallel: int) -> tuple[httpx.Client, httpx.AsyncClient]:
+    """HTTP clients for a local server's socket, shared by the requests of all its tasks.
+
+    A connection per slot is kept alive so requests don't connect first. Up to as many requests
+    again can wait in the server's queue for a free slot, the rest wait for a connection.
+    """
+    limits = httpx.Limits(max_connections=2 * n_parallel, max_keepalive_connections=n_parallel)
+    return (
+        httpx.Client(transport=httpx.HTTPTransport(uds=socket_path, limits=limits)),
+        httpx.AsyncClient(transport=httpx.AsyncHTTPTransport(uds=socket_path, limits=limits)),
+    )
+
+
+def _chat_model(base_url: str, model: str, loader_config: dict, **kwargs: Any) -> ChatOpenAI:
     model_kwargs: dict = {}
     if loader_config.get("stop"):
         model_kwargs["stop"] = loader_config["stop"]
 
     return ChatOpenAI(
-        base_url=f"http://127.0.0.1:{port}/v1",
-        api_key="not-needed",
-        model=model_alias,
+        base_url=base_url,
+        model=model,
         max_tokens=loader_config.get("max_tokens", 2048),
         temperature=loader_config.get("temperature", 0.7),
         model_kwargs=model_kwargs,
+        callbacks=[GENERATION_METRICS],
+        **{"api_key": "not-needed", **kwargs},
     )
 
 
+# model name -> (endpoints config, backend) of the models served by remote endpoints
+_remote_backends: dict[str, tuple[list, RemoteBackend]] = {}
+
+
+def remote_backend(model_name: str) -> RemoteBackend | None:
+    """The backend of a model whose config lists remote `endpoints`, None for local models."""
+    model_name = model_name.split(".gguf")[0]
+    model_config = get_model_config(model_name)
+    endpoints_config = model_config.get("endpoints")
+    if not endpoints_config:
+        return None
+    cached = _remote_backends.get(model_name)
+    if cached is not None and cached[0] is endpoints_config:
+        return cached[1]
+    if cached is not None:
+        cached[1].stop()
+
+    loader_config = model_config["loader_config"]
+    try:
+        endpoints = [
+            Endpoint(
+                url=entry["url"],
+                slots=entry["slots"],
+                api_key=entry.get("api_key", ""),
+                # Failing over to another endpoint beats retrying a dead one
+                llm=_chat_model(
+                    entry["url"], entry.get("model", model_name), loader_config,
+                    max_retries=0, **({"api_key": entry["api_key"]} if entry.get("api_key") else {}),
+                ),
+            )
+            for entry in parse_endpoints(endpoints_config)
+        ]
+    except ValueError as e:
+        logger.error(f"Invalid endpoints in the config of {model_name}: {e}")
+        endpoints = []
+    backend = RemoteBackend(model_name, endpoints)
+    _remote_backends[model_name] = (endpoints_config, backend)
+    return backend
+
+
+def remote_backends() -> dict[str, RemoteBackend]:
+    return {model_name: backend for model_name, (_, backend) in _remote_backends.items()}
+
+
+async def start_model(model_name: str) -> None:
+    """Makes sure the model can take requests: starts its local server or checks its remote endpoints."""
+    backend = remote_backend(model_name)
+    if backend is not None:
+        await backend.start()
+    else:
+        await SERVER_POOL.start(model_name)
+
+
+def model_can_serve(model_name: str) -> bool:
+    backend = remote_backend(model_name)
+    if backend is not None:
+        return backend.is_available()
+    return SERVER_POOL.can_serve(model_name)
+
+
+def is_remote_model(model_name: str) -> bool:
+    return bool(get_model_config(model_name).get("endpoints"))
+
+
+def model_is_warm(model_name: str) -> bool:
+    # Remote endpoints have their models loaded already
+    return remote_backend(model_name) is not None or SERVER_POOL.is_warm(model_name)
+
+
+async def _warm_up_server(server: ModelServer) -> None:
+    if not PREFIX_KV_CACHE:
+        return
+    file_name = server.model_name + ".gguf"
+    loader_config = get_model_config(file_name)["loader_config"]
+    os.makedirs(slot_save_path(persistent_storage(), server.model_name), exist_ok=True)
+    prefixes = {}
+    for task_type, factory in PROCESSOR_FACTORIES.items():
+        processor = _processor_loader(file_name, server.model_name + ":" + task_type, factory)()
+        messages = processor_prefix_messages(processor)
+        if messages:
+            prefixes[task_type] = messages
+    await warm_prefix_cache(
+        server.base_url,
+        slot_save_path(persistent_storage(), server.model_name),
+        _model_path(file_name),
+        loader_config,
+        prefixes,
+    )
+
+
+SERVER_POOL = ServerPool(
+    _spawn_model_server,
+    _estimate_server_memory,
+    ram_budget_bytes=int(SERVER_RAM_BUDGET_MB * 1024 * 1024),
+    idle_timeout=SERVER_IDLE_TIMEOUT,
+    on_ready=_warm_up_server,
+)
+
+
+def generate_chat_model(file_name: str) -> ChatOpenAI | Runnable:
+    """Returns the client of a model's server, which must have been started with start_model()."""
+    backend = remote_backend(file_name)
+    if backend is not None:
+        return backend.chat_model
+    return SERVER_POOL.get(file_name.split(".gguf")[0]).llm
+
+
 def stop_all_servers() -> None:
-    for file_name, (proc, port) in _server_processes.items():
-        logger.info(f"Stopping llama-cpp-server for {file_name} (port {port})")
-        try:
-            proc.terminate()
-            proc.wait(timeout=15)
-        except Exception as e:
-            logger.warning(f"Error stopping server for {file_name}: {e}")
-            try:
-                proc.kill()
-            except Exception:
-                pass
-    _server_processes.clear()
+    for backend in remote_backends().values():
+        backend.stop()
+    SERVER_POOL.stop_all()
 
 
 def generate_task_processors(task_processors = {}):
+    refresh_model_configs()
+
     for file in os.scandir(models_folder_path):
         if file.name.endswith(".gguf"):
             if file.name.split('.gguf')[0] in task_processors:
@@ -217,23 +463,113 @@ def generate_task_processors(task_processors = {}):
                 continue
             generate_task_processors_for_model(file.name, task_processors)
 
+    # Models served by remote endpoints only need their config, no GGUF file
+    for folder in (models_folder_path, persistent_storage()):
+        for file in os.scandir(folder):
+            if not file.name.endswith('.json'):
+                continue
+            model_name = file.name[:-len('.json')]
+            if os.path.exists(os.path.join(folder, model_name + '.gguf')):
+                continue
+            try:
+                is_remote = bool(get_model_config(model_name).get("endpoints"))
+            except (OSError, ValueError, KeyError, AttributeError):
+                continue
+            if is_remote:
+                generate_task_processors_for_model(model_name + '.gguf', task_processors)
+
     return task_processors
 
 
+# processor name -> (chat model, model config, processor). Processors hold no per-task state,
+# so one instance per model is reused until the chat model or the config changes.
+_processors: dict[str, tuple[ChatOpenAI, dict, Any]] = {}
+# (model, server base url) -> tokenizer, so the token count cache survives rebuilt processors
+_tokenizers: dict[tuple[str, str], ServerTokenizer] = {}
+
+
+def _tokenizer_for(llm: ChatOpenAI) -> ServerTokenizer:
+    base_url = _server_urls.get(llm.model_name) or str(llm.openai_api_base).removesuffix("/v1")
+    key = (llm.model_name, base_url)
+    if key not in _tokenizers:
+        _tokenizers[key] = ServerTokenizer(base_url)
+    return _tokenizers[key]
+
+
+# (model, server base url) -> slot router, shared by the chat processors of the server
+_slot_routers: dict[tuple[str, str], SlotRouter] = {}
+
+
+def _slot_router_for(llm: ChatOpenAI, model_config: dict) -> SlotRouter | None:
+    """Router of chat turns to the slots of a local server with several slots, None otherwise."""
+    n_parallel = model_config["loader_config"].get("n_parallel", 1)
+    base_url = _server_urls.get(llm.model_name)
+    if model_config.get("endpoints") or base_url is None or n_parallel < 2:
+        return None
+    key = (llm.model_name, base_url)
+    if key not in _slot_routers:
+        _slot_routers[key] = SlotRouter(llm.model_name, n_parallel)
+    return _slot_routers[key]
+
+
+def _processor_loader(file_name: str, processor_name: str, factory: Callable[[ChatOpenAI, dict], Any]) -> Callable[[], Any]:
+    task_type = processor_name.split(":", 1)[1]
+
+    def load():
+        llm = generate_chat_model(file_name)
+        model_config = get_model_config(file_name)
+        cached = _processors.get(processor_name)
+        if cached is not None and cached[0] is llm and cached[1] is model_config:
+            return cached[2]
+        # The task type's profile applies per request, all task types share the model's client
+        profile = task_profile(model_config, task_type)
+        processor = factory(llm.bind(**profile) if profile else llm, model_config)
+        _processors[processor_name] = (llm, model_config, processor)
+        return processor
+    return load
+
+
+PROCESSOR_FACTORIES: dict[str, Callable[[ChatOpenAI, dict], Any]] = {
+    "core:text2text:summary": lambda llm, config: SummarizeProcessor(
+        llm,
+        config["loader_config"]["n_ctx"],
+        config["loader_config"].get("n_parallel", 1),
+        _max_tokens(config, "core:text2text:summary"),
+        _tokenizer_for(llm),
+    ),
+    "core:text2text:headline": lambda llm, config: HeadlineProcessor(llm),
+    "core:text2text:topics": lambda llm, config: TopicsProcessor(llm),
+    "core:text2text:simplification": lambda llm, config: SimplifyProcessor(llm),
+    "core:text2text:reformulation": lambda llm, config: ReformulateProcessor(llm),
+    "core:contextwrite": lambda llm, config: ContextWriteProcessor(llm),
+    "core:text2text:improve": lambda llm, config: ImproveProcessor(llm),
+    "core:text2text": lambda llm, config: FreePromptProcessor(llm),
+    "core:text2text:chat": lambda llm, config: ChatProcessor(
+        llm, _history_window(llm, config, "core:text2text:chat"), _slot_router_for(llm, config),
+    ),
+    "core:text2text:proofread": lambda llm, config: ProofreadProcessor(llm),
+    "core:text2text:changetone": lambda llm, config: ChangeToneProcessor(llm),
+    "core:text2text:chatwithtools": lambda llm, config: ChatWithToolsProcessor(
+        llm,
+        native_tools=config.get("tool_calling") == "native",
+        history_window=_history_window(llm, config, "core:text2text:chatwithtools"),
+        slot_router=_slot_router_for(llm, config),
+    ),
+    "core:text2text:reformatparagraphs": lambda llm, config: ReformatParagraphsProcessor(
+        llm,
+        config["loader_config"]["n_ctx"],
+        config["loader_config"].get("n_parallel", 1),
+        _max_tokens(config, "core:text2text:reformatparagraphs"),
+        _tokenizer_for(llm),
+    ),
+}
+
+
 def generate_task_processors_for_model(file_name, task_processors):
     model_name = file_name.split('.gguf')[0]
-    n_ctx = get_model_config(file_name)["loader_config"]["n_ctx"]
-
-    task_processors[model_name + ":core:text2text:summary"] = lambda: SummarizeProcessor(generate_chat_model(file_name), n_ctx)
-    task_processors[model_name + ":core:text2text:headline"] = lambda: HeadlineProcessor(generate_chat_model(file_name))
-    task_processors[model_name + ":core:text2text:topics"] = lambda: TopicsProcessor(generate_chat_model(file_name))
-    task_processors[model_name + ":core:text2text:simplification"] = lambda: SimplifyProcessor(generate_chat_model(file_name))
-    task_processors[model_name + ":core:text2text:reformulation"] = lambda: ReformulateProcessor(generate_chat_model(file_name))
-    task_processors[model_name + ":core:contextwrite"] = lambda: ContextWriteProcessor(generate_chat_model(file_name))
-    task_processors[model_name + ":core:text2text:improve"] = lambda: ImproveProcessor(generate_chat_model(file_name))
-    task_processors[model_name + ":core:text2text"] = lambda: FreePromptProcessor(generate_chat_model(file_name))
-    task_processors[model_name + ":core:text2text:chat"] = lambda: ChatProcessor(generate_chat_model(file_name))
-    task_processors[model_name + ":core:text2text:proofread"] = lambda: ProofreadProcessor(generate_chat_model(file_name))
-    task_processors[model_name + ":core:text2text:changetone"] = lambda: ChangeToneProcessor(generate_chat_model(file_name))
-    task_processors[model_name + ":core:text2text:chatwithtools"] = lambda: ChatWithToolsProcessor(generate_chat_model(file_name))
-    task_processors[model_name + ":core:text2text:reformatparagraphs"] = lambda: ReformatParagraphsProcessor(generate_chat_model(file_name))
+    # Load the config into the registry now, so the scheduler never has to read it from disk
+    get_model_config(file_name, revalidate=True)
+
+    for task_type, factory in PROCESSOR_FACTORIES.items():
+        processor_name = model_name + ":" + task_type
+        task_processors[processor_name] = _processor_loader(file_name, processor_name, factory)
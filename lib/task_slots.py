@@ -0,0 +1,66 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+"""Model slots for the parallel requests of one task
+
+A claimed task is charged one slot of its model. Processors that split their input, like
+summaries and paragraph reformatting, send the requests for the parts in parallel; every
+request beyond the first runs on a further slot, which the task borrows from the model's
+free slots (see `borrow_model_slots` in main.py) and gives back as soon as it has no more
+requests for it. This way the parallel requests never take the slots of other claimed tasks
+or the slots reserved for higher priority classes.
+"""
+import asyncio
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Awaitable, Callable, TypeVar
+
+T = TypeVar("T")
+
+
+@dataclass
+class TaskSlots:
+    # Takes up to the given number of free slots of the task's model, returns how many it got
+    borrow: Callable[[int], Awaitable[int]]
+    # Gives back the given number of borrowed slots
+    give_back: Callable[[int], Awaitable[None]]
+
+
+# Slots of the task processed in the current asyncio context, None outside of tasks
+_current_slots: ContextVar[TaskSlots | None] = ContextVar("llm2_task_slots", default=None)
+
+
+def use_task_slots(slots: TaskSlots) -> None:
+    """Lets the requests made from the current asyncio task (and its children) borrow slots."""
+    _current_slots.set(slots)
+
+
+async def gather_with_task_slots(calls: list[Callable[[], Awaitable[T]]], limit: int) -> list[T]:
+    """Runs the calls on the task's own slot and the slots it can borrow, at most `limit` at a time.
+
+    Returns the results in the order of the calls. Outside of a task, `limit` calls run at a time.
+    """
+    wanted = max(0, min(limit, len(calls)) - 1)
+    slots = _current_slots.get()
+    extra = await slots.borrow(wanted) if slots is not None and wanted else wanted
+    results: list[T] = [None] * len(calls)  # type: ignore[list-item]
+    pending = iter(enumerate(calls))
+
+    async def worker(borrowed: bool) -> None:
+        try:
+            for index, call in pending:
+                results[index] = await call()
+        finally:
+            # Free for other tasks once there is nothing left to start
+            if borrowed and slots is not None:
+                await slots.give_back(1)
+
+    workers = [asyncio.ensure_future(worker(index > 0)) for index in range(extra + 1)]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        # One failed request fails the task, the other workers stop and give their slots back
+        for running in workers:
+            running.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        raise
+    return results
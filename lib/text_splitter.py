@@ -0,0 +1,194 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+"""Token-aware text splitting
+
+Chunks are sized by the token counts of the model's own tokenizer (llama-server's /tokenize
+endpoint), so they fill the context window for every script, from English to CJK. The input is
+walked once, sentence by sentence; only finished chunks are tokenized to verify their size.
+"""
+import hashlib
+import logging
+import re
+import time
+from collections import OrderedDict
+
+import niquests
+
+logger = logging.getLogger(__name__)
+
+# A sentence (or a run of text up to a line break) including its terminator and trailing whitespace
+_UNIT_PATTERN = re.compile(r"[^\n.!?。！？]*(?:[.!?。！？]+|\n+|$)\s*")
+
+# Seconds the token counts are estimated after a failed /tokenize request, growing with failures in a row
+MIN_TOKENIZE_BACKOFF = 1.0
+MAX_TOKENIZE_BACKOFF = 60.0
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough upper bound used when no tokenizer is reachable: ~4 ASCII chars or 1 other char per token."""
+    non_ascii = sum(1 for char in text if ord(char) > 127)
+    return (len(text) - non_ascii) // 4 + non_ascii + 1
+
+
+class ServerTokenizer:
+    """Counts tokens with a llama-server's /tokenize endpoint and caches the results.
+
+    Counts are estimated while the server can't be reached or fails, e.g. while it starts or is
+    busy; it is asked again after a backoff. Only a server without the endpoint is never asked again.
+    """
+
+    def __init__(self, base_url: str, cache_size: int = 4096) -> None:
+        self.base_url = base_url.rstrip("/")
+        self.cache_size = cache_size
+        self._cache: OrderedDict[str, int] = OrderedDict()
+        self._available = True
+        # Seconds to wait after the next failure, doubled with every failure in a row
+        self._backoff = MIN_TOKENIZE_BACKOFF
+        self._retry_at = 0.0
+        # One connection for all counts, opened on first use
+        self._session: niquests.AsyncSession | None = None
+
+    async def count(self, text: str) -> int:
+        if not text:
+            return 0
+        key = hashlib.sha1(text.encode("utf-8", "surrogatepass")).hexdigest()
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        count = await self._tokenize(text)
+        if count is None:
+            return estimate_tokens(text)
+        self._cache[key] = count
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return count
+
+    async def _tokenize(self, text: str) -> int | None:
+        if not self._available or time.monotonic() < self._retry_at:
+            return None
+        if self._session is None:
+            self._session = niquests.AsyncSession()
+        try:
+            resp = await self._session.post(self.base_url + "/tokenize", json={"content": text}, timeout=60)
+            if resp.status_code == 200:
+                self._backoff = MIN_TOKENIZE_BACKOFF
+                return len(resp.json()["tokens"])
+            if resp.status_code in (404, 501):
+                # The server has no tokenizer endpoint, don't keep asking
+                logger.warning(f"Tokenizing is not supported (status {resp.status_code}), falling back to estimates")
+                self._available = False
+                return None
+            logger.warning(f"Tokenizing failed with status {resp.status_code}, estimating for {self._backoff}s")
+        except Exception as e:
+            logger.warning(f"Tokenizing failed, estimating for {self._backoff}s: {e}")
+        self._retry_at = time.monotonic() + self._backoff
+        self._backoff = min(self._backoff * 2, MAX_TOKENIZE_BACKOFF)
+        return None
+
+
+class EstimatingTokenizer:
+    """Tokenizer stand-in for backends without a /tokenize endpoint."""
+
+    async def count(self, text: str) -> int:
+        return estimate_tokens(text) if text else 0
+
+
+def chunk_token_budget(n_ctx: int, n_parallel: int, prompt_overhead: int, max_tokens: int) -> int:
+    """Input tokens that fit into one request next to the prompt and the generated output.
+
+    llama-server splits the context evenly between its slots, and the output reserve is capped
+    at a quarter of a slot's context, since summaries are much shorter than their input.
+    """
+    slot_ctx = n_ctx // max(1, n_parallel)
+    output_reserve = min(max_tokens, slot_ctx // 4)
+    # Small safety margin for the chat template tokens around the messages
+    budget = int((slot_ctx - prompt_overhead - output_reserve) * 0.95)
+    return max(64, budget)
+
+
+class TokenBudgetSplitter:
+    """Splits text into chunks of at most `chunk_tokens` tokens, on sentence boundaries where possible."""
+
+    def __init__(self, tokenizer, chunk_tokens: int, overlap_tokens: int = 0) -> None:
+        self.tokenizer = tokenizer
+        self.chunk_tokens = max(1, chunk_tokens)
+        self.overlap_tokens = min(overlap_tokens, self.chunk_tokens // 4)
+        self._scale = 1.0
+
+    async def split_text(self, text: str) -> list[str]:
+        if not text:
+            return [text]
+        total_tokens = await self.tokenizer.count(text)
+        if total_tokens <= self.chunk_tokens:
+            return [text]
+        # Calibrates the cheap per-sentence estimates to the real tokenizer, so chunks are packed
+        # close to the budget and rarely have to be split again after verifying them
+        self._scale = total_tokens / estimate_tokens(text)
+
+        chunks: list[str] = []
+        # Sentences of the chunk being built, with their estimated token counts
+        units: list[str] = []
+        unit_tokens: list[float] = []
+        estimated = 0.0
+        for match in _UNIT_PATTERN.finditer(text):
+            unit = match.group(0)
+            if not unit:
+                continue
+            for piece in self._split_long_unit(unit):
+                tokens = estimate_tokens(piece) * self._scale
+                if units and estimated + tokens > self.chunk_tokens:
+                    chunks += await self._finish_chunk(units, estimated)
+                    units, unit_tokens = self._overlap(units, unit_tokens)
+                    estimated = sum(unit_tokens)
+                units.append(piece)
+                unit_tokens.append(tokens)
+                estimated += tokens
+        if units:
+            chunks += await self._finish_chunk(units, estimated)
+        return chunks
+
+    async def _finish_chunk(self, units: list[str], estimated: float) -> list[str]:
+        """Verify the chunk with the real tokenizer and halve it until every part fits."""
+        chunk = "".join(units)
+        if len(units) == 1:
+            return [chunk]
+        tokens = await self.tokenizer.count(chunk)
+        if estimated > 0:
+            # Follow local changes of the text, e.g. from prose to code, but slowly
+            self._scale = 0.7 * self._scale + 0.3 * self._scale * tokens / estimated
+        if tokens <= self.chunk_tokens:
+            return [chunk]
+        middle = len(units) // 2
+        ratio = tokens / estimated if estimated > 0 else 1.0
+        return (
+            await self._finish_chunk(units[:middle], estimated * ratio * middle / len(units))
+            + await self._finish_chunk(units[middle:], estimated * ratio * (len(units) - middle) / len(units))
+        )
+
+    def _overlap(self, units: list[str], unit_tokens: list[float]) -> tuple[list[str], list[float]]:
+        if not self.overlap_tokens:
+            return [], []
+        kept = 0
+        start = len(units)
+        while start > 0 and kept + unit_tokens[start - 1] <= self.overlap_tokens:
+            start -= 1
+            kept += unit_tokens[start]
+        return units[start:], unit_tokens[start:]
+
+    def _split_long_unit(self, unit: str) -> list[str]:
+        """Hard-split text without sentence boundaries that would not fit into one chunk."""
+        limit = self.chunk_tokens / self._scale
+        if estimate_tokens(unit) <= limit:
+            return [unit]
+        # estimate_tokens never counts less than a token per 4 chars, so this mostly fits at once
+        size = max(1, int(limit * 4 * 0.9))
+        pieces = []
+        start = 0
+        while start < len(unit):
+            end = start + size
+            while end - start > 1 and estimate_tokens(unit[start:end]) > limit:
+                end = start + (end - start) // 2
+            pieces.append(unit[start:end])
+            start = end
+        return pieces
@@ -0,0 +1,395 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+"""Tool call parsing for the text-based tool calling protocol
+
+The models write tool calls in one of three formats (Qwen `<tool_call>`, Olmo
+`<function_calls>`, Gemma ```` ```tool_call ````). ToolCallStreamParser follows the text
+as it is streamed: it only rescans the text around new format markers, and parses every
+completed call once. Its final result is the same as running try_parse_tool_calls() on
+the complete text.
+"""
+import ast
+import hashlib
+import json
+import logging
+import re
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+from streaming import StreamAccumulator
+
+logger = logging.getLogger(__name__)
+
+
+def generate_tool_call_id(tool_call: dict) -> str:
+    stable_payload = json.dumps(
+        {
+            "name": tool_call.get("name"),
+            "args": tool_call.get("args", tool_call.get("arguments", {})),
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha1(stable_payload.encode("utf-8")).hexdigest()[:16]
+
+
+def _parse_python_function_call(call_str: str) -> dict | None:
+    """Parse a Python-style call like `name(a="x", b=1)` into {name, arguments}."""
+    try:
+        tree = ast.parse(call_str.strip(), mode='eval')
+    except SyntaxError:
+        return None
+    if not isinstance(tree.body, ast.Call):
+        return None
+    func = tree.body.func
+    if isinstance(func, ast.Name):
+        name = func.id
+    elif isinstance(func, ast.Attribute):
+        name = func.attr
+    else:
+        return None
+    args: dict[str, Any] = {}
+    for kw in tree.body.keywords:
+        if kw.arg is None:
+            continue
+        try:
+            args[kw.arg] = ast.literal_eval(kw.value)
+        except (ValueError, SyntaxError):
+            return None
+    return {'name': name, 'arguments': args}
+
+
+def _parse_json_tool_call(body: str, tool_calls: list, arguments_required: bool) -> bool:
+    """Appends the call to `tool_calls` and returns whether it was parsed completely.
+
+    A call whose arguments fail to parse stays in the list as it is, like it always did.
+    """
+    try:
+        try:
+            func = json.loads(body)
+        except json.JSONDecodeError:
+            func = json.loads(body[0:-1])
+        tool_calls.append(func)
+        arguments = func["arguments"] if arguments_required else func.get("arguments", None)
+        if isinstance(arguments, str):
+            func["arguments"] = json.loads(arguments)
+        if 'arguments' in func:
+            func['args'] = func['arguments']
+            del func['arguments']
+        if 'id' not in func:
+            func['id'] = generate_tool_call_id(func)
+        if 'type' not in func:
+            func['type'] = 'tool_call'
+        return True
+    except json.JSONDecodeError as e:
+        logger.warning(f"Failed to parse tool calls: the content is {body} and {e}")
+        return False
+
+
+def _parse_gemma_tool_call(body: str, tool_calls: list) -> bool:
+    _parse_json_tool_call(body, tool_calls, arguments_required=True)
+    # Gemma calls never counted as found; it is the last format, so that changes nothing
+    return False
+
+
+def _parse_python_tool_call(body: str, tool_calls: list) -> bool:
+    func = _parse_python_function_call(body)
+    if func is None:
+        logger.warning(f"Failed to parse tool call: the content is {body}")
+        return False
+    func['args'] = func.pop('arguments', {})
+    func.setdefault('id', generate_tool_call_id(func))
+    func.setdefault('type', 'tool_call')
+    tool_calls.append(func)
+    return True
+
+
+@dataclass(frozen=True)
+class ToolCallFormat:
+    name: str
+    opener: str
+    pattern: re.Pattern
+    # Appends the parsed call to the list and returns whether it counts as found
+    parse: Callable[[str, list], bool]
+    # The body starts on the line after the opener instead of after the whitespace
+    fenced: bool = False
+
+
+# In order of precedence: a format is only used when no call of the formats before it was parsed
+TOOL_CALL_FORMATS = (
+    # Qwen-style tool call, works with Llama 3.1
+    # <tool_call>{"name": "function_name", "arguments": {"param1": "value1", "param2": "value2"}}</tool_call>
+    ToolCallFormat(
+        name="qwen",
+        opener="<tool_call>",
+        pattern=re.compile(r"<tool_call>\s*(.+?)\s*</?tool_call>", re.DOTALL),
+        parse=lambda body, tool_calls: _parse_json_tool_call(body, tool_calls, arguments_required=False),
+    ),
+    # Olmo-style tool call
+    # <function_calls>function_name(param1="value1", param2="value2")</function_calls>
+    ToolCallFormat(
+        name="olmo",
+        opener="<function_calls>",
+        pattern=re.compile(r"<function_calls>\s*(.+?)\s*</?function_calls>", re.DOTALL),
+        parse=_parse_python_tool_call,
+    ),
+    # Gemma-style tool call
+    # ```tool_call
+    # {"name": "function_name", "arguments": {"param1": "value1", "param2": "value2"}}
+    # ```
+    ToolCallFormat(
+        name="gemma",
+        opener="```tool_call",
+        pattern=re.compile(r"```tool_call\s*\n(.+?)\n\s*```", re.DOTALL),
+        parse=_parse_gemma_tool_call,
+        fenced=True,
+    ),
+)
+
+
+@dataclass
+class ParsedToolCall:
+    start: int
+    tool_calls: list[dict]
+    found: bool
+
+
+def parse_tool_call_match(tool_call_format: ToolCallFormat, match: re.Match, offset: int = 0) -> ParsedToolCall:
+    tool_calls: list[dict] = []
+    found = tool_call_format.parse(match.group(1), tool_calls)
+    return ParsedToolCall(offset + match.start(), tool_calls, found)
+
+
+def select_tool_calls(parsed: list[list[ParsedToolCall]]) -> tuple[list[dict], int]:
+    """Combines the calls of every format, in order, until one format had a call that was found.
+
+    Returns the tool calls and the start of the first call of the last format that was used.
+    """
+    tool_calls: list[dict] = []
+    offset = 0
+    found = False
+    for matches in parsed:
+        if found:
+            break
+        if matches:
+            offset = matches[0].start
+        for match in matches:
+            tool_calls += match.tool_calls
+            found = found or match.found
+    return tool_calls, offset
+
+
+def tool_call_response(content: str, tool_calls: list[dict], offset: int) -> dict[str, Any]:
+    if tool_calls:
+        if offset > 0 and content[:offset].strip():
+            c = content[:offset]
+        else:
+            c = ""
+        return {"role": "assistant", "content": c, "tool_calls": tool_calls}
+    return {"role": "assistant", "content": re.sub(r"<\|im_end\|>$", "", content)}
+
+
+# Strings whose arrival can complete or start a tool call or a hidden block
+_TRIGGERS = ("<tool", "<function_calls", "function_calls>", "tool_call>", "```")
+# Starts of text that is hidden from the streamed output until it is complete (or forever)
+_HIDDEN_MARKERS = ("<tool", "<function_calls", "```tool")
+# Longer than every marker and opener, so none can start before the last _OVERLAP chars unseen
+_OVERLAP = 16
+_WHITESPACE = re.compile(r"\s*")
+
+
+def _hidden_block_end(text: str, start: int) -> int | None:
+    """End of the complete tool call block at `start`, which is hidden from the streamed output."""
+    for opener, closer in (("<tool_call>", "</tool_call>"), ("<function_calls>", "</function_calls>"), ("```tool_call\n", "\n```")):
+        if text.startswith(opener, start):
+            end = text.find(closer, start + len(opener))
+            return end + len(closer) if end != -1 else None
+    return None
+
+
+@dataclass
+class _FormatState:
+    format: ToolCallFormat
+    # Where re.finditer() would continue looking for the next call
+    pos: int = 0
+    matches: list[ParsedToolCall] = field(default_factory=list)
+    # The last match could still change with more text, so only the final pass may continue
+    deferred: bool = False
+
+
+class ToolCallStreamParser:
+    """Incremental tool call parser for streamed responses.
+
+    Feed the streamed deltas to push(); payload() returns the streamed output with complete
+    tool calls hidden and the calls found so far, and finish() returns the final response.
+    Only the text from the earliest unfinished call on is kept for rescanning.
+    """
+
+    def __init__(self) -> None:
+        self._states = [_FormatState(tool_call_format) for tool_call_format in TOOL_CALL_FORMATS]
+        # Text from absolute position _base on; deltas are joined lazily from _pending
+        self._base = 0
+        self._buffer = ""
+        self._pending: list[str] = []
+        self._length = 0
+        self._recent = ""
+        # Visible output up to _visible_pos; the rest is visible unless hidden by a marker there
+        self._visible = StreamAccumulator()
+        self._visible_pos = 0
+        self._visible_blocked = False
+        # The tool calls of the last payload, serialized once per new call
+        self._serialized_tool_calls: str | None = None
+        self._serialized_match_count = 0
+
+    def push(self, delta: str) -> None:
+        if not delta:
+            return
+        self._pending.append(delta)
+        self._length += len(delta)
+        window = self._recent + delta
+        self._recent = window[-_OVERLAP:]
+        if any(trigger in window for trigger in _TRIGGERS):
+            self._settle()
+
+    def payload(self) -> dict[str, Any] | None:
+        self._settle()
+        visible = self._visible.text
+        if not self._visible_blocked:
+            visible += self._buffer[self._visible_pos - self._base:]
+        cleaned_output = re.sub(r"<\|im_end\|>$", "", visible)
+
+        match_count = sum(len(state.matches) for state in self._states)
+        if match_count != self._serialized_match_count:
+            tool_calls, _ = select_tool_calls([state.matches for state in self._states])
+            self._serialized_tool_calls = json.dumps(tool_calls) if tool_calls else None
+            self._serialized_match_count = match_count
+
+        payload: dict[str, Any] = {}
+        if cleaned_output or self._serialized_tool_calls:
+            payload['output'] = cleaned_output
+        if self._serialized_tool_calls:
+            payload['tool_calls'] = self._serialized_tool_calls
+        return payload or None
+
+    def finish(self, content: str) -> dict[str, Any]:
+        """The response for the complete `content`, which must be the text pushed so far (or none of it)."""
+        for state in self._states:
+            for match in state.format.pattern.finditer(content, state.pos):
+                state.matches.append(parse_tool_call_match(state.format, match))
+            state.pos = len(content)
+        tool_calls, offset = select_tool_calls([state.matches for state in self._states])
+        return tool_call_response(content, tool_calls, offset)
+
+    def _settle(self) -> None:
+        if self._pending:
+            self._buffer += "".join(self._pending)
+            self._pending.clear()
+        for state in self._states:
+            self._scan_format(state)
+        self._scan_visible()
+
+        keep_from = min([state.pos for state in self._states] + [self._visible_pos])
+        if keep_from > self._base:
+            self._buffer = self._buffer[keep_from - self._base:]
+            self._base = keep_from
+
+    def _scan_format(self, state: _FormatState) -> None:
+        buffer = self._buffer
+        tool_call_format = state.format
+        while not state.deferred:
+            start = buffer.find(tool_call_format.opener, state.pos - self._base)
+            if start == -1:
+                # No opener can start before the last few chars anymore
+                state.pos = max(state.pos, self._length - _OVERLAP)
+                return
+            state.pos = self._base + start
+            opener_end = start + len(tool_call_format.opener)
+            whitespace_end = _WHITESPACE.match(buffer, opener_end).end()
+            if whitespace_end == len(buffer):
+                return
+            if tool_call_format.fenced:
+                newline = buffer.rfind("\n", opener_end, whitespace_end)
+                if newline == -1:
+                    # The opener is not followed by a line break, so no call can start here
+                    state.pos += 1
+                    continue
+                body_start = newline + 1
+            else:
+                body_start = whitespace_end
+            match = tool_call_format.pattern.match(buffer, start)
+            if match is None:
+                return
+            if match.start(1) != body_start:
+                # Only matched by backtracking into the whitespace, which more text could still change
+                state.deferred = True
+                return
+            state.matches.append(parse_tool_call_match(tool_call_format, match, self._base))
+            state.pos = self._base + match.end()
+
+    def _scan_visible(self) -> None:
+        buffer = self._buffer
+        while True:
+            start = self._visible_pos - self._base
+            markers = [index for index in (buffer.find(marker, start) for marker in _HIDDEN_MARKERS) if index != -1]
+            if not markers:
+                # The text before the last few chars can no longer turn into a marker
+                confirmed_end = max(start, len(buffer) - _OVERLAP)
+                self._visible.append(buffer[start:confirmed_end])
+                self._visible_pos = self._base + confirmed_end
+                self._visible_blocked = False
+                return
+            marker = min(markers)
+            self._visible.append(buffer[start:marker])
+            self._visible_pos = self._base + marker
+            end = _hidden_block_end(buffer, marker)
+            if end is None:
+                self._visible_blocked = True
+                return
+            self._visible_pos = self._base + end
+
+
+class NativeToolCallAccumulator:
+    """Collects the tool calls of the OpenAI-compatible tool calling API from streamed chunks or a message."""
+
+    def __init__(self) -> None:
+        # index -> id, name and argument fragments of a streamed call
+        self._streamed: dict[int, dict[str, Any]] = {}
+        self._complete: list[dict] = []
+
+    def add(self, message: Any) -> None:
+        chunks = getattr(message, "tool_call_chunks", None)
+        if chunks:
+            for chunk in chunks:
+                index = chunk.get("index")
+                if index is None:
+                    index = len(self._streamed)
+                call = self._streamed.setdefault(index, {"id": None, "name": "", "args": []})
+                if chunk.get("id"):
+                    call["id"] = chunk["id"]
+                if chunk.get("name"):
+                    call["name"] += chunk["name"]
+                if chunk.get("args"):
+                    call["args"].append(chunk["args"])
+            return
+        if getattr(message, "tool_calls", None):
+            self._complete.extend(message.tool_calls)
+
+    def tool_calls(self) -> list[dict]:
+        tool_calls = []
+        for call in self._complete:
+            tool_calls.append(self._finish_call(call.get("name", ""), call.get("args", {}), call.get("id")))
+        for _, call in sorted(self._streamed.items()):
+            arguments = "".join(call["args"])
+            try:
+                args = json.loads(arguments) if arguments.strip() else {}
+            except json.JSONDecodeError as e:
+                logger.warning(f"Failed to parse tool calls: the arguments are {arguments} and {e}")
+                continue
+            tool_calls.append(self._finish_call(call["name"], args, call["id"]))
+        return tool_calls
+
+    @staticmethod
+    def _finish_call(name: str, args: Any, call_id: str | None) -> dict:
+        func = {"name": name, "args": args}
+        func["id"] = call_id or generate_tool_call_id(func)
+        func["type"] = "tool_call"
+        return func
@@ -0,0 +1,87 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import asyncio
+
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+from chat_history import ChatHistoryWindow
+from text_splitter import EstimatingTokenizer
+
+
+class SummaryModel(GenericFakeChatModel):
+    """Answers every summary request with a numbered summary and records the prompts."""
+
+    prompts: list = []
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        self.prompts.append(messages[0].content)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=f"SUMMARY{len(self.prompts)}"))])
+
+
+def window(budget_tokens: int = 400) -> tuple[ChatHistoryWindow, SummaryModel]:
+    model = SummaryModel(messages=iter([]), prompts=[])
+    return ChatHistoryWindow(model, EstimatingTokenizer(), budget_tokens=budget_tokens, summary_tokens=50), model
+
+
+def history(turns: int) -> list:
+    messages = []
+    for i in range(turns):
+        messages += [
+            HumanMessage(content=f"question {i} " + "word " * 40),
+            AIMessage(content=f"answer {i} " + "word " * 40),
+        ]
+    return messages
+
+
+FIRST = SystemMessage(content="You are helpful.")
+NEW = [HumanMessage(content="new question")]
+
+
+def fit(chat_window: ChatHistoryWindow, messages: list, new_messages: list = NEW) -> list:
+    return asyncio.run(chat_window.fit(FIRST, messages, new_messages))
+
+
+def test_short_history_is_sent_unchanged():
+    chat_window, model = window()
+    messages = history(2)
+    assert fit(chat_window, messages) == [FIRST, *messages, *NEW]
+    assert model.prompts == []
+
+
+def test_older_turns_are_replaced_by_a_summary():
+    chat_window, model = window()
+    messages = history(6)
+    fitted = fit(chat_window, messages)
+    assert fitted[0].content.startswith(FIRST.content)
+    assert fitted[0].content.endswith(f"SUMMARY{len(model.prompts)}")
+    assert fitted[-1] == NEW[0]
+    kept = fitted[1:-1]
+    # The latest turns are kept whole, the older ones are summarized
+    assert kept == messages[len(messages) - len(kept):]
+    assert kept[0].type == "human"
+    assert "question 0" in model.prompts[0]
+
+
+def test_summary_rolls_forward():
+    chat_window, model = window()
+    messages = history(6)
+    fit(chat_window, messages)
+    requests = len(model.prompts)
+    # Same conversation again: the cached summary is reused
+    fit(chat_window, messages)
+    assert len(model.prompts) == requests
+    # One more turn: only the newly dropped turns are folded into the previous summary
+    fit(chat_window, messages + history(7)[12:])
+    assert len(model.prompts) == requests + 1
+    assert f"SUMMARY{requests}" in model.prompts[-1]
+    assert "question 0" not in model.prompts[-1]
+
+
+def test_tool_call_stays_with_its_result():
+    chat_window, _ = window()
+    tool_call = AIMessage(content="", tool_calls=[{"name": "search", "args": {"query": "x" * 300}, "id": "1"}])
+    messages = history(6) + [HumanMessage(content="search for it"), tool_call]
+    fitted = fit(chat_window, messages, [ToolMessage(content="result", tool_call_id="1")])
+    assert fitted[-3:-1] == [messages[-2], tool_call]
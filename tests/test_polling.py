@@ -0,0 +1,52 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import time
+
+import pytest
+
+from polling import PollingPolicy
+
+
+def policy(**kwargs) -> PollingPolicy:
+    # A random value of 0.5 means no jitter
+    return PollingPolicy(min_interval=1, max_interval=8, trigger_interval=60, random=lambda: 0.5, **kwargs)
+
+
+def test_backs_off_while_the_queue_is_empty():
+    polling = policy()
+    assert [polling.next_interval() for _ in range(6)] == [1, 2, 4, 8, 8, 8]
+    polling.note_activity()
+    assert polling.next_interval() == 1
+
+
+def test_jitter_stays_within_bounds():
+    assert PollingPolicy(min_interval=1, jitter=0.2, random=lambda: 0.0).next_interval() == pytest.approx(0.8)
+    assert PollingPolicy(min_interval=1, jitter=0.2, random=lambda: 1.0).next_interval() == pytest.approx(1.2)
+
+
+def test_triggers_raise_the_cap():
+    polling = policy()
+    polling.note_trigger()
+    assert polling.triggers_live
+    assert [polling.next_interval() for _ in range(8)][-1] == 60
+
+
+def test_a_task_without_trigger_switches_back_to_polling():
+    polling = policy(missed_trigger_grace=10)
+    polling.note_trigger()
+    # Announced by the last trigger, or not waiting long enough
+    assert not polling.note_claimed(time.time() - 5)
+    assert not polling.note_claimed(polling.last_trigger_at)
+    polling.last_trigger_at = time.time() - 100
+    assert polling.note_claimed(time.time() - 50)
+    assert not polling.triggers_live
+    assert polling.cap == 8
+
+
+def test_missing_schedule_time_is_no_missed_trigger():
+    polling = policy()
+    polling.note_trigger()
+    polling.last_trigger_at = 0
+    assert not polling.note_claimed(None)
+    assert not polling.note_claimed(0)
+    assert polling.triggers_live
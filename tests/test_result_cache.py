@@ -0,0 +1,98 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import asyncio
+
+import pytest
+
+from inflight_tasks import TaskGone
+from result_cache import ResultCache
+
+
+def _cache(tmp_path) -> ResultCache:
+    return ResultCache(str(tmp_path), disabled_task_types="")
+
+
+def test_waiter_takes_over_when_leader_is_gone(tmp_path):
+    cache = _cache(tmp_path)
+    events = []
+
+    async def main():
+        leader_started = asyncio.Event()
+
+        async def leader_generate():
+            leader_started.set()
+            await asyncio.sleep(0.05)
+            raise TaskGone(1, "cancelled")
+
+        async def waiter_generate():
+            events.append("waiter generates")
+            return {"output": "fresh"}
+
+        async def on_coalesce():
+            events.append("coalesced")
+
+        async def on_take_over():
+            events.append("took over")
+
+        leader = asyncio.ensure_future(cache.get_or_generate("key", leader_generate, abandoned=(TaskGone,)))
+        await leader_started.wait()
+        waiter = await cache.get_or_generate(
+            "key", waiter_generate, on_coalesce=on_coalesce, on_take_over=on_take_over, abandoned=(TaskGone,),
+        )
+        with pytest.raises(TaskGone):
+            await leader
+        return waiter
+
+    assert asyncio.run(main()) == ({"output": "fresh"}, "miss")
+    assert events == ["coalesced", "took over", "waiter generates"]
+
+
+def test_waiter_takes_over_when_leader_is_cancelled(tmp_path):
+    cache = _cache(tmp_path)
+
+    async def main():
+        leader_started = asyncio.Event()
+
+        async def leader_generate():
+            leader_started.set()
+            await asyncio.sleep(10)
+
+        async def waiter_generate():
+            return {"output": "fresh"}
+
+        leader = asyncio.ensure_future(cache.get_or_generate("key", leader_generate))
+        await leader_started.wait()
+        waiters = [asyncio.ensure_future(cache.get_or_generate("key", waiter_generate)) for _ in range(2)]
+        await asyncio.sleep(0)
+        leader.cancel()
+        return await asyncio.gather(*waiters)
+
+    # One waiter generates, the other one waits for it
+    assert sorted(outcome for _, outcome in asyncio.run(main())) == ["coalesced", "miss"]
+    assert cache.stats()["misses"] == 2
+
+
+def test_waiter_gets_the_leaders_error(tmp_path):
+    cache = _cache(tmp_path)
+
+    async def main():
+        leader_started = asyncio.Event()
+
+        async def leader_generate():
+            leader_started.set()
+            await asyncio.sleep(0.05)
+            raise ValueError("model failed")
+
+        async def waiter_generate():
+            return {"output": "fresh"}
+
+        leader = asyncio.ensure_future(cache.get_or_generate("key", leader_generate, abandoned=(TaskGone,)))
+        await leader_started.wait()
+        try:
+            with pytest.raises(ValueError):
+                await cache.get_or_generate("key", waiter_generate, abandoned=(TaskGone,))
+        finally:
+            with pytest.raises(ValueError):
+                await leader
+
+    asyncio.run(main())
@@ -0,0 +1,75 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import json
+import time
+
+from scheduler import PriorityScheduler, load_priority_classes
+
+CHAT = "core:text2text:chat"
+FREE_PROMPT = "core:text2text"
+SUMMARY = "core:text2text:summary"
+TASK_PROCESSORS = {f"model:{task_type}": None for task_type in (SUMMARY, FREE_PROMPT, CHAT)}
+
+
+def scheduler(**kwargs) -> PriorityScheduler:
+    return PriorityScheduler(load_priority_classes(), **kwargs)
+
+
+def test_lower_classes_leave_the_reserved_slot_free():
+    priority = scheduler()
+    assert priority.usable_slots("model", 4, 0) == {"interactive": 4, "short_edit": 3, "batch": 3}
+    # The last free slot is held back for chats
+    assert priority.usable_slots("model", 4, 3) == {"interactive": 1, "short_edit": 0, "batch": 0}
+    # Once a chat runs, the reservation is met
+    priority.claimed("model", CHAT, {})
+    assert priority.usable_slots("model", 4, 3) == {"interactive": 1, "short_edit": 1, "batch": 1}
+    priority.released("model", CHAT)
+    assert priority.usable_slots("model", 4, 3)["batch"] == 0
+
+
+def test_reservations_never_take_every_slot():
+    assert scheduler().usable_slots("model", 1, 0) == {"interactive": 1, "short_edit": 1, "batch": 1}
+
+
+def test_reservations_of_classes_the_model_does_not_serve_are_ignored():
+    usable = scheduler().usable_slots("model", 2, 1, served_classes={"batch"})
+    assert usable["batch"] == 1
+
+
+def test_providers_are_ordered_by_class_and_filtered_by_reservations():
+    priority = scheduler()
+    providers = priority.provider_ids(TASK_PROCESSORS, {"model": 0}, lambda model: 2)
+    assert providers == [f"llm2:model:{CHAT}", f"llm2:model:{FREE_PROMPT}", f"llm2:model:{SUMMARY}"]
+    assert priority.provider_ids(TASK_PROCESSORS, {"model": 1}, lambda model: 2) == [f"llm2:model:{CHAT}"]
+    assert priority.provider_ids(TASK_PROCESSORS, {"model": 2}, lambda model: 2) == []
+
+
+def test_cold_models_are_offered_only_when_warm_ones_stay_saturated():
+    task_processors = {f"warm:{FREE_PROMPT}": None, f"cold:{FREE_PROMPT}": None}
+    priority = scheduler(cold_model_delay=0.05)
+
+    def offered(inflight: dict[str, int]) -> list[str]:
+        return priority.provider_ids(task_processors, inflight, lambda model: 1, model_warm=lambda model: model == "warm")
+
+    assert offered({}) == [f"llm2:warm:{FREE_PROMPT}"]
+    assert offered({"warm": 1}) == []
+    time.sleep(0.06)
+    assert offered({"warm": 1}) == [f"llm2:cold:{FREE_PROMPT}"]
+
+
+def test_claimed_returns_the_queue_wait():
+    priority = scheduler()
+    assert priority.claimed("model", SUMMARY, {}) is None
+    assert 9 < priority.claimed("model", SUMMARY, {"scheduledAt": time.time() - 10}) < 11
+
+
+def test_unknown_task_types_get_the_lowest_class():
+    assert scheduler().class_of("core:unknown").name == "batch"
+
+
+def test_invalid_priority_classes_fall_back_to_the_defaults(monkeypatch):
+    monkeypatch.setenv("TASK_PRIORITY_CLASSES", "not json")
+    assert [priority_class.name for priority_class in load_priority_classes()] == ["interactive", "short_edit", "batch"]
+    monkeypatch.setenv("TASK_PRIORITY_CLASSES", json.dumps([{"name": "all", "task_types": [CHAT], "reserved": 2}]))
+    classes = load_priority_classes()
+    assert [(priority_class.name, priority_class.reserved) for priority_class in classes] == [("all", 2)]
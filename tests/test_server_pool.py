@@ -0,0 +1,136 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import asyncio
+import time
+
+import pytest
+
+import server_pool
+from server_pool import ModelServer, ServerLogPipe, ServerPool
+
+GB = 1024 ** 3
+
+
+class FakeProcess:
+    def __init__(self) -> None:
+        self.pid = 1
+        self.exit_code: int | None = None
+
+    def poll(self) -> int | None:
+        return self.exit_code
+
+    def terminate(self) -> None:
+        self.exit_code = 0
+
+    def wait(self, timeout: float | None = None) -> int | None:
+        return self.exit_code
+
+    def kill(self) -> None:
+        self.exit_code = -9
+
+
+class Spawner:
+    def __init__(self) -> None:
+        self.spawned: list[ModelServer] = []
+
+    def __call__(self, model_name: str) -> ModelServer:
+        server = ModelServer(
+            model_name=model_name, proc=FakeProcess(), base_url=f"http://{model_name}", llm=None,
+            log_pipe=ServerLogPipe(model_name),
+        )
+        self.spawned.append(server)
+        return server
+
+    def names(self) -> list[str]:
+        return [server.model_name for server in self.spawned]
+
+
+@pytest.fixture(autouse=True)
+def ready_at_once(monkeypatch):
+    async def wait_for_server(proc, base_url, log_pipe):
+        await asyncio.sleep(0.01)
+    monkeypatch.setattr(server_pool, "wait_for_server", wait_for_server)
+
+
+def pool(ram_budget_gb: int = 0, **kwargs) -> tuple[ServerPool, Spawner]:
+    spawner = Spawner()
+    return ServerPool(spawner, lambda model_name: 2 * GB, ram_budget_bytes=ram_budget_gb * GB, **kwargs), spawner
+
+
+def test_concurrent_starts_share_one_server():
+    servers, spawner = pool()
+
+    async def main():
+        return await asyncio.gather(*(servers.start("a") for _ in range(5)))
+
+    started = asyncio.run(main())
+    assert spawner.names() == ["a"]
+    assert all(server is started[0] for server in started)
+    assert servers.get("a") is started[0]
+
+
+def test_least_recently_used_idle_server_is_evicted():
+    servers, spawner = pool(ram_budget_gb=4)
+
+    async def main():
+        await servers.start("a")
+        await servers.start("b")
+        servers.get("a")
+        assert not servers.fits_without_eviction("c")
+        await servers.start("c")
+
+    asyncio.run(main())
+    assert not servers.is_running("b")
+    assert servers.is_running("a") and servers.is_running("c")
+    assert spawner.spawned[1].proc.poll() is not None
+
+
+def test_servers_with_tasks_in_flight_are_not_evicted():
+    servers, _ = pool(ram_budget_gb=4)
+
+    async def main():
+        await servers.start("a")
+        await servers.start("b")
+
+    asyncio.run(main())
+    servers.acquire("a")
+    servers.acquire("b")
+    assert not servers.can_serve("c")
+    servers.release("b")
+    assert servers.can_serve("c")
+
+
+def test_idle_servers_are_stopped():
+    servers, _ = pool(idle_timeout=0.05)
+    asyncio.run(servers.start("a"))
+    servers.acquire("a")
+    time.sleep(0.06)
+    servers.evict_idle()
+    assert servers.is_running("a")
+    servers.release("a")
+    time.sleep(0.06)
+    servers.evict_idle()
+    assert not servers.is_running("a")
+    servers.stop_all()
+
+
+def test_exited_server_is_started_again():
+    servers, spawner = pool()
+    first = asyncio.run(servers.start("a"))
+    first.proc.exit_code = 1
+    assert not servers.is_running("a")
+    assert asyncio.run(servers.start("a")) is not first
+    assert spawner.names() == ["a", "a"]
+
+
+def test_failed_startup_stops_the_server(monkeypatch):
+    servers, spawner = pool()
+
+    async def never_ready(proc, base_url, log_pipe):
+        raise RuntimeError("not ready")
+    monkeypatch.setattr(server_pool, "wait_for_server", never_ready)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(servers.start("a"))
+    assert spawner.spawned[0].proc.poll() is not None
+    assert not servers.is_warm("a")
@@ -0,0 +1,34 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import asyncio
+
+from summarize import SummarizeProcessor
+
+
+class WordTokenizer:
+    async def count(self, text: str) -> int:
+        return len(text.split())
+
+
+def group(sizes: list[int], budget: int) -> list[list[int]]:
+    processor = SummarizeProcessor(None, tokenizer=WordTokenizer())
+    summaries = [" ".join(["word"] * size) for size in sizes]
+    groups = asyncio.run(processor._group_for_merge(summaries, budget))
+    return [[len(summary.split()) for summary in batch] for batch in groups]
+
+
+def test_batches_fit_the_budget():
+    assert group([3, 3, 3, 3, 3], 9) == [[3, 3, 3], [3, 3]]
+    assert group([3, 3], 9) == [[3, 3]]
+
+
+def test_leftover_joins_the_previous_batch_when_it_fits():
+    assert group([3, 3, 2], 8) == [[3, 3, 2]]
+
+
+def test_leftover_is_paired_with_the_last_summary_when_the_batch_is_full():
+    assert group([3, 3, 3, 4], 9) == [[3, 3], [3, 4]]
+
+
+def test_leftover_passes_on_when_nothing_fits():
+    assert group([4, 4, 8], 8) == [[4, 4], [8]]
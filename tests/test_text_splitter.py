@@ -0,0 +1,118 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from text_splitter import ServerTokenizer, TokenBudgetSplitter, chunk_token_budget, estimate_tokens
+
+
+class WordTokenizer:
+    """One token per word and per CJK character, unlike the estimates the splitter packs by."""
+
+    async def count(self, text: str) -> int:
+        return len(text.split()) + sum(1 for char in text if ord(char) > 0x2E80)
+
+
+def split(text: str, chunk_tokens: int, overlap_tokens: int = 0) -> list[str]:
+    splitter = TokenBudgetSplitter(WordTokenizer(), chunk_tokens, overlap_tokens)
+    return asyncio.run(splitter.split_text(text))
+
+
+def count(text: str) -> int:
+    return asyncio.run(WordTokenizer().count(text))
+
+
+PROSE = " ".join(f"Sentence number {i} is about the topic {i % 7} and nothing else." for i in range(300))
+
+
+def test_short_text_is_one_chunk():
+    assert split("Just one sentence.", 100) == ["Just one sentence."]
+    assert split("", 100) == [""]
+
+
+def test_chunks_fit_the_budget_and_keep_the_text():
+    chunks = split(PROSE, 120)
+    assert len(chunks) > 1
+    assert "".join(chunks) == PROSE
+    assert all(count(chunk) <= 120 for chunk in chunks)
+    # Cut on sentence boundaries
+    assert all(chunk.rstrip().endswith(".") for chunk in chunks)
+
+
+def test_cjk_text_fits_the_budget():
+    text = "这是一个关于天气的句子。" * 200
+    chunks = split(text, 100)
+    assert "".join(chunks) == text
+    assert all(count(chunk) <= 100 for chunk in chunks)
+
+
+def test_text_without_sentence_ends_is_hard_split():
+    text = "word " * 2000
+    chunks = split(text, 100)
+    assert "".join(chunks) == text
+    assert len(chunks) > 1
+    assert all(count(chunk) <= 100 for chunk in chunks)
+
+
+def test_overlapping_chunks_repeat_the_last_sentences():
+    chunks = split(PROSE, 120, overlap_tokens=30)
+    for previous, chunk in zip(chunks, chunks[1:]):
+        first_sentence = chunk.split(". ")[0]
+        assert first_sentence in previous
+
+
+def test_chunk_token_budget():
+    # 4096 / 2 slots, a quarter of a slot reserved for the output, 5% margin
+    assert chunk_token_budget(4096, 2, 100, 4000) == int((2048 - 100 - 512) * 0.95)
+    assert chunk_token_budget(512, 4, 500, 100) == 64
+
+
+class FakeSession:
+    def __init__(self, responses: list) -> None:
+        self.responses = responses
+        self.posts = 0
+
+    async def post(self, url, json, timeout):
+        self.posts += 1
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return SimpleNamespace(status_code=response, json=lambda: {"tokens": json["content"].split()})
+
+
+def tokenizer_with(responses: list) -> tuple[ServerTokenizer, FakeSession]:
+    tokenizer = ServerTokenizer("http://server")
+    session = FakeSession(responses)
+    tokenizer._session = session
+    return tokenizer, session
+
+
+def test_server_counts_are_cached():
+    tokenizer, session = tokenizer_with([200])
+    assert asyncio.run(tokenizer.count("three little words")) == 3
+    assert asyncio.run(tokenizer.count("three little words")) == 3
+    assert session.posts == 1
+
+
+@pytest.mark.parametrize("failure", [503, ConnectionResetError("reset")])
+def test_transient_failures_back_off(failure):
+    tokenizer, session = tokenizer_with([failure, 200])
+    text = "three little words"
+    assert asyncio.run(tokenizer.count(text)) == estimate_tokens(text)
+    # Estimated during the backoff without asking the server
+    assert asyncio.run(tokenizer.count(text)) == estimate_tokens(text)
+    assert session.posts == 1
+    tokenizer._retry_at = 0
+    assert asyncio.run(tokenizer.count(text)) == 3
+    assert tokenizer._available
+
+
+@pytest.mark.parametrize("status", [404, 501])
+def test_missing_endpoint_disables_the_tokenizer(status):
+    tokenizer, session = tokenizer_with([status])
+    asyncio.run(tokenizer.count("some text"))
+    assert not tokenizer._available
+    asyncio.run(tokenizer.count("other text"))
+    assert session.posts == 1
@@ -0,0 +1,99 @@
+# SPDX-FileCopyrightText: 2026 Nextcloud GmbH and Nextcloud contributors
+# SPDX-License-Identifier: AGPL-3.0-or-later
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from chatwithtools import try_parse_tool_calls
+from tool_call_parser import NativeToolCallAccumulator, ToolCallStreamParser
+
+QWEN = 'Let me check.<tool_call>{"name": "weather", "arguments": {"city": "Berlin"}}</tool_call>'
+OLMO = 'Searching <function_calls>search(query="nextcloud", limit=3)</function_calls> now'
+GEMMA = 'Sure.\n```tool_call\n{"name": "weather", "arguments": {"city": "Paris"}}\n```\nDone.'
+
+RESPONSES = [
+    "Just a plain answer without any tools.<|im_end|>",
+    QWEN,
+    OLMO,
+    GEMMA,
+    # Several calls, and whitespace around the body
+    QWEN + '\n<tool_call>\n  {"name": "time", "arguments": "{\\"zone\\": \\"UTC\\"}"}  \n</tool_call>',
+    # A later format is ignored once an earlier one found a call
+    OLMO + QWEN,
+    # Arguments that don't parse, and a call that is never closed
+    'Oops <tool_call>{"name": "broken", "arguments": {"a": }}</tool_call> and <tool_call>{"name": "open"',
+    # Markers that only look like the start of a call
+    "Use <tools> or ```python\nprint(1)\n``` instead.",
+]
+
+
+def stream(text: str, chunks: list[str]) -> tuple[ToolCallStreamParser, list[dict | None]]:
+    parser = ToolCallStreamParser()
+    payloads = []
+    for chunk in chunks:
+        parser.push(chunk)
+        payloads.append(parser.payload())
+    assert "".join(chunks) == text
+    return parser, payloads
+
+
+def fixed_size_chunks(text: str, size: int) -> list[str]:
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+@pytest.mark.parametrize("text", RESPONSES)
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 8, 13, 1000])
+def test_streamed_result_matches_full_parse(text, size):
+    parser, _ = stream(text, fixed_size_chunks(text, size))
+    assert parser.finish(text) == try_parse_tool_calls(text)
+
+
+@pytest.mark.parametrize("text", RESPONSES)
+def test_every_split_point_matches_full_parse(text):
+    # Splits every marker and closing tag at every position
+    for split in range(1, len(text)):
+        parser, _ = stream(text, [text[:split], text[split:]])
+        assert parser.finish(text) == try_parse_tool_calls(text), split
+
+
+@pytest.mark.parametrize("text", [QWEN, OLMO, GEMMA])
+def test_streamed_output_never_shows_tool_call_markup(text):
+    _, payloads = stream(text, fixed_size_chunks(text, 1))
+    for payload in payloads:
+        output = (payload or {}).get("output", "")
+        assert "<tool" not in output and "<function_calls" not in output and "```tool" not in output
+
+
+@pytest.mark.parametrize("text, output", [
+    (QWEN, "Let me check."),
+    (OLMO, "Searching  now"),
+    (GEMMA, "Sure.\n\nDone."),
+    ("Just a plain answer without any tools.<|im_end|>", "Just a plain answer without any tools."),
+])
+def test_final_payload(text, output):
+    _, payloads = stream(text, fixed_size_chunks(text, 3))
+    payload = payloads[-1]
+    assert payload["output"] == output
+    tool_calls = try_parse_tool_calls(text).get("tool_calls")
+    if tool_calls:
+        assert json.loads(payload["tool_calls"]) == tool_calls
+    else:
+        assert "tool_calls" not in payload
+
+
+def test_finish_without_pushing():
+    assert ToolCallStreamParser().finish(QWEN) == try_parse_tool_calls(QWEN)
+
+
+def test_native_tool_calls_from_chunks():
+    accumulator = NativeToolCallAccumulator()
+    for chunk in [
+        {"index": 0, "id": "call_1", "name": "weather", "args": '{"city": '},
+        {"index": 0, "args": '"Berlin"}'},
+        {"index": 1, "id": "call_2", "name": "broken", "args": '{"a": '},
+    ]:
+        accumulator.add(SimpleNamespace(tool_call_chunks=[chunk]))
+    tool_calls = accumulator.tool_calls()
+    # The call whose arguments don't parse is dropped
+    assert [(call["id"], call["name"], call["args"]) for call in tool_calls] == [("call_1", "weather", {"city": "Berlin"})]